@@ -28,6 +28,14 @@ DEBUG = True
 
 ALLOWED_HOSTS = []
 
+# The URL Tor Weather is served from, used in the links in its emails.
+BASE_URL = 'http://127.0.0.1:8000'
+
+# The Tor control port the updaters and the router lookups connect to, and
+# its password, or None for cookie or no authentication.
+TOR_CONTROL_PORT = 9051
+TOR_AUTHENTICATOR = None
+
 
 # Application definition
 
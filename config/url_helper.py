@@ -0,0 +1,48 @@
+"""
+The url_helper module builds the links Tor Weather puts in its emails and
+pages. All links start with the C{BASE_URL} Django setting, the URL the
+Tor Weather site is served from. The setting is read when a link is built,
+so importing this module needs no configuration.
+"""
+from django.conf import settings
+
+
+def _base_url():
+    """
+    @rtype: str
+    @return: The C{BASE_URL} setting without a trailing slash.
+    """
+    return settings.BASE_URL.rstrip('/')
+
+
+def get_confirm_url(confirm_auth):
+    """
+    @type confirm_auth: str
+    @param confirm_auth: A subscriber's confirmation authorization key.
+
+    @rtype: str
+    @return: The URL of the subscriber's confirmation page.
+    """
+    return '%s/confirm/%s/' % (_base_url(), confirm_auth)
+
+
+def get_unsubscribe_url(unsubs_auth):
+    """
+    @type unsubs_auth: str
+    @param unsubs_auth: A subscriber's unsubscription authorization key.
+
+    @rtype: str
+    @return: The URL of the subscriber's unsubscribe page.
+    """
+    return '%s/unsubscribe/%s/' % (_base_url(), unsubs_auth)
+
+
+def get_preferences_url(pref_auth):
+    """
+    @type pref_auth: str
+    @param pref_auth: A subscriber's preferences authorization key.
+
+    @rtype: str
+    @return: The URL of the subscriber's preferences page.
+    """
+    return '%s/preferences/%s/' % (_base_url(), pref_auth)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class WeatherappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'weatherapp'
+
+    def ready(self):
+        from weatherapp import fanout
+        fanout.connect_signals()
@@ -0,0 +1,284 @@
+"""
+The bandwidth module keeps a fixed-size history of the observed bandwidth of
+each router with a low bandwidth subscription, one sample per consensus,
+so that the low bandwidth check can ask about sustained bandwidth without
+rereading history rows from the database.
+
+The updaters run more often than once per consensus, since new descriptors
+also trigger a run, so samples are keyed by consensus number (see
+L{presence.consensus_seq}) and a consensus that has already been sampled
+is skipped. A window of N samples therefore covers N hourly consensuses.
+
+The samples live in one flat C{array('I')} with L{_SLOTS} slots per router,
+used as a ring buffer: every router is written at the same slot in a
+consensus, and once a router has a full window its oldest sample is
+overwritten. A router that is down in a consensus has its history cleared,
+since only bandwidth since the router last came up is of interest. Routers
+that no longer have a low bandwidth subscription are dropped with
+L{BandwidthHistory.retain}.
+The maximum of a recent window is taken over contiguous slices of the
+array. Routers are keyed by their binary fingerprints (see L{fingerprint}).
+
+The history is saved to L{HISTORY_FILE} after each update and loaded from
+it on first use, so it survives restarts.
+
+@type _SLOTS: int
+@var _SLOTS: Number of samples kept per router. One sample is taken per
+    hourly consensus, so this covers a week.
+
+@type _MAGIC: bytes
+@var _MAGIC: Marks the start of a history file.
+
+@type _HEADER: struct.Struct
+@var _HEADER: Layout of the history file header: the magic bytes, the
+    number of slots, the next slot to write, the number of routers and the
+    latest consensus number sampled.
+
+@type HISTORY_FILE: str
+@var HISTORY_FILE: Where the process-wide history is saved.
+"""
+import logging
+import os
+import struct
+import sys
+import threading
+from array import array
+
+from weatherapp import fingerprint as fp
+
+_SLOTS = 7 * 24
+_MAGIC = b'TWB3'
+_HEADER = struct.Struct('<4sIIII')
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data', 'bandwidth_history.dat')
+
+
+def _to_little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+class BandwidthHistory:
+    '''
+    A ring buffer of observed bandwidth samples for a set of routers.
+
+    @type slots: int
+    @ivar slots: Number of samples kept per router.
+
+    @type seq: int
+    @ivar seq: The number of the latest consensus sampled, or C{None}.
+
+    @type _rows: dict {bytes: int}
+    @ivar _rows: The row of each router's samples in L{_samples}.
+    @type _fingerprints: list [bytes]
+    @ivar _fingerprints: The binary fingerprint of the router in each
+        row.
+    @type _samples: array
+    @ivar _samples: The samples in kB/s, L{slots} per row.
+    @type _counts: array
+    @ivar _counts: How many of each row's most recent samples are valid.
+    @type _head: int
+    @ivar _head: The slot the next consensus is written to.
+    '''
+
+    def __init__(self, slots = _SLOTS):
+        self.slots = slots
+        self.seq = None
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._fingerprints = []
+        self._samples = array('I')
+        self._counts = array('I')
+        self._head = 0
+
+    def _row(self, key):
+        """
+        Return the row of the router C{key}, adding an empty row if needed.
+        """
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._fingerprints)
+            self._rows[key] = row
+            self._fingerprints.append(key)
+            self._samples.extend(array('I', [0]) * self.slots)
+            self._counts.append(0)
+        return row
+
+    def record(self, seq, samples):
+        """
+        Add one consensus's samples. Routers with history that are not in
+        C{samples} are treated as down and have their history cleared. A
+        consensus no newer than the latest one sampled is ignored.
+
+        @type seq: int
+        @param seq: The consensus number, from L{presence.consensus_seq}.
+        @type samples: dict {str: int}
+        @param samples: The observed bandwidth in kB/s of each subscribed
+            router that is up.
+
+        @rtype: bool
+        @return: C{True} if the samples were added, C{False} if the
+            consensus had already been sampled.
+        """
+        samples = dict((fp.to_binary(fingerprint), bandwidth)
+                       for fingerprint, bandwidth in samples.items())
+        with self._lock:
+            if self.seq is not None and seq <= self.seq:
+                return False
+            self.seq = seq
+            for key, row in self._rows.items():
+                if key not in samples:
+                    self._counts[row] = 0
+
+            head = self._head
+            for key, bandwidth in samples.items():
+                row = self._row(key)
+                index = row * self.slots + head
+                if self._counts[row] < self.slots:
+                    self._counts[row] += 1
+                self._samples[index] = bandwidth
+            self._head = (head + 1) % self.slots
+        return True
+
+    def retain(self, fingerprints):
+        """
+        Drop the history of every router not in C{fingerprints}, such as
+        routers whose last low bandwidth subscription was removed.
+
+        @type fingerprints: iterable of str
+        @param fingerprints: The routers to keep.
+        """
+        keep = set(fp.to_binary(fingerprint) for fingerprint in fingerprints)
+        with self._lock:
+            if all(key in keep for key in self._fingerprints):
+                return
+            kept = []
+            samples, counts = array('I'), array('I')
+            for row, key in enumerate(self._fingerprints):
+                if key in keep:
+                    base = row * self.slots
+                    kept.append(key)
+                    samples.extend(self._samples[base:base + self.slots])
+                    counts.append(self._counts[row])
+            self._fingerprints = kept
+            self._rows = dict((key, row) for row, key in enumerate(kept))
+            self._samples, self._counts = samples, counts
+
+    def _window(self, row, hours):
+        """
+        @rtype: list [array]
+        @return: The slices of C{row} holding its last C{hours} samples.
+        """
+        base = row * self.slots
+        start = (self._head - hours) % self.slots
+        if start < self._head:
+            return [self._samples[base + start:base + self._head]]
+        parts = [self._samples[base + start:base + self.slots]]
+        if self._head:
+            parts.append(self._samples[base:base + self._head])
+        return parts
+
+    def recent_max(self, fingerprints, hours):
+        """
+        Find the highest bandwidth of each router over the last C{hours}
+        consensuses. A router whose maximum is below a threshold has been
+        below it for the whole window.
+
+        @type fingerprints: iterable of str
+        @param fingerprints: The routers in question.
+        @type hours: int
+        @param hours: The length of the window, at most L{slots}.
+
+        @rtype: dict {str: int}
+        @return: The maximum of each router that has been up for the whole
+            window. Other routers are left out.
+        """
+        maxima = {}
+        with self._lock:
+            for fingerprint in fingerprints:
+                row = self._rows.get(fp.to_binary(fingerprint))
+                if row is None or self._counts[row] < hours:
+                    continue
+                maxima[fingerprint] = max(max(part) for part
+                                          in self._window(row, hours))
+        return maxima
+
+    def save(self, path):
+        """
+        Write the history to C{path}, replacing any previous file only once
+        the new one is complete.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        temp_path = path + '.tmp'
+        with self._lock, open(temp_path, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, self.slots, self._head,
+                                   len(self._fingerprints), self.seq or 0))
+            out.write(b''.join(self._fingerprints))
+            _to_little_endian(self._counts).tofile(out)
+            _to_little_endian(self._samples).tofile(out)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a history written by L{save}.
+
+        @rtype: L{BandwidthHistory}
+        @return: The history, or an empty one if C{path} is missing or is
+            not a history file with the current number of slots.
+        """
+        try:
+            with open(path, 'rb') as source:
+                magic, slots, head, count, seq = _HEADER.unpack(
+                    source.read(_HEADER.size))
+                if magic != _MAGIC or slots != _SLOTS:
+                    logging.warning("Ignoring bandwidth history in %s", path)
+                    return cls()
+                keys = source.read(fp.BINARY_LEN * count)
+                counts, samples = array('I'), array('I')
+                counts.fromfile(source, count)
+                samples.fromfile(source, count * slots)
+        except FileNotFoundError:
+            return cls()
+        except (OSError, EOFError, struct.error) as exc:
+            logging.warning("Could not read bandwidth history in %s: %s",
+                            path, exc)
+            return cls()
+
+        history = cls(slots)
+        history.seq = seq or None
+        history._head = head
+        history._counts = _to_little_endian(counts)
+        history._samples = _to_little_endian(samples)
+        history._fingerprints = [keys[i:i + fp.BINARY_LEN] for i
+                                 in range(0, len(keys), fp.BINARY_LEN)]
+        history._rows = dict((key, row) for row, key
+                             in enumerate(history._fingerprints))
+        return history
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history():
+    '''
+    Return the process-wide L{BandwidthHistory}, loading it from
+    L{HISTORY_FILE} on first use.
+
+    @rtype: L{BandwidthHistory}
+    @return: The shared history.
+    '''
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = BandwidthHistory.load(HISTORY_FILE)
+        return _history
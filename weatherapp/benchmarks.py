@@ -0,0 +1,199 @@
+"""
+The benchmarks module times each stage of one Tor Weather update cycle
+against synthetic data, so that regressions between releases show up as
+numbers rather than as slow hours in production.
+
+Each run builds a network of synthetic relays with the L{synthetic} module,
+fills a throwaway test database with the requested number of subscribers,
+and times these stages:
+
+    - C{subscription_index}: rebuilding the L{fanout} index from the
+      subscriptions, as each update does.
+    - C{consensus_load} and C{descriptor_load}: L{CachedDataCtlUil}
+      loading the cached files.
+    - C{router_upsert_full}: the first L{updaters.update_routers} pass,
+      which writes every router.
+    - C{router_upsert_diff}: the next pass, an hour of churn later.
+    - C{presence_record}: adding the consensus to the L{presence} history.
+    - C{bandwidth_record}: adding a sample to the L{bandwidth} history.
+    - C{evaluate_<type>}: each subscription check in
+      L{updaters.SUBSCRIPTION_CHECKS}, which also renders the emails.
+    - C{email_dispatch}: sending the rendered emails to Django's in-memory
+      email backend.
+
+Results are written as JSON. Run with::
+
+    python -m weatherapp.benchmarks --relays 7000 --scales 1000 10000 100000
+
+@type _DEFAULT_SCALES: list [int]
+@var _DEFAULT_SCALES: Subscriber counts benchmarked by default.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+_DEFAULT_SCALES = [1000, 10000, 100000]
+
+
+@contextmanager
+def _timed(stages, name):
+    """
+    Time the body of a with-statement and record it in C{stages}.
+
+    @type stages: dict {str: float}
+    @param stages: The timings of the current run, in seconds.
+    @type name: str
+    @param name: The stage name.
+    """
+    start = time.perf_counter()
+    yield
+    stages[name] = time.perf_counter() - start
+
+
+def run_cycle(relay_count, subscriber_count, path, seed = 0):
+    """
+    Benchmark one update cycle. Expects an empty database.
+
+    @type relay_count: int
+    @param relay_count: Number of synthetic relays.
+    @type subscriber_count: int
+    @param subscriber_count: Number of synthetic subscribers.
+    @type path: str
+    @param path: Scratch directory for the synthetic cached files.
+    @type seed: int
+    @param seed: Seed of the synthetic data.
+
+    @rtype: tuple (dict {str: float}, int)
+    @return: The duration of each stage in seconds, and the number of
+        emails sent.
+    """
+    from django.core.mail import send_mass_mail
+
+    from weatherapp import bandwidth, known, presence, updaters
+    from weatherapp.ctlutil import CachedDataCtlUil
+    from weatherapp.fanout import subscription_index
+    from weatherapp.synthetic import SyntheticNetwork, populate_database
+
+    network = SyntheticNetwork(relay_count, seed)
+    first, second = os.path.join(path, '0000'), os.path.join(path, '0001')
+    network.write(first)
+    populate_database(network, subscriber_count, seed)
+    network.advance()
+    network.write(second)
+
+    stages = {}
+    updaters._previous_state = None
+    with _timed(stages, 'subscription_index'):
+        subscription_index.build()
+    bandwidth.HISTORY_FILE = os.path.join(path, 'bandwidth_history.dat')
+    bandwidth._history = bandwidth.BandwidthHistory()
+    presence.PRESENCE_FILE = os.path.join(path, 'presence.dat')
+    presence._history = presence.PresenceHistory()
+    known.FILTER_FILE = os.path.join(path, 'known_fingerprints.dat')
+
+    ctl_util = CachedDataCtlUil(first)
+    with _timed(stages, 'consensus_load'):
+        ctl_util.refresh_consensus()
+    with _timed(stages, 'descriptor_load'):
+        ctl_util.refresh_descriptors()
+    with _timed(stages, 'router_upsert_full'):
+        updaters.update_routers(ctl_util)
+
+    ctl_util = CachedDataCtlUil(second)
+    ctl_util.refresh_consensus()
+    ctl_util.refresh_descriptors()
+    with _timed(stages, 'router_upsert_diff'):
+        updaters.update_routers(ctl_util)
+    with _timed(stages, 'presence_record'):
+        updaters.record_presence(ctl_util)
+    with _timed(stages, 'bandwidth_record'):
+        updaters.record_bandwidth(ctl_util)
+
+    email_list = []
+    for name, check, kinds in updaters.SUBSCRIPTION_CHECKS:
+        with _timed(stages, 'evaluate_' + name):
+            check(ctl_util, email_list)
+    with _timed(stages, 'email_dispatch'):
+        send_mass_mail(email_list, fail_silently = True)
+    return stages, len(email_list)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(relay_count, scales, seed = 0):
+    """
+    Benchmark an update cycle at each subscriber count in C{scales}, in a
+    fresh test database.
+
+    @rtype: dict
+    @return: The results, ready to be written as JSON.
+    """
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test.utils import setup_test_environment, \
+        teardown_test_environment
+
+    results = {'created': datetime.now().isoformat(),
+               'revision': _git_revision(),
+               'python': platform.python_version(),
+               'database': connection.vendor,
+               'relays': relay_count,
+               'runs': []}
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity = 0)
+    try:
+        for subscriber_count in scales:
+            call_command('flush', interactive = False, verbosity = 0)
+            with tempfile.TemporaryDirectory() as path:
+                stages, email_count = run_cycle(relay_count,
+                                                subscriber_count, path, seed)
+            results['runs'].append({'subscribers': subscriber_count,
+                                    'emails': email_count,
+                                    'stages': stages})
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+        teardown_test_environment()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the Tor Weather update cycle.')
+    parser.add_argument('--relays', type = int, default = 7000)
+    parser.add_argument('--scales', type = int, nargs = '+',
+                        default = _DEFAULT_SCALES,
+                        help = 'subscriber counts to benchmark')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'bench_output.json')
+    args = parser.parse_args()
+
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                          'TorWeatherProject.settings')
+    django.setup()
+
+    results = run_benchmarks(args.relays, args.scales, args.seed)
+    with open(args.output, 'w') as out:
+        json.dump(results, out, indent = 2)
+    for run in results['runs']:
+        print('%d subscribers:' % run['subscribers'])
+        for name, seconds in run['stages'].items():
+            print('    %-24s %s' % (name, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+"""
+The ctlsim module is a stand-in for a Tor control port, used to test and
+benchmark L{CtlUil} without a running Tor process. It speaks enough of the
+control protocol for Stem and CtlUil: PROTOCOLINFO, AUTHENTICATE, GETINFO
+(version, consensus/valid-after, ns/all, ns/id/*, desc/all-recent,
+desc/id/*), GETCONF, SETEVENTS and asynchronous NEWCONSENSUS and NEWDESC
+events.
+
+The network it serves is replayed from Tor DataDirectory style
+directories, each holding a C{cached-consensus} and a C{cached-descriptors}
+file, such as those written by a Tor process or by the L{synthetic}
+module. L{ControlPortSimulator.publish_next} moves on to the next directory
+and sends the events a real Tor would.
+
+Run it on its own with::
+
+    python -m weatherapp.ctlsim --port 9051 --interval 60 DIR [DIR ...]
+
+@type _TOR_VERSION: str
+@var _TOR_VERSION: The Tor version the simulator reports.
+"""
+import argparse
+import base64
+import binascii
+import re
+import socketserver
+import threading
+import time
+
+_TOR_VERSION = '0.4.8.9'
+
+
+def _fingerprint_from_identity(identity):
+    """
+    Convert the base64 identity of an 'r' line to a hex fingerprint.
+
+    @type identity: str
+    @param identity: Unpadded base64 identity digest.
+
+    @rtype: str
+    @return: The upper case hex fingerprint.
+    """
+    raw = base64.b64decode(identity + '=' * (-len(identity) % 4))
+    return binascii.hexlify(raw).decode().upper()
+
+
+class SimulatedNetwork:
+    '''
+    One consensus and its server descriptors, as served by the simulator.
+
+    @type valid_after: str
+    @ivar valid_after: The valid-after time of the consensus.
+
+    @type entries: dict {str: str}
+    @ivar entries: Router status entry text keyed by fingerprint, in
+        consensus order.
+
+    @type descriptors: dict {str: str}
+    @ivar descriptors: Server descriptor text keyed by fingerprint.
+    '''
+
+    def __init__(self, valid_after, entries, descriptors):
+        self.valid_after = valid_after
+        self.entries = entries
+        self.descriptors = descriptors
+
+    @classmethod
+    def from_data_directory(cls, path):
+        """
+        Read a network from the cached files in a Tor DataDirectory.
+
+        @type path: str
+        @param path: The directory holding C{cached-consensus} and
+            C{cached-descriptors}.
+
+        @rtype: L{SimulatedNetwork}
+        @return: The network read from C{path}.
+        """
+        with open(path + '/cached-consensus') as consensus_file:
+            consensus = consensus_file.read()
+        try:
+            with open(path + '/cached-descriptors') as descriptor_file:
+                descriptors = descriptor_file.read()
+        except FileNotFoundError:
+            descriptors = ''
+
+        match = re.search(r'^valid-after (.*)$', consensus, re.M)
+        valid_after = match.group(1).strip() if match else None
+
+        body = consensus.split('\ndirectory-footer', 1)[0]
+        entries = {}
+        for chunk in re.split(r'\n(?=r )', body)[1:]:
+            identity = chunk.split(' ', 3)[2]
+            entries[_fingerprint_from_identity(identity)] = chunk.strip('\n')
+
+        by_fingerprint = {}
+        for chunk in re.split(r'\n(?=router )', '\n' + descriptors)[1:]:
+            # Drop the annotation lines of the next descriptor.
+            lines = [line for line in chunk.strip('\n').split('\n')
+                     if not line.startswith('@')]
+            text = '\n'.join(lines)
+            match = re.search(r'^fingerprint (.*)$', text, re.M)
+            if match:
+                by_fingerprint[match.group(1).replace(' ', '')] = text
+
+        return cls(valid_after, entries, by_fingerprint)
+
+    def consensus_text(self):
+        """
+        @rtype: str
+        @return: Every router status entry, as returned by GETINFO ns/all.
+        """
+        return '\n'.join(self.entries.values())
+
+    def descriptors_text(self):
+        """
+        @rtype: str
+        @return: Every server descriptor, as returned by GETINFO
+            desc/all-recent.
+        """
+        return '\n'.join(self.descriptors.values())
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    '''
+    Serves one control connection.
+    '''
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.write_lock = threading.Lock()
+        self.events = set()
+        self.server.simulator._add_connection(self)
+
+    def finish(self):
+        self.server.simulator._remove_connection(self)
+        socketserver.StreamRequestHandler.finish(self)
+
+    def send(self, reply):
+        """
+        Write a reply, or an asynchronous event, to the connection.
+
+        @type reply: list [str]
+        @param reply: The reply lines, without line endings.
+        """
+        data = ''.join(line + '\r\n' for line in reply).encode('utf-8')
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                pass
+
+    def handle(self):
+        simulator = self.server.simulator
+        for line in self.rfile:
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            if not line:
+                continue
+            command, _, args = line.partition(' ')
+            command = command.upper()
+            if simulator.latency:
+                time.sleep(simulator.latency)
+            simulator._count(command)
+
+            if command == 'QUIT':
+                self.send(['250 closing connection'])
+                return
+            handler = getattr(self, '_do_' + command.lower(), None)
+            if handler is None:
+                self.send(['510 Unrecognized command "%s"' % command])
+            else:
+                self.send(handler(args))
+
+    def _do_protocolinfo(self, args):
+        return ['250-PROTOCOLINFO 1',
+                '250-AUTH METHODS=NULL,HASHEDPASSWORD',
+                '250-VERSION Tor="%s"' % _TOR_VERSION,
+                '250 OK']
+
+    def _do_authenticate(self, args):
+        return ['250 OK']
+
+    def _do_setevents(self, args):
+        self.events = set(arg.upper() for arg in args.split()
+                          if arg.upper() != 'EXTENDED')
+        return ['250 OK']
+
+    def _do_setconf(self, args):
+        return ['250 OK']
+
+    _do_resetconf = _do_setconf
+    _do_takeownership = _do_setconf
+
+    def _do_getconf(self, args):
+        keys = args.split() or ['']
+        return ['250-%s' % key for key in keys[:-1]] + ['250 %s' % keys[-1]]
+
+    def _do_getinfo(self, args):
+        network = self.server.simulator.network
+        reply = []
+        for key in args.split():
+            if key == 'version':
+                value = _TOR_VERSION
+            elif key == 'consensus/valid-after' and network.valid_after:
+                value = network.valid_after
+            elif key == 'ns/all':
+                value = network.consensus_text()
+            elif key == 'desc/all-recent':
+                value = network.descriptors_text()
+            elif key.startswith('ns/id/') and \
+                 key[6:].upper() in network.entries:
+                value = network.entries[key[6:].upper()]
+            elif key.startswith('desc/id/') and \
+                 key[8:].upper() in network.descriptors:
+                value = network.descriptors[key[8:].upper()]
+            else:
+                return ['552 Unrecognized key "%s"' % key]
+            reply.extend(_format_value('250', key, value))
+        return reply + ['250 OK']
+
+
+def _format_value(status, key, value):
+    """
+    Format one keyword/value pair of a reply, using a data block for
+    values that span several lines.
+
+    @rtype: list [str]
+    @return: The reply lines.
+    """
+    if '\n' not in value:
+        return ['%s-%s=%s' % (status, key, value)]
+    lines = ['%s+%s=' % (status, key)]
+    for line in value.split('\n'):
+        lines.append('.' + line if line.startswith('.') else line)
+    return lines + ['.']
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class ControlPortSimulator:
+    '''
+    A local control port serving a sequence of simulated networks.
+
+    @type networks: list [L{SimulatedNetwork}]
+    @ivar networks: The networks to replay, in order.
+
+    @type latency: float
+    @ivar latency: Seconds to wait before answering each command.
+
+    @type network: L{SimulatedNetwork}
+    @ivar network: The network currently served.
+
+    @type command_counts: dict {str: int}
+    @ivar command_counts: Number of commands received, by command.
+    '''
+
+    def __init__(self, networks, host = '127.0.0.1', port = 0,
+                 latency = 0):
+        self.networks = list(networks)
+        self.latency = latency
+        self.network = self.networks[0]
+        self.command_counts = {}
+        self._index = 0
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._server = _Server((host, port), _ControlHandler)
+        self._server.simulator = self
+        self._thread = None
+
+    @property
+    def address(self):
+        """
+        @rtype: tuple (str, int)
+        @return: The host and port the simulator listens on.
+        """
+        return self._server.server_address
+
+    def start(self):
+        """
+        Serve connections on a background thread.
+        """
+        self._thread = threading.Thread(target = self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving and close the listening socket.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _add_connection(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def _remove_connection(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def _count(self, command):
+        with self._lock:
+            self.command_counts[command] = \
+                self.command_counts.get(command, 0) + 1
+
+    def publish_next(self):
+        """
+        Move on to the next network, wrapping around after the last one,
+        and send NEWDESC and NEWCONSENSUS events to the connections that
+        asked for them.
+
+        @rtype: L{SimulatedNetwork}
+        @return: The network now being served.
+        """
+        with self._lock:
+            previous = self.network
+            self._index = (self._index + 1) % len(self.networks)
+            self.network = self.networks[self._index]
+            connections = list(self._connections)
+
+        changed = [fingerprint for fingerprint, text
+                   in self.network.descriptors.items()
+                   if previous.descriptors.get(fingerprint) != text]
+        newdesc = None
+        if changed:
+            newdesc = ['650 NEWDESC ' + ' '.join('$' + fingerprint
+                                                 for fingerprint in changed)]
+        newconsensus = _format_value('650', 'NEWCONSENSUS',
+                                     self.network.consensus_text() + '\n')
+        newconsensus[0] = '650+NEWCONSENSUS'
+        newconsensus[-2:] = ['.', '650 OK']
+
+        for connection in connections:
+            if newdesc and 'NEWDESC' in connection.events:
+                connection.send(newdesc)
+            if 'NEWCONSENSUS' in connection.events:
+                connection.send(newconsensus)
+        return self.network
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Simulate a Tor control port for Tor Weather.')
+    parser.add_argument('directories', nargs = '+',
+                        help = 'data directories to replay, in order')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 9051)
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = 'seconds to wait before each reply')
+    parser.add_argument('--interval', type = float, default = 3600,
+                        help = 'seconds between consensuses')
+    args = parser.parse_args()
+
+    networks = [SimulatedNetwork.from_data_directory(directory)
+                for directory in args.directories]
+    simulator = ControlPortSimulator(networks, args.host, args.port,
+                                     args.latency)
+    simulator.start()
+    print('Listening on %s:%s' % simulator.address)
+    try:
+        while True:
+            time.sleep(args.interval)
+            network = simulator.publish_next()
+            print('Published consensus valid after %s' % network.valid_after)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,10 @@ Stem and handle communication concerning consensus documents and descriptor
 files.
 
 @var unparsable_email_file: A log file for contacts with unparsable emails.
+
+@type _GETINFO_BATCH_SIZE: int
+@var _GETINFO_BATCH_SIZE: Maximum number of keys sent in one GETINFO command
+    by the batch lookups.
 """
 
 '''
@@ -19,22 +23,357 @@ https://stem.torproject.org/#:~:text=Stem%20is%20a%20Python%20controller,release
 '''
 import logging
 import re
+import collections
+import hashlib
+import mmap
+import os
+import threading
 import string
 import getpass
 import sys
 import socket
+from datetime import datetime
 
 import stem
 import stem.connection
+import stem.descriptor
+import stem.descriptor.router_status_entry
+import stem.descriptor.server_descriptor
 import stem.version
 
 from stem import Flag
 from stem.control import Controller
-from config import config 
+from django.conf import settings
+from weatherapp.fingerprint import normalize as _normalize_fingerprint
 
 
 unparsable_email_file = 'log/unparsable_emails.txt'
 
+_GETINFO_BATCH_SIZE = 100
+
+
+def _decode(value):
+    '''
+    Decode a descriptor field Stem hands back as bytes.
+
+    @type value: bytes
+    @param value: The raw field value, or C{None}.
+
+    @rtype: str
+    @return: The field as text, or C{None} if it was not present.
+    '''
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+DescriptorSummary = collections.namedtuple('DescriptorSummary',
+    ['observed_bandwidth', 'hibernating', 'platform', 'version', 'contact',
+     'exit', 'policy_digest'])
+DescriptorSummary.__doc__ = '''
+The parts of a relay's server descriptor that Weather uses. Everything else
+in the descriptor is dropped once it has been parsed.
+
+@type observed_bandwidth: int
+@ivar observed_bandwidth: Observed bandwidth in bytes per second.
+@type hibernating: bool
+@ivar hibernating: Whether the relay reports that it is hibernating.
+@type platform: str
+@ivar platform: The relay's platform line.
+@type version: stem.version.Version
+@ivar version: The Tor version the relay runs, or C{None}.
+@type contact: str
+@ivar contact: The relay's contact line, or C{None}.
+@type exit: bool
+@ivar exit: Whether the relay's exit policy allows exits to port 80.
+@type policy_digest: bytes
+@ivar policy_digest: Digest of the relay's exit policy in
+    L{exit_policy_cache}.
+'''
+
+
+def _normalized_rules(policy):
+    '''
+    Reduce an exit policy to the rules that can change whether it allows
+    exits to a port, whatever the address. Reject rules for particular
+    addresses, such as the relay's own address and private networks, are
+    dropped, since Stem does not match them when no address is given, and
+    so are the rules after one that matches every address and port.
+
+    @type policy: stem.exit_policy.ExitPolicy
+    @param policy: An exit policy.
+
+    @rtype: list [str]
+    @return: The remaining rules, in order.
+    '''
+    rules = []
+    for rule in policy:
+        if not rule.is_accept and not rule.is_address_wildcard():
+            continue
+        rules.append(str(rule))
+        if rule.is_address_wildcard() and rule.is_port_wildcard():
+            break
+    return rules
+
+
+class ExitPolicyCache:
+    '''
+    Memoizes exit policy evaluation. Thousands of relays share a handful of
+    exit policies (reject *:*, the default and the reduced exit policy), so
+    results are cached by a digest of the normalized policy and each
+    distinct policy is only evaluated once per port.
+
+    Relays put their own address and private networks in their policies,
+    which would make nearly every exit's policy unique. Weather only asks
+    about ports, never about addresses, and Stem never matches a reject
+    rule for particular addresses against such a question, so those rules
+    are left out of the digest (see L{_normalized_rules}). The cache is
+    still bounded and drops the policies used least recently once it holds
+    L{max_size}.
+
+    @type _MAX_POLICIES: int
+    @cvar _MAX_POLICIES: Default maximum number of cached policies, well
+        above the number of relays in the network.
+
+    @type max_size: int
+    @ivar max_size: Maximum number of cached policies.
+
+    @type _policies: collections.OrderedDict {bytes: stem.exit_policy.ExitPolicy}
+    @ivar _policies: One policy object per digest, kept to answer ports
+        that have not been asked about yet, least recently used first.
+
+    @type _results: dict {bytes: dict {int: bool}}
+    @ivar _results: Cached C{can_exit_to} results per digest and port.
+    '''
+
+    _MAX_POLICIES = 20000
+
+    def __init__(self, max_size = _MAX_POLICIES):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._policies = collections.OrderedDict()
+        self._results = {}
+
+    def digest(self, policy):
+        """
+        Add C{policy} to the cache if it is new and return its digest.
+
+        @type policy: stem.exit_policy.ExitPolicy
+        @param policy: An exit policy.
+
+        @rtype: bytes
+        @return: The digest of the policy's normalized rules.
+        """
+        key = hashlib.sha1(', '.join(_normalized_rules(policy))
+                           .encode('utf-8')).digest()
+        with self._lock:
+            if key in self._policies:
+                self._policies.move_to_end(key)
+            else:
+                self._policies[key] = policy
+                self._results[key] = {}
+                while len(self._policies) > self.max_size:
+                    oldest, _ = self._policies.popitem(last = False)
+                    del self._results[oldest]
+        return key
+
+    def can_exit_to(self, digest, ports):
+        """
+        Check which of C{ports} the policy with digest C{digest} allows
+        exits to.
+
+        @type digest: bytes
+        @param digest: A digest returned by L{digest}.
+        @type ports: iterable of int
+        @param ports: The ports to check.
+
+        @rtype: dict {int: bool}
+        @return: Whether the policy allows exits to each of C{ports}, or
+            C{None} if the policy has been dropped from the cache.
+        """
+        with self._lock:
+            policy = self._policies.get(digest)
+            if policy is None:
+                return None
+            self._policies.move_to_end(digest)
+            results = self._results[digest]
+            answer = {}
+            for port in ports:
+                if port not in results:
+                    results[port] = policy.can_exit_to(port = port)
+                answer[port] = results[port]
+            return answer
+
+    def clear(self):
+        """
+        Drop every cached policy and result.
+        """
+        with self._lock:
+            self._policies.clear()
+            self._results.clear()
+
+
+exit_policy_cache = ExitPolicyCache()
+
+
+class ControllerPool:
+    '''
+    A bounded pool of authenticated Stem controller connections, shared by
+    every L{CtlUil} in the process so that web views and the updater reuse
+    warm connections instead of connecting and authenticating each time.
+
+    Connections are checked when they are acquired and reconnected if Tor
+    has closed them, for instance after Tor was restarted.
+
+    @type _POOL_SIZE: int
+    @cvar _POOL_SIZE: Default maximum number of connections.
+
+    @type _ACQUIRE_TIMEOUT: int
+    @cvar _ACQUIRE_TIMEOUT: Default number of seconds L{acquire} waits for a
+        free connection.
+
+    @type control_host: str
+    @ivar control_host: Control host of the Stem connections.
+
+    @type control_port: int
+    @ivar control_port: Control port of the Stem connections.
+
+    @type authenticator: str
+    @ivar authenticator: Authenticator string of the Stem connections.
+
+    @type max_size: int
+    @ivar max_size: Maximum number of connections, idle or in use.
+    '''
+
+    _POOL_SIZE = 4
+    _ACQUIRE_TIMEOUT = 30
+
+    def __init__(self, control_host, control_port, authenticator,
+                 max_size = _POOL_SIZE):
+        self.control_host = control_host
+        self.control_port = control_port
+        self.authenticator = authenticator
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []
+
+    def _connect(self):
+        '''
+        Open and authenticate a new Stem connection.
+
+        @rtype: stem.control.Controller
+        @return: An authenticated controller.
+        '''
+        try:
+            control = Controller.from_port(address = self.control_host,
+                                           port = self.control_port)
+        except stem.SocketError:
+            errormsg = "Could not connect to Tor control port.\n" + \
+            "Is Tor running on %s with its control port opened on %s?" %\
+            (self.control_host, self.control_port)
+            logging.error(errormsg )
+            raise 
+
+        # Authenticate connection
+        try:
+            control.authenticate(self.authenticator)
+        except (stem.ControllerError,
+                stem.connection.AuthenticationFailure):
+            control.close()
+            logging.error("Could not authenticate to the Tor control port")
+            raise
+        return control
+
+    def _is_healthy(self, control):
+        '''
+        Check that C{control} is still connected and authenticated,
+        reconnecting it if Tor closed the connection. A connection that
+        cannot be reconnected is closed.
+
+        @rtype: bool
+        @return: C{True} if C{control} can be used.
+        '''
+        if control.is_alive() and control.is_authenticated():
+            return True
+        try:
+            control.reconnect(self.authenticator)
+            return True
+        except (stem.ControllerError,
+                stem.connection.AuthenticationFailure):
+            control.close()
+            return False
+
+    def acquire(self, timeout = _ACQUIRE_TIMEOUT):
+        '''
+        Take a connection from the pool, opening a new one if none is idle.
+        Blocks while L{max_size} connections are in use.
+
+        @type timeout: float
+        @param timeout: Seconds to wait for a free connection.
+
+        @rtype: stem.control.Controller
+        @return: An authenticated controller, to be handed back with
+            L{release}.
+        '''
+        if not self._slots.acquire(timeout = timeout):
+            raise stem.ControllerError("No free Tor control connection "
+                                       "after %s seconds" % timeout)
+        try:
+            while True:
+                with self._lock:
+                    control = self._idle.pop() if self._idle else None
+                if control is None:
+                    return self._connect()
+                if self._is_healthy(control):
+                    return control
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, control):
+        '''
+        Hand a connection taken with L{acquire} back to the pool.
+
+        @type control: stem.control.Controller
+        @param control: The controller to release.
+        '''
+        if control.is_alive():
+            with self._lock:
+                self._idle.append(control)
+        else:
+            control.close()
+        self._slots.release()
+
+    def close_all(self):
+        '''
+        Close every idle connection in the pool.
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for control in idle:
+            control.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(control_host, control_port, authenticator):
+    '''
+    Return the process-wide L{ControllerPool} for a control host, port and
+    authenticator, creating it on first use.
+
+    @rtype: L{ControllerPool}
+    @return: The shared pool.
+    '''
+    key = (control_host, control_port, authenticator)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ControllerPool(control_host, control_port,
+                                         authenticator)
+        return _pools[key]
+
 
 class CtlUil:
     '''
@@ -43,13 +382,6 @@ class CtlUil:
     @type _CONTROL_HOST: str
     @cvar _CONTROL_HOST: Constant for the control host of the Stem connection.
 
-    @type _CONTROL_PORT: int
-    @cvar _CONTROL_PORT: Constant for the control port of the Stem connection.
-
-    @type _AUTHENTICATOR: str
-    @cvar _AUTHENTICATOR: Constant for the authenticator string of the Stem
-                          connection.
-
 
     @type control_host: str
     @ivar control_host: Control host of the Stem connection.
@@ -66,55 +398,302 @@ class CtlUil:
     @type control: Stem Connection
     @ivar control: Connection to Stem.
 
+    @type _consensus: dict {str: stem.descriptor.router_status_entry.RouterStatusEntryV3}
+    @ivar _consensus: Snapshot of the current consensus, mapping each relay
+        fingerprint to its router status entry. Loaded in one pass by
+        L{refresh_consensus}, or lazily on the first lookup.
+
+    @type _valid_after: str
+    @ivar _valid_after: The valid-after time of the consensus held in
+        L{_consensus}, or C{None} if no consensus has been loaded yet.
+
+    @type _descriptors: dict {str: L{DescriptorSummary}}
+    @ivar _descriptors: Index of the current server descriptors, mapping
+        each relay fingerprint to the summary of its descriptor. Built in
+        one pass by L{refresh_descriptors}, or lazily on the first lookup.
+
     '''
 
 
     _CONTROL_HOST = '127.0.0.1'
-    _CONTROL_PORT = config.control_port
-    _AUTHENTICATOR = config.authenticator
 
 
 
     def __init__(self, control_host = _CONTROL_HOST,
-                control_port = _CONTROL_PORT, sock = None,
-                authenticator = _AUTHENTICATOR):
+                control_port = None, sock = None,
+                authenticator = None):
 
         '''
-        Initialize the CtlUtil object, connect to Stem.
+        Initialize the CtlUtil object, take a Stem connection from the
+        shared L{ControllerPool}. The control port and authenticator default
+        to the C{TOR_CONTROL_PORT} and C{TOR_AUTHENTICATOR} settings.
         '''
+        if control_port is None:
+            control_port = settings.TOR_CONTROL_PORT
+        if authenticator is None:
+            authenticator = settings.TOR_AUTHENTICATOR
         self.control_host = control_host
         self.control_port = control_port
         self.authenticator = authenticator    
-        try:
-            self.control = Controller.from_port(port = self.control_port)
-        except stem.SocketError:
-            errormsg = "Could not connect to Tor control port.\n" + \
-            "Is Tor running on %s with its control port opened on %s?" %\
-            (control_host, control_port)
-            logging.error(errormsg )
-            raise 
+        self._pool = get_pool(control_host, control_port, authenticator)
+        self.control = self._pool.acquire()
 
+        self._consensus = None
+        self._valid_after = None
+        self._descriptors = None
+        self._recommended = None
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        # Authenticate connection
-        self.control.authenticate(config.authenticator)
+    def close(self):
+        '''
+        Return the Stem connection to the pool. The CtlUtil object can't
+        talk to Tor after this, but its snapshots remain readable.
+        '''
+
+        control = getattr(self, 'control', None)
+        if control is not None:
+            self.control = None
+            self._pool.release(control)
+
+    def reconnect(self):
+        '''
+        Return the Stem connection to the pool and take another one, for
+        instance after Tor was restarted and closed the old one. The
+        snapshots are kept.
+        '''
+
+        self.close()
+        self.control = self._pool.acquire()
 
     def __del__(self) :
         '''
-        Closes the connection when the CtlUtil object is garbage collected.
-        (From original Tor Weather)
+        Releases the connection when the CtlUtil object is garbage
+        collected, in case L{close} was not called.
+        '''
+
+        self.close()
+
+    def refresh_consensus(self):
         '''
+        Load the full consensus into the fingerprint-keyed snapshot used by
+        L{is_up} and L{is_stable}, replacing the previous snapshot. The whole
+        consensus is fetched with a single request rather than one request
+        per router. Nothing is fetched if Tor's consensus still has the same
+        valid-after time as the snapshot already held.
 
-        self.control.close()
+        If the consensus cannot be fetched or lists no routers, the previous
+        snapshot is kept, and if there is none the next lookup tries again.
+
+        @rtype: bool
+        @return: C{True} if a new consensus was loaded, C{False} if the
+            snapshot was already current or could not be loaded.
+        '''
+
+        valid_after = self._get_valid_after()
+        if valid_after is not None and self._consensus is not None and \
+           valid_after == self._valid_after:
+            return False
+
+        consensus = {}
+        try:
+            for entry in self._get_network_statuses():
+                consensus[entry.fingerprint] = entry
+        except stem.ControllerError:
+            errormsg = "Unable to get the current consensus"
+            logging.error(errormsg)
+            return False
+        if not consensus:
+            logging.error("The current consensus lists no routers")
+            return False
+
+        self._consensus = consensus
+        self._valid_after = valid_after
+        self._recommended = None
+        return True
+
+    def _get_valid_after(self):
+        '''
+        Ask Tor for the valid-after time of its current consensus.
+
+        @rtype: str
+        @return: The valid-after time, or C{None} if Tor could not say.
+        '''
+
+        try:
+            return self.control.get_info('consensus/valid-after')
+        except stem.ControllerError:
+            return None
+
+    def _get_recommended_versions(self):
+        '''
+        Ask Tor for the server versions recommended by the current
+        consensus.
+
+        @rtype: str
+        @return: The comma separated list of recommended versions, or
+            C{None} if Tor could not say.
+        '''
+
+        try:
+            return self.control.get_info('status/version/recommended')
+        except stem.ControllerError:
+            return None
+
+    def _get_network_statuses(self):
+        '''
+        Iterate over the router status entries of the current consensus.
+        Stem parses the entries one at a time as they are iterated.
+
+        @rtype: iterator
+        @return: L{stem.descriptor.router_status_entry.RouterStatusEntryV3}
+            objects for every router in the consensus.
+        '''
+
+        return self.control.get_network_statuses()
+
+    def get_consensus(self):
+        '''
+        Return the consensus snapshot, loading it first if necessary.
+
+        @rtype: dict {str: RouterStatusEntryV3}
+        @return: The router status entries of the current consensus keyed
+            by fingerprint, or an empty dict if no consensus could be
+            loaded.
+        '''
+
+        if self._consensus is None:
+            self.refresh_consensus()
+        if self._consensus is None:
+            return {}
+        return self._consensus
+
+    def get_valid_after(self):
+        '''
+        @rtype: datetime
+        @return: The valid-after time of the consensus snapshot, in UTC, or
+            C{None} if it is not known.
+        '''
+
+        self.get_consensus()
+        if self._valid_after is None:
+            return None
+        try:
+            return datetime.strptime(self._valid_after, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return None
+
+    def get_single_consensus(self, fingerprint):
+        '''
+        Look up the consensus entry for the router with fingerprint
+        C{fingerprint} in the consensus snapshot.
+
+        @type fingerprint: str
+        @param fingerprint: Fingerprint of the node in question.
+
+        @rtype: RouterStatusEntryV3
+        @return: The router status entry, or C{None} if the router is not
+            in the current consensus.
+        '''
+
+        return self.get_consensus().get(_normalize_fingerprint(fingerprint))
+
+    def _get_info_batched(self, prefix, fingerprints):
+        '''
+        Send GETINFO C{prefix}<fingerprint> for many fingerprints, with up
+        to L{_GETINFO_BATCH_SIZE} keys per command. Tor rejects a whole
+        command if any one key fails, so a failed batch is split in half
+        and retried until the failing fingerprints are isolated and
+        dropped.
+
+        @type prefix: str
+        @param prefix: The GETINFO key prefix, such as C{'ns/id/'}.
+        @type fingerprints: iterable of str
+        @param fingerprints: The fingerprints to query.
+
+        @rtype: dict {str: bytes}
+        @return: The non-empty answers keyed by normalized fingerprint.
+        '''
+
+        fingerprints = sorted(set(_normalize_fingerprint(fingerprint)
+                                  for fingerprint in fingerprints))
+        results = {}
+        pending = [fingerprints[i:i + _GETINFO_BATCH_SIZE] for i in
+                   range(0, len(fingerprints), _GETINFO_BATCH_SIZE)]
+        while pending:
+            batch = pending.pop()
+            try:
+                answers = self.control.get_info(
+                    [prefix + fingerprint for fingerprint in batch],
+                    get_bytes = True)
+            except stem.ControllerError:
+                if len(batch) > 1:
+                    half = len(batch) // 2
+                    pending.extend([batch[:half], batch[half:]])
+                else:
+                    errormsg = "Unable to get %s%s" % (prefix, batch[0])
+                    logging.error(errormsg)
+                continue
+            for fingerprint in batch:
+                content = answers.get(prefix + fingerprint)
+                if content:
+                    results[fingerprint] = content
+        return results
+
+    def status_for(self, fingerprints):
+        '''
+        Fetch the consensus entries of the routers with the given
+        fingerprints from Tor, with one GETINFO command per batch of
+        fingerprints rather than one per router. This is cheaper than
+        L{refresh_consensus} when only a few thousand routers matter.
+
+        @type fingerprints: iterable of str
+        @param fingerprints: Fingerprints of the nodes in question.
+
+        @rtype: dict {str: RouterStatusEntryV3}
+        @return: Router status entries keyed by fingerprint. Routers that
+            are not in the consensus are left out.
+        '''
+
+        entries = {}
+        answers = self._get_info_batched('ns/id/', fingerprints)
+        for fingerprint, content in answers.items():
+            entries[fingerprint] = \
+                stem.descriptor.router_status_entry.RouterStatusEntryV3(content)
+        return entries
+
+    def descriptors_for(self, fingerprints):
+        '''
+        Fetch the server descriptors of the relays with the given
+        fingerprints from Tor, with one GETINFO command per batch of
+        fingerprints rather than one per relay.
+
+        @type fingerprints: iterable of str
+        @param fingerprints: Fingerprints of the nodes in question.
+
+        @rtype: dict {str: L{DescriptorSummary}}
+        @return: Descriptor summaries keyed by fingerprint. Relays Tor has
+            no descriptor for are left out.
+        '''
+
+        summaries = {}
+        answers = self._get_info_batched('desc/id/', fingerprints)
+        for fingerprint, content in answers.items():
+            desc = stem.descriptor.server_descriptor.RelayDescriptor(content)
+            summaries[fingerprint] = self._summarize(desc)
+        return summaries
 
     def is_up(self, fingerprint):
         '''
         Check if this node is up (actively running) 
-        by requesting a consensus document for node C{fingerprint}. 
+        by looking node C{fingerprint} up in the consensus snapshot. 
      
-        If a document is received successfully, then the node is up; 
-        if a document is not received, then the router is down.
+        If the node is in the consensus, then the node is up; 
+        if it is not, then the router is down.
         If a node is hiberanating, it will return C{False}.
 
 
@@ -126,30 +705,241 @@ class CtlUil:
         
         '''
 
-        # try:
-        #     self.control.get_network_status(fingerprint)
-        #     return True
-        # except:
-        #     return False
+        return self.get_single_consensus(fingerprint) is not None
 
-        cons = self.get_single_consensus(fingerprint)
-        if cons == '':
-            return False
-        else:
-            return True
 
 
+    def refresh_descriptors(self):
+        '''
+        Rebuild the descriptor index used by L{is_exit} and
+        L{is_hibernating}. All server descriptors are fetched with a single
+        request and streamed through one at a time, so each descriptor is
+        parsed once per refresh and only its L{DescriptorSummary} is kept.
 
-    def is_exit(self, fingerprint):
+        If the descriptors cannot be fetched or there are none, the previous
+        index is kept, and if there is none the next lookup tries again.
+
+        @rtype: bool
+        @return: C{True} if the index changed, C{False} if it did not or
+            the descriptors could not be fetched.
+        '''
+
+        descriptors = {}
+        published = {}
         try:
-            desc = self.control.get_server_descriptor(fingerprint)
-            return desc.exit_policy.can_exit_to(port = 80)
+            for desc in self._get_server_descriptors():
+                # Keep the newest descriptor if a relay has several.
+                newest = published.get(desc.fingerprint)
+                if newest and desc.published and newest >= desc.published:
+                    continue
+                published[desc.fingerprint] = desc.published
+                descriptors[desc.fingerprint] = self._summarize(desc)
         except stem.ControllerError:
+            errormsg = "Unable to get the current server descriptors"
+            logging.error(errormsg)
+            return False
+        if not descriptors:
+            logging.error("Tor has no server descriptors")
+            return False
+        if descriptors == self._descriptors:
+            return False
+
+        self._descriptors = descriptors
+        return True
+
+    def _get_server_descriptors(self):
+        '''
+        Iterate over all of the server descriptors Tor currently has.
+        Stem parses the descriptors one at a time as they are iterated.
+
+        @rtype: iterator
+        @return: L{stem.descriptor.server_descriptor.RelayDescriptor}
+            objects for every relay Tor has a descriptor for.
+        '''
+
+        return self.control.get_server_descriptors()
+
+    def _summarize(self, desc):
+        '''
+        Reduce a parsed server descriptor to the fields Weather uses.
+
+        @type desc: stem.descriptor.server_descriptor.RelayDescriptor
+        @param desc: A parsed server descriptor.
+
+        @rtype: L{DescriptorSummary}
+        @return: The summary of C{desc}.
+        '''
+
+        digest = exit_policy_cache.digest(desc.exit_policy)
+        return DescriptorSummary(
+            observed_bandwidth = desc.observed_bandwidth or 0,
+            hibernating = bool(desc.hibernating),
+            platform = _decode(desc.platform),
+            version = desc.tor_version,
+            contact = _decode(desc.contact),
+            exit = exit_policy_cache.can_exit_to(digest, [80])[80],
+            policy_digest = digest)
+
+    def get_descriptors(self):
+        '''
+        Return the descriptor index, building it first if necessary.
+
+        @rtype: dict {str: L{DescriptorSummary}}
+        @return: Descriptor summaries keyed by fingerprint, or an empty dict
+            if no descriptors could be loaded.
+        '''
+
+        if self._descriptors is None:
+            self.refresh_descriptors()
+        if self._descriptors is None:
+            return {}
+        return self._descriptors
+
+    def get_single_descriptor(self, fingerprint):
+        '''
+        Look up the descriptor summary for the relay with fingerprint
+        C{fingerprint} in the descriptor index.
+
+        @type fingerprint: str
+        @param fingerprint: Fingerprint of the node in question.
+
+        @rtype: L{DescriptorSummary}
+        @return: The descriptor summary, or C{None} if Tor has no
+            descriptor for the relay.
+        '''
+
+        return self.get_descriptors().get(_normalize_fingerprint(fingerprint))
+
+    def is_exit(self, fingerprint):
+        '''
+        Check if the Tor relay with fingerprint C{fingerprint} allows exits
+        to port 80.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the Tor relay to check.
+
+        @rtype: bool
+        @return: True if the relay's descriptor has an exit policy that
+        accepts port 80, False otherwise.
+        '''
+
+        desc = self.get_single_descriptor(fingerprint)
+        if desc is None:
             errormsg = "Unable to get server descriptor for '%s'" % (fingerprint)
             logging.error(errormsg )
             return False
+        return desc.exit
+
+    def can_exit_to(self, fingerprint, ports):
+        '''
+        Check which of C{ports} the Tor relay with fingerprint
+        C{fingerprint} allows exits to.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the Tor relay to check.
+
+        @type ports: iterable of int
+        @param ports: The ports to check.
+
+        @rtype: dict {int: bool}
+        @return: Whether the relay allows exits to each of C{ports}. Every
+        port maps to False if the relay has no descriptor.
+        '''
+
+        desc = self.get_single_descriptor(fingerprint)
+        if desc is None:
+            return dict((port, False) for port in ports)
+        answer = exit_policy_cache.can_exit_to(desc.policy_digest, ports)
+        if answer is None:
+            # The policy was dropped from the cache since this index was
+            # built; a fresh index adds the relay's current policy back.
+            self.refresh_descriptors()
+            desc = self.get_single_descriptor(fingerprint)
+            if desc is not None:
+                answer = exit_policy_cache.can_exit_to(desc.policy_digest,
+                                                       ports)
+            if answer is None:
+                return dict((port, False) for port in ports)
+        return answer
         
 
+    def get_bandwidth(self, fingerprint):
+        '''
+        Get the observed bandwidth of the Tor relay with fingerprint
+        C{fingerprint} from its descriptor.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the Tor relay to check.
+
+        @rtype: int
+        @return: The observed bandwidth in kB/s, or 0 if the relay has no
+        descriptor.
+        '''
+
+        desc = self.get_single_descriptor(fingerprint)
+        if desc is None:
+            return 0
+        return desc.observed_bandwidth // 1000
+
+    def get_recommended_versions(self):
+        '''
+        Get the Tor versions recommended for relays by the current
+        consensus.
+
+        @rtype: list [stem.version.Version]
+        @return: The recommended versions, oldest first.
+        '''
+
+        if self._recommended is None:
+            versions = self._get_recommended_versions() or ''
+            self._recommended = sorted(stem.version.Version(version)
+                                       for version in versions.split(',')
+                                       if version)
+        return self._recommended
+
+    def get_version_type(self, fingerprint):
+        '''
+        Classify the Tor version the relay with fingerprint C{fingerprint}
+        runs against the recommended versions.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the Tor relay to check.
+
+        @rtype: str
+        @return: C{'RECOMMENDED'} if it runs the newest stable recommended
+        version, C{'UNRECOMMENDED'} if it runs another recommended version,
+        C{'OBSOLETE'} if its version is not recommended at all, and
+        C{'ERROR'} if its version is unknown.
+        '''
+
+        desc = self.get_single_descriptor(fingerprint)
+        if desc is None or desc.version is None:
+            return 'ERROR'
+        return self.classify_version(desc.version)
+
+    def classify_version(self, version):
+        '''
+        Classify C{version} as described in L{get_version_type}. Callers
+        checking many relays classify each distinct version once.
+
+        @type version: stem.version.Version
+        @param version: A Tor version.
+
+        @rtype: str
+        @return: C{'RECOMMENDED'}, C{'UNRECOMMENDED'}, C{'OBSOLETE'} or
+        C{'ERROR'}.
+        '''
+
+        recommended = self.get_recommended_versions()
+        if not recommended:
+            return 'ERROR'
+        stable = [rec for rec in recommended if not rec.status] or recommended
+        if version == stable[-1]:
+            return 'RECOMMENDED'
+        if version in recommended:
+            return 'UNRECOMMENDED'
+        return 'OBSOLETE'
+
     def is_stable(self, fingerprint):
         '''
         Check if a Tor node has the stable flag.
@@ -162,13 +952,10 @@ class CtlUil:
         flag, false otherwise.
         '''
 
-        try:
-            desc = self.control.get_network_status(fingerprint)
-            return Flag.Stable in desc.flags
-        except stem.ControllerError:
-            errormsg = "Unable to get router status entry for '%s'" % (fingerprint)
-            logging.error(errormsg)
+        entry = self.get_single_consensus(fingerprint)
+        if entry is None:
             return False
+        return Flag.Stable in entry.flags
 
 
     def is_hibernating(self, fingerprint):
@@ -182,10 +969,160 @@ class CtlUil:
         @return: True if the Tor relay has a current descriptor file with
         the hibernating flag, False otherwise."""
 
-        try:
-            desc = self.control.get_server_descriptor(fingerprint)
-            return desc.hibernating
-        except stem.ControllerError:
+        desc = self.get_single_descriptor(fingerprint)
+        if desc is None:
             return False
-    
-    pass
\ No newline at end of file
+        return desc.hibernating
+
+
+class _MappedFile(mmap.mmap):
+    '''
+    A read-only memory map with the C{readlines} method Stem's consensus
+    parser expects of a file.
+    '''
+
+    def readlines(self):
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            line = self.readline()
+        return lines
+
+
+def _parse_cached_file(path, descriptor_type, **kwargs):
+    '''
+    Stream-parse the descriptors in one of Tor's cached files. The file is
+    memory-mapped and Stem reads one descriptor at a time from the map, so
+    memory use does not grow with the size of the file.
+
+    @type path: str
+    @param path: Path of the cached file. Missing, unreadable or empty
+        files yield nothing.
+    @type descriptor_type: str
+    @param descriptor_type: Stem descriptor type annotation of the file.
+
+    @rtype: iterator
+    @return: The parsed descriptors.
+    '''
+    try:
+        cached_file = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    except OSError as exc:
+        logging.error("Could not read %s: %s", path, exc)
+        return
+    with cached_file:
+        if os.fstat(cached_file.fileno()).st_size == 0:
+            return
+        with _MappedFile(cached_file.fileno(), 0,
+                         access = mmap.ACCESS_READ) as data:
+            for desc in stem.descriptor.parse_file(data, descriptor_type,
+                                                   **kwargs):
+                yield desc
+
+
+class CachedDataCtlUil(CtlUil):
+    '''
+    A L{CtlUil} that reads the consensus and server descriptors from the
+    cached files in a Tor DataDirectory instead of asking a running Tor
+    process. It answers L{is_up}, L{is_exit}, L{is_stable} and
+    L{is_hibernating} the same way, which lets the updater run without a
+    control connection, and tests and benchmarks run without Tor.
+
+    @type _CONSENSUS_FILE: str
+    @cvar _CONSENSUS_FILE: Name of the cached consensus file.
+
+    @type _DESCRIPTOR_FILES: list [str]
+    @cvar _DESCRIPTOR_FILES: Names of the cached server descriptor files,
+        oldest first.
+
+    @type data_directory: str
+    @ivar data_directory: The Tor DataDirectory the files are read from.
+    '''
+
+    _CONSENSUS_FILE = 'cached-consensus'
+    _DESCRIPTOR_FILES = ['cached-descriptors', 'cached-descriptors.new']
+
+    def __init__(self, data_directory):
+        '''
+        Initialize the CachedDataCtlUil object. No connection is made.
+        '''
+        self.data_directory = data_directory
+        self.control = None
+
+        self._consensus = None
+        self._valid_after = None
+        self._descriptors = None
+        self._recommended = None
+
+    def close(self):
+        '''
+        There is no Stem connection to release.
+        '''
+
+    def _read_header(self, keyword):
+        '''
+        Read a field from the header of the cached consensus.
+
+        @type keyword: bytes
+        @param keyword: The header keyword, such as C{b'valid-after'}.
+
+        @rtype: str
+        @return: The field's value, or C{None} if the field or the cached
+            consensus is missing.
+        '''
+        path = os.path.join(self.data_directory, self._CONSENSUS_FILE)
+        try:
+            with open(path, 'rb') as cached_file:
+                for line in cached_file:
+                    if line.startswith(keyword + b' '):
+                        return line[len(keyword) + 1:].strip().decode()
+                    if line.startswith(b'r '):
+                        break
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _get_valid_after(self):
+        return self._read_header(b'valid-after')
+
+    def _get_recommended_versions(self):
+        return self._read_header(b'server-versions')
+
+    def _get_network_statuses(self):
+        path = os.path.join(self.data_directory, self._CONSENSUS_FILE)
+        return _parse_cached_file(path, 'network-status-consensus-3 1.0',
+            document_handler = stem.descriptor.DocumentHandler.ENTRIES)
+
+    def _get_server_descriptors(self):
+        for name in self._DESCRIPTOR_FILES:
+            path = os.path.join(self.data_directory, name)
+            for desc in _parse_cached_file(path, 'server-descriptor 1.0'):
+                yield desc
+
+    def status_for(self, fingerprints):
+        '''
+        Look the given fingerprints up in the cached consensus.
+
+        @rtype: dict {str: RouterStatusEntryV3}
+        @return: Router status entries keyed by fingerprint.
+        '''
+        consensus = self.get_consensus()
+        fingerprints = set(_normalize_fingerprint(fingerprint)
+                           for fingerprint in fingerprints)
+        return dict((fingerprint, consensus[fingerprint]) for fingerprint
+                    in fingerprints if fingerprint in consensus)
+
+    def descriptors_for(self, fingerprints):
+        '''
+        Look the given fingerprints up in the cached descriptors.
+
+        @rtype: dict {str: L{DescriptorSummary}}
+        @return: Descriptor summaries keyed by fingerprint.
+        '''
+        descriptors = self.get_descriptors()
+        fingerprints = set(_normalize_fingerprint(fingerprint)
+                           for fingerprint in fingerprints)
+        return dict((fingerprint, descriptors[fingerprint]) for fingerprint
+                    in fingerprints if fingerprint in descriptors)
@@ -0,0 +1,182 @@
+"""
+The diff module compares two views of the Tor network and reports only what
+changed between them, so the updaters can skip the routers that did not.
+
+A view of the network is a dict mapping fingerprints to L{RouterState}
+tuples, built from a L{CtlUil} by L{network_state}. L{diff_states} compares
+two views and returns a list of L{RouterChange} records.
+
+@type APPEARED: str
+@var APPEARED: Change kind for a router that joined the consensus.
+@type DISAPPEARED: str
+@var DISAPPEARED: Change kind for a router that left the consensus.
+@type FLAGS_CHANGED: str
+@var FLAGS_CHANGED: Change kind for a router whose consensus flags changed.
+@type NAME_CHANGED: str
+@var NAME_CHANGED: Change kind for a router whose nickname changed.
+@type BANDWIDTH_CHANGED: str
+@var BANDWIDTH_CHANGED: Change kind for a router whose observed bandwidth
+    changed.
+@type EXIT_CHANGED: str
+@var EXIT_CHANGED: Change kind for a router that started or stopped
+    allowing exits to port 80.
+@type VERSION_CHANGED: str
+@var VERSION_CHANGED: Change kind for a router whose Tor version changed.
+@type HIBERNATION_CHANGED: str
+@var HIBERNATION_CHANGED: Change kind for a router that started or stopped
+    hibernating.
+"""
+import collections
+
+APPEARED = 'appeared'
+DISAPPEARED = 'disappeared'
+FLAGS_CHANGED = 'flags_changed'
+NAME_CHANGED = 'name_changed'
+BANDWIDTH_CHANGED = 'bandwidth_changed'
+EXIT_CHANGED = 'exit_changed'
+VERSION_CHANGED = 'version_changed'
+HIBERNATION_CHANGED = 'hibernation_changed'
+
+RouterState = collections.namedtuple('RouterState',
+    ['name', 'flags', 'bandwidth', 'exit', 'version',
+                     'hibernating'])
+RouterState.__doc__ = '''
+What Weather knows about one router in one consensus.
+
+@type name: str
+@ivar name: The router's nickname.
+@type flags: frozenset
+@ivar flags: The router's consensus flags.
+@type bandwidth: int
+@ivar bandwidth: Observed bandwidth from the router's descriptor, or
+    C{None} if there is no descriptor.
+@type exit: bool
+@ivar exit: Whether the router allows exits to port 80.
+@type version: stem.version.Version
+@ivar version: The Tor version from the router's descriptor, or C{None}.
+@type hibernating: bool
+@ivar hibernating: Whether the router's descriptor says it is hibernating.
+'''
+
+RouterChange = collections.namedtuple('RouterChange',
+    ['kind', 'fingerprint', 'old', 'new'])
+RouterChange.__doc__ = '''
+One change to one router between two views of the network.
+
+@type kind: str
+@ivar kind: One of the change kinds defined in this module.
+@type fingerprint: str
+@ivar fingerprint: The fingerprint of the router that changed.
+@ivar old: The previous value (the previous L{RouterState} for
+    L{APPEARED}/L{DISAPPEARED}), or C{None}.
+@ivar new: The new value (the new L{RouterState} for
+    L{APPEARED}/L{DISAPPEARED}), or C{None}.
+'''
+
+
+def network_state(ctl_util):
+    """
+    Build a view of the network from the consensus snapshot and descriptor
+    index held by C{ctl_util}.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem.
+
+    @rtype: dict {str: L{RouterState}}
+    @return: The state of every router in the consensus, keyed by
+        fingerprint.
+    """
+
+    descriptors = ctl_util.get_descriptors()
+    state = {}
+    for fingerprint, entry in ctl_util.get_consensus().items():
+        desc = descriptors.get(fingerprint)
+        if desc is None:
+            state[fingerprint] = RouterState(entry.nickname,
+                frozenset(entry.flags), None, False, None, False)
+        else:
+            state[fingerprint] = RouterState(entry.nickname,
+                frozenset(entry.flags), desc.observed_bandwidth, desc.exit,
+                desc.version, desc.hibernating)
+    return state
+
+
+def diff_states(old, new):
+    """
+    Compare two views of the network.
+
+    A router that appears or disappears gets a single L{APPEARED} or
+    L{DISAPPEARED} record. A router present in both views gets one record
+    for each field that changed, and none if nothing did.
+
+    @type old: dict {str: L{RouterState}}
+    @param old: The previous view of the network.
+    @type new: dict {str: L{RouterState}}
+    @param new: The current view of the network.
+
+    @rtype: list [L{RouterChange}]
+    @return: The changes from C{old} to C{new}.
+    """
+
+    changes = []
+    for fingerprint, state in new.items():
+        before = old.get(fingerprint)
+        if before is None:
+            changes.append(RouterChange(APPEARED, fingerprint, None, state))
+            continue
+        if before == state:
+            continue
+        if before.flags != state.flags:
+            changes.append(RouterChange(FLAGS_CHANGED, fingerprint,
+                                        before.flags, state.flags))
+        if before.name != state.name:
+            changes.append(RouterChange(NAME_CHANGED, fingerprint,
+                                        before.name, state.name))
+        if before.bandwidth != state.bandwidth:
+            changes.append(RouterChange(BANDWIDTH_CHANGED, fingerprint,
+                                        before.bandwidth, state.bandwidth))
+        if before.exit != state.exit:
+            changes.append(RouterChange(EXIT_CHANGED, fingerprint,
+                                        before.exit, state.exit))
+        if before.version != state.version:
+            changes.append(RouterChange(VERSION_CHANGED, fingerprint,
+                                        before.version, state.version))
+        if before.hibernating != state.hibernating:
+            changes.append(RouterChange(HIBERNATION_CHANGED, fingerprint,
+                                        before.hibernating,
+                                        state.hibernating))
+
+    for fingerprint, state in old.items():
+        if fingerprint not in new:
+            changes.append(RouterChange(DISAPPEARED, fingerprint, state, None))
+    return changes
+
+
+def changed_fingerprints(changes):
+    """
+    Return the set of routers that C{changes} touch.
+
+    @type changes: list [L{RouterChange}]
+    @param changes: Change records from L{diff_states}.
+
+    @rtype: set
+    @return: The fingerprints of the changed routers.
+    """
+    return set(change.fingerprint for change in changes)
+
+
+def fingerprints_with(changes, kinds):
+    """
+    Return the set of routers that have a change of one of C{kinds}.
+
+    @type changes: list [L{RouterChange}]
+    @param changes: Change records from L{diff_states}.
+    @type kinds: iterable of str
+    @param kinds: The change kinds of interest.
+
+    @rtype: set
+    @return: The fingerprints of the matching routers.
+    """
+    kinds = set(kinds)
+    return set(change.fingerprint for change in changes
+               if change.kind in kinds)
@@ -18,6 +18,33 @@ Emails are sent after all database checks/updates.
     The email contains a link to the user-specific confirmation
     page, which the user must follow to confirm.
 
+@type _NODE_DOWN_SUBJ: str
+@var _NODE_DOWN_SUBJ: The subject line for node down notifications.
+@type _NODE_DOWN_MAIL: str
+@var _NODE_DOWN_MAIL: The email message sent when a router has been down
+    for longer than the subscriber's grace period.
+@type _NODE_DOWN_UPTIME: str
+@var _NODE_DOWN_UPTIME: The router's recent uptime, added to a node down
+    email when the presence history has any.
+@type _VERSION_SUBJ: str
+@var _VERSION_SUBJ: The subject line for version notifications.
+@type _VERSION_MAIL: str
+@var _VERSION_MAIL: The email message sent when a router runs a version of
+    Tor the subscriber should upgrade from.
+@type _LOW_BANDWIDTH_SUBJ: str
+@var _LOW_BANDWIDTH_SUBJ: The subject line for low bandwidth notifications.
+@type _LOW_BANDWIDTH_MAIL: str
+@var _LOW_BANDWIDTH_MAIL: The email message sent when a router's observed
+    bandwidth is below the subscriber's threshold.
+@type _T_SHIRT_SUBJ: str
+@var _T_SHIRT_SUBJ: The subject line for T-shirt notifications.
+@type _T_SHIRT_MAIL: str
+@var _T_SHIRT_MAIL: The email message sent when a router has earned its
+    operator a T-shirt.
+@type _GENERIC_FOOTER: str
+@var _GENERIC_FOOTER: The footer of every notification, with links to the
+    unsubscribe and preferences pages.
+
 """
 import re
 
@@ -39,6 +66,40 @@ _CONFIRMATION_MAIL = "Dear human,\n\n" +\
     "Reports, you don't need to do anything. You shouldn't hear from us "+\
     "again."
 
+_NODE_DOWN_SUBJ = 'Node Down!'
+_NODE_DOWN_MAIL = "This is a Tor Weather Report.\n\n" +\
+    "It appears that the node %s you've been observing has been " +\
+    "unreachable for over %d hour(s). You may wish to look at it to see " +\
+    "why."
+_NODE_DOWN_UPTIME = "\n\nOver the last %d days, the node was up %d%% " +\
+    "of the time, and its longest outage lasted %d hour(s)."
+
+_VERSION_SUBJ = 'Version Warning'
+_VERSION_MAIL = "This is a Tor Weather Report.\n\n" +\
+    "It appears that the Tor node %s you've been observing is running " +\
+    "an %s version of Tor. You can download the latest version of Tor at " +\
+    "https://www.torproject.org/download/."
+
+_LOW_BANDWIDTH_SUBJ = 'Low Bandwidth!'
+_LOW_BANDWIDTH_MAIL = "This is a Tor Weather Report.\n\n" +\
+    "It appears that the Tor node %s you've been observing has an " +\
+    "observed bandwidth capacity of %s kB/s. You elected to receive " +\
+    "notifications if this node's bandwidth capacity passed a threshold " +\
+    "of %s kB/s. You may wish to look at your router to see why."
+
+_T_SHIRT_SUBJ = 'Congratulations! Have a T-shirt!'
+_T_SHIRT_MAIL = "This is a Tor Weather Report.\n\n" +\
+    "Congratulations! The node %s you've been observing has been %s for " +\
+    "%s days with an average bandwidth of %s kB/s, which makes the " +\
+    "operator eligible to receive an official Tor T-shirt! If you're " +\
+    "interested in claiming your shirt, please visit the following link " +\
+    "for more information.\n\n" +\
+    "https://www.torproject.org/getinvolved/tshirt.html"
+
+_GENERIC_FOOTER = "\n\nYou can unsubscribe from these reports at any " +\
+    "time by visiting the following url:\n\n%s\n\nor change your Tor " +\
+    "Weather notification preferences here:\n\n%s"
+
 def _get_router_name(fingerprint, name):
     """
     Returns a string representation of the name and fingerprint of
@@ -84,3 +145,116 @@ def send_confirmation(recipient, fingerprint, name, confirm_auth):
     sender = _SENDER
     subj = _SUBJECT_HEADER + _CONFIRMATION_SUBJ
     send_mail(subj, msg, sender, [recipient], fail_silently=True)
+
+def _get_generic_footer(unsubs_auth, pref_auth):
+    """
+    Returns the footer of a notification email, with the subscriber's
+    unsubscribe and preferences links filled in.
+
+    @type unsubs_auth: str
+    @param unsubs_auth: The user's unique unsubscribe authorization key.
+
+    @type pref_auth: str
+    @param pref_auth: The user's unique preferences authorization key.
+    """
+    unsubURL = url_helper.get_unsubscribe_url(unsubs_auth)
+    prefURL = url_helper.get_preferences_url(pref_auth)
+    return _GENERIC_FOOTER % (unsubURL, prefURL)
+
+def node_down_tuple(recipient, fingerprint, name, grace_pd, unsubs_auth,
+                    pref_auth, stats = None, days = None):
+    """
+    Returns the tuple for a node down email, for use with Django's
+    send_mass_mail().
+
+    @type recipient: str
+    @param recipient: The user's email address
+
+    @type fingerprint: str
+    @param fingerprint: The fingerprint of the node that is down.
+
+    @type grace_pd: int
+    @param grace_pd: The grace period in hours.
+
+    @type stats: dict {str: various}
+    @param stats: The node's presence statistics over the last C{days}
+        days, from L{PresenceHistory.stats}, if known.
+
+    @rtype: tuple
+    @return: (subject, message, sender, [recipient])
+    """
+    router = _get_router_name(fingerprint, name)
+    subj = _SUBJECT_HEADER + _NODE_DOWN_SUBJ
+    msg = _NODE_DOWN_MAIL % (router, grace_pd)
+    if stats and stats['present_in']:
+        msg += _NODE_DOWN_UPTIME % (days, round(stats['uptime'] * 100),
+                                    stats['longest_outage'])
+    msg += _get_generic_footer(unsubs_auth, pref_auth)
+    return (subj, msg, _SENDER, [recipient])
+
+def version_tuple(recipient, fingerprint, name, version_type, unsubs_auth,
+                  pref_auth):
+    """
+    Returns the tuple for a version email, for use with Django's
+    send_mass_mail().
+
+    @type version_type: str
+    @param version_type: Either 'UNRECOMMENDED' or 'OBSOLETE'.
+
+    @rtype: tuple
+    @return: (subject, message, sender, [recipient])
+    """
+    router = _get_router_name(fingerprint, name)
+    subj = _SUBJECT_HEADER + _VERSION_SUBJ
+    msg = _VERSION_MAIL % (router, version_type.lower()) + \
+          _get_generic_footer(unsubs_auth, pref_auth)
+    return (subj, msg, _SENDER, [recipient])
+
+def low_bandwidth_tuple(recipient, fingerprint, name, bandwidth, threshold,
+                        unsubs_auth, pref_auth):
+    """
+    Returns the tuple for a low bandwidth email, for use with Django's
+    send_mass_mail().
+
+    @type bandwidth: int
+    @param bandwidth: The router's observed bandwidth in kB/s.
+
+    @type threshold: int
+    @param threshold: The subscriber's threshold in kB/s.
+
+    @rtype: tuple
+    @return: (subject, message, sender, [recipient])
+    """
+    router = _get_router_name(fingerprint, name)
+    subj = _SUBJECT_HEADER + _LOW_BANDWIDTH_SUBJ
+    msg = _LOW_BANDWIDTH_MAIL % (router, bandwidth, threshold) + \
+          _get_generic_footer(unsubs_auth, pref_auth)
+    return (subj, msg, _SENDER, [recipient])
+
+def t_shirt_tuple(recipient, fingerprint, name, avg_bandwidth, hours_up,
+                  exit, unsubs_auth, pref_auth):
+    """
+    Returns the tuple for a T-shirt email, for use with Django's
+    send_mass_mail().
+
+    @type avg_bandwidth: int
+    @param avg_bandwidth: The router's average bandwidth in kB/s.
+
+    @type hours_up: int
+    @param hours_up: Hours the router has been up.
+
+    @type exit: bool
+    @param exit: Whether the router allows exits to port 80.
+
+    @rtype: tuple
+    @return: (subject, message, sender, [recipient])
+    """
+    router = _get_router_name(fingerprint, name)
+    if exit:
+        stats = 'running as an exit node'
+    else:
+        stats = 'running'
+    subj = _SUBJECT_HEADER + _T_SHIRT_SUBJ
+    msg = _T_SHIRT_MAIL % (router, stats, int(hours_up / 24), avg_bandwidth) + \
+          _get_generic_footer(unsubs_auth, pref_auth)
+    return (subj, msg, _SENDER, [recipient])
@@ -0,0 +1,262 @@
+"""
+The fanout module keeps an in-memory index from router fingerprints to the
+confirmed subscriptions on each router, so an update cycle can find the
+subscriptions on the routers that changed without reading every
+subscription.
+
+Subscribers confirm and unsubscribe in the web server, not in the process
+that runs the updaters. The model signal handlers here (see
+L{connect_signals}) therefore record each change as a
+L{SubscriptionChange} row, in whichever process makes it. The updaters
+build the index from the database once, and at the start of each later run
+apply only the changes recorded since (see L{SubscriptionIndex.update}).
+Changes made with C{QuerySet.update} or C{bulk_create}, which send no
+signals, are only picked up by a full L{SubscriptionIndex.build}.
+
+Change rows are read in id order. On SQLite, which serializes writes, ids
+are assigned in commit order, so no change is skipped.
+
+@type SUBSCRIPTION_TYPES: list [tuple (str, class)]
+@var SUBSCRIPTION_TYPES: The name of each subscription type, with its
+    L{Subscription} subclass.
+
+@type subscription_index: L{SubscriptionIndex}
+@var subscription_index: The process-wide index.
+
+@type _TYPE_NAMES: dict {class: str}
+@var _TYPE_NAMES: The name of each L{Subscription} subclass.
+"""
+import threading
+
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+
+from weatherapp.models import BandwidthSub, NodeDownSub, Subscriber, \
+    SubscriptionChange, TShirtSub, VersionSub
+
+SUBSCRIPTION_TYPES = [('node_down', NodeDownSub),
+                      ('version', VersionSub),
+                      ('low_bandwidth', BandwidthSub),
+                      ('t_shirt', TShirtSub)]
+
+
+class SubscriptionIndex:
+    '''
+    An inverted index from router fingerprints to confirmed subscriptions.
+
+    @type _by_fingerprint: dict {str: dict {int: str}}
+    @ivar _by_fingerprint: For each fingerprint, the ids of the
+        subscriptions on that router mapped to their type names.
+
+    @type _fingerprints: dict {int: str}
+    @ivar _fingerprints: The fingerprint each indexed subscription is on.
+
+    @type _added: dict {int: str}
+    @ivar _added: The subscriptions added to the index since it was first
+        built and not yet returned by L{take_added}, mapped to their type
+        names. These are on routers that may not change for a long time, so
+        they must be checked once on their own.
+
+    @type _applied: int
+    @ivar _applied: The id of the last L{SubscriptionChange} the index
+        includes.
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_fingerprint = None
+        self._fingerprints = {}
+        self._added = {}
+        self._applied = 0
+
+    def build(self):
+        """
+        Rebuild the index from the database, with one query per
+        subscription type. Subscriptions confirmed since the previous build
+        are added to those returned by L{take_added}; on the first build
+        there is nothing to compare with, and none are.
+        """
+        # Changes recorded from here on may or may not be in the rows read
+        # below, so they are applied again by the next update.
+        applied = SubscriptionChange.objects.aggregate(last = Max('pk'))
+        by_fingerprint = {}
+        fingerprints = {}
+        types = {}
+        for name, model in SUBSCRIPTION_TYPES:
+            rows = model.objects.filter(subscriber__confirmed = True) \
+                .values_list('pk', 'subscriber__router__fingerprint')
+            for pk, fingerprint in rows:
+                by_fingerprint.setdefault(fingerprint, {})[pk] = name
+                fingerprints[pk] = fingerprint
+                types[pk] = name
+        with self._lock:
+            if self._by_fingerprint is not None:
+                for pk in fingerprints.keys() - self._fingerprints.keys():
+                    self._added[pk] = types[pk]
+            for pk in list(self._added):
+                if pk not in fingerprints:
+                    del self._added[pk]
+            self._by_fingerprint = by_fingerprint
+            self._fingerprints = fingerprints
+            self._applied = applied['last'] or 0
+        SubscriptionChange.objects.filter(pk__lte = self._applied).delete()
+
+    def update(self):
+        """
+        Bring the index up to date with the L{SubscriptionChange}s recorded
+        since it was built or last updated, and delete them. The index is
+        built first if it has not been.
+        """
+        with self._lock:
+            if self._by_fingerprint is None:
+                self.build()
+                return
+            changes = list(SubscriptionChange.objects
+                           .filter(pk__gt = self._applied).order_by('pk')
+                           .values_list('pk', 'subscription_id', 'type_name',
+                                        'fingerprint', 'added'))
+            if not changes:
+                return
+            for change_id, pk, name, fingerprint, added in changes:
+                if added:
+                    self._add(pk, name, fingerprint)
+                else:
+                    self._remove(pk)
+            self._applied = changes[-1][0]
+        SubscriptionChange.objects.filter(pk__lte = self._applied).delete()
+
+    def _add(self, pk, name, fingerprint):
+        if self._fingerprints.get(pk) == fingerprint:
+            return
+        self._remove(pk)
+        self._by_fingerprint.setdefault(fingerprint, {})[pk] = name
+        self._fingerprints[pk] = fingerprint
+        self._added[pk] = name
+
+    def _remove(self, pk):
+        fingerprint = self._fingerprints.pop(pk, None)
+        self._added.pop(pk, None)
+        if fingerprint is None:
+            return
+        subs = self._by_fingerprint[fingerprint]
+        del subs[pk]
+        if not subs:
+            del self._by_fingerprint[fingerprint]
+
+    def _ensure_built(self):
+        if self._by_fingerprint is None:
+            self.build()
+
+    def subscriptions_for(self, fingerprints, type_name = None):
+        """
+        Find the confirmed subscriptions on the routers C{fingerprints}.
+
+        @type fingerprints: iterable of str
+        @param fingerprints: The routers in question.
+        @type type_name: str
+        @param type_name: Only return subscriptions of this type, if given.
+
+        @rtype: set [int]
+        @return: The ids of the matching subscriptions.
+        """
+        with self._lock:
+            self._ensure_built()
+            ids = set()
+            for fingerprint in fingerprints:
+                for pk, name in self._by_fingerprint.get(fingerprint,
+                                                         {}).items():
+                    if type_name is None or name == type_name:
+                        ids.add(pk)
+            return ids
+
+    def fingerprints(self, type_names = None):
+        """
+        @type type_names: iterable of str
+        @param type_names: Only count subscriptions of these types, if
+            given.
+
+        @rtype: set [str]
+        @return: The routers with at least one matching subscription.
+        """
+        with self._lock:
+            self._ensure_built()
+            if type_names is None:
+                return set(self._by_fingerprint)
+            type_names = set(type_names)
+            return set(fingerprint for fingerprint, subs
+                       in self._by_fingerprint.items()
+                       if type_names.intersection(subs.values()))
+
+    def take_added(self):
+        """
+        Return and forget the subscriptions found new by L{build} since
+        the last call.
+
+        @rtype: dict {int: str}
+        @return: The ids of the new subscriptions, mapped to their type
+            names.
+        """
+        with self._lock:
+            added, self._added = self._added, {}
+            return added
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_built()
+            return len(self._fingerprints)
+
+
+subscription_index = SubscriptionIndex()
+_TYPE_NAMES = dict((model, name) for name, model in SUBSCRIPTION_TYPES)
+
+
+def _record(changes):
+    """
+    Write C{changes}, a list of L{SubscriptionChange}s, once the
+    transaction that made them commits.
+    """
+    if changes:
+        transaction.on_commit(
+            lambda: SubscriptionChange.objects.bulk_create(changes))
+
+
+def _subscription_saved(sender, instance, **kwargs):
+    subscriber = instance.subscriber
+    _record([SubscriptionChange(subscription_id = instance.pk,
+                                type_name = _TYPE_NAMES[sender],
+                                fingerprint = subscriber.router.fingerprint,
+                                added = subscriber.confirmed)])
+
+
+def _subscription_deleted(sender, instance, **kwargs):
+    _record([SubscriptionChange(subscription_id = instance.pk,
+                                type_name = _TYPE_NAMES[sender],
+                                added = False)])
+
+
+def _subscriber_saved(sender, instance, created, **kwargs):
+    if created:
+        return
+    changes = []
+    for name, model in SUBSCRIPTION_TYPES:
+        for pk in model.objects.filter(subscriber = instance) \
+                .values_list('pk', flat = True):
+            changes.append(SubscriptionChange(
+                subscription_id = pk, type_name = name,
+                fingerprint = instance.router.fingerprint,
+                added = instance.confirmed))
+    _record(changes)
+
+
+def connect_signals():
+    """
+    Record every subscription that is saved or deleted, and every
+    subscriber that is confirmed or saved again, as L{SubscriptionChange}s.
+    Called once when the app is ready.
+    """
+    for name, model in SUBSCRIPTION_TYPES:
+        post_save.connect(_subscription_saved, sender = model)
+        post_delete.connect(_subscription_deleted, sender = model)
+    post_save.connect(_subscriber_saved, sender = Subscriber)
+
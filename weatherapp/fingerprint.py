@@ -0,0 +1,76 @@
+"""
+The fingerprint module converts router fingerprints between the forms Tor
+Weather handles them in: the canonical 40 character upper-case hex string
+stored in L{Router.fingerprint}, and a compact 20 byte binary form used as
+the key of the in-memory router maps and in the history files, which takes
+half the space and compares faster.
+
+Both directions are a single call into C{bytes.fromhex} or C{bytes.hex}.
+
+@type FINGERPRINT_LEN: int
+@var FINGERPRINT_LEN: Length of a canonical fingerprint.
+
+@type BINARY_LEN: int
+@var BINARY_LEN: Length of a binary fingerprint.
+"""
+import re
+
+FINGERPRINT_LEN = 40
+BINARY_LEN = 20
+
+_HEX_RE = re.compile('[0-9A-F]{%d}\\Z' % FINGERPRINT_LEN)
+
+
+def normalize(fingerprint):
+    """
+    Strip the spaces from C{fingerprint} and upper-case it.
+
+    @type fingerprint: str
+    @param fingerprint: A fingerprint, possibly with spaces.
+
+    @rtype: str
+    @return: The canonical form of C{fingerprint}.
+    """
+    return fingerprint.replace(' ', '').upper()
+
+
+def is_valid(fingerprint):
+    """
+    @type fingerprint: str
+    @param fingerprint: A fingerprint, possibly with spaces.
+
+    @rtype: bool
+    @return: C{True} if C{fingerprint} is 40 hex digits once normalized.
+    """
+    return _HEX_RE.match(normalize(fingerprint)) is not None
+
+
+def to_binary(fingerprint):
+    """
+    Encode a fingerprint in its binary form.
+
+    @type fingerprint: str
+    @param fingerprint: A fingerprint, possibly with spaces.
+
+    @rtype: bytes
+    @return: The 20 byte binary fingerprint.
+
+    @raise ValueError: If C{fingerprint} is not 40 hex digits.
+    """
+    binary = bytes.fromhex(fingerprint.replace(' ', ''))
+    if len(binary) != BINARY_LEN:
+        raise ValueError("Not a fingerprint: %r" % fingerprint)
+    return binary
+
+
+def from_binary(binary):
+    """
+    Decode a binary fingerprint.
+
+    @type binary: bytes
+    @param binary: A 20 byte binary fingerprint.
+
+    @rtype: str
+    @return: The canonical fingerprint.
+    """
+    return binary.hex().upper()
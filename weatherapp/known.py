@@ -0,0 +1,225 @@
+"""
+The known module answers whether a fingerprint may belong to a relay seen
+recently, so that the subscribe form can turn away mistyped fingerprints and
+relays that do not exist without querying the database or the Tor
+controller.
+
+L{FingerprintFilter} is a Bloom filter of the fingerprints in the last
+L{_CONSENSUSES} consensuses. It never reports a seen fingerprint as unknown,
+but may report an unseen one as known, so a hit still has to be confirmed
+against the L{Router} table. Fingerprints are SHA-1 digests, so their bytes
+are already uniformly distributed and the filter takes its bit positions
+directly from the binary fingerprint (see L{fingerprint}) instead of hashing
+it again.
+
+The updaters rebuild the filter from the L{presence} history after each
+consensus and save it to L{FILTER_FILE}. A process that does not run the
+updaters, such as the web server, loads it from there and reloads it when
+the file changes.
+
+@type _CONSENSUSES: int
+@var _CONSENSUSES: Number of consensuses a relay is remembered for, sixty
+    days of hourly consensuses, all that the presence history keeps.
+
+@type _BITS_PER_ENTRY: int
+@var _BITS_PER_ENTRY: Filter bits per fingerprint.
+
+@type _HASHES: int
+@var _HASHES: Bits set per fingerprint. With L{_BITS_PER_ENTRY}, about one
+    unseen fingerprint in a hundred passes the filter.
+
+@type _MAGIC: bytes
+@var _MAGIC: Marks the start of a filter file.
+
+@type _HEADER: struct.Struct
+@var _HEADER: Layout of the filter file header: the magic bytes, the number
+    of bits, the number of bits set per fingerprint and the number of
+    fingerprints.
+
+@type FILTER_FILE: str
+@var FILTER_FILE: Where the process-wide filter is saved.
+"""
+import logging
+import os
+import struct
+import threading
+
+from weatherapp import fingerprint as fp
+
+_CONSENSUSES = 60 * 24
+_BITS_PER_ENTRY = 10
+_HASHES = 7
+_MAGIC = b'TWF1'
+_HEADER = struct.Struct('<4sIII')
+
+FILTER_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data', 'known_fingerprints.dat')
+
+
+class FingerprintFilter:
+    '''
+    A Bloom filter of router fingerprints.
+
+    @type size: int
+    @ivar size: Number of bits in the filter.
+    @type count: int
+    @ivar count: Number of fingerprints added.
+
+    @type _bits: bytearray
+    @ivar _bits: The filter, eight bits per byte.
+    '''
+
+    def __init__(self, capacity = 0):
+        """
+        @type capacity: int
+        @param capacity: Number of fingerprints the filter is sized for.
+        """
+        self.size = max(capacity * _BITS_PER_ENTRY, 64)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def build(cls, fingerprints):
+        """
+        @type fingerprints: iterable of str
+        @param fingerprints: The fingerprints to add.
+
+        @rtype: L{FingerprintFilter}
+        @return: A filter sized for and holding C{fingerprints}.
+        """
+        fingerprints = list(fingerprints)
+        known = cls(len(fingerprints))
+        for fingerprint in fingerprints:
+            known.add(fingerprint)
+        return known
+
+    def _positions(self, key):
+        """
+        @rtype: list [int]
+        @return: The bits of the binary fingerprint C{key}, by double
+            hashing over its first two eight byte words.
+        """
+        first = int.from_bytes(key[:8], 'little')
+        step = int.from_bytes(key[8:16], 'little') | 1
+        return [(first + i * step) % self.size for i in range(_HASHES)]
+
+    def add(self, fingerprint):
+        """
+        @type fingerprint: str
+        @param fingerprint: A valid fingerprint, possibly with spaces.
+        """
+        for position in self._positions(fp.to_binary(fingerprint)):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def might_contain(self, fingerprint):
+        """
+        @type fingerprint: str
+        @param fingerprint: A fingerprint as entered, possibly with spaces.
+
+        @rtype: bool
+        @return: C{False} if C{fingerprint} is malformed or was certainly
+            not added, C{True} if it probably was.
+        """
+        if not fp.is_valid(fingerprint):
+            return False
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(fp.to_binary(fingerprint)))
+
+    __contains__ = might_contain
+
+    def save(self, path):
+        """
+        Write the filter to C{path}, replacing any previous file only once
+        the new one is complete.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, self.size, _HASHES, self.count))
+            out.write(self._bits)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a filter written by L{save}.
+
+        @rtype: L{FingerprintFilter}
+        @return: The filter, or C{None} if C{path} is missing or is not a
+            filter file with the current number of bits per fingerprint.
+        """
+        try:
+            with open(path, 'rb') as source:
+                magic, size, hashes, count = _HEADER.unpack(
+                    source.read(_HEADER.size))
+                bits = source.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, struct.error) as exc:
+            logging.warning("Could not read known fingerprints in %s: %s",
+                            path, exc)
+            return None
+        if magic != _MAGIC or hashes != _HASHES or \
+           len(bits) != (size + 7) // 8:
+            logging.warning("Ignoring known fingerprints in %s", path)
+            return None
+
+        known = cls()
+        known.size = size
+        known.count = count
+        known._bits = bytearray(bits)
+        return known
+
+    def __len__(self):
+        return self.count
+
+
+_filter = None
+_filter_mtime = None
+_filter_lock = threading.Lock()
+
+
+def rebuild(history):
+    """
+    Replace the process-wide filter with the fingerprints in the last
+    L{_CONSENSUSES} consensuses of C{history}, and save it.
+
+    @type history: L{PresenceHistory}
+    @param history: The presence history, with the latest consensus
+        recorded.
+    """
+    global _filter, _filter_mtime
+    known = FingerprintFilter.build(history.seen_within(_CONSENSUSES))
+    with _filter_lock:
+        _filter = known
+        try:
+            known.save(FILTER_FILE)
+            _filter_mtime = os.stat(FILTER_FILE).st_mtime
+        except OSError as exc:
+            logging.error("Could not save the known fingerprints: %s", exc)
+
+
+def get_filter():
+    """
+    Return the process-wide filter, loading it from L{FILTER_FILE} if the
+    file changed since it was last read.
+
+    @rtype: L{FingerprintFilter}
+    @return: The shared filter, or C{None} if none has been built yet, in
+        which case every fingerprint has to be looked up.
+    """
+    global _filter, _filter_mtime
+    try:
+        mtime = os.stat(FILTER_FILE).st_mtime
+    except OSError:
+        return _filter
+    if mtime != _filter_mtime:
+        with _filter_lock:
+            if mtime != _filter_mtime:
+                _filter = FingerprintFilter.load(FILTER_FILE)
+                _filter_mtime = mtime
+    return _filter
@@ -0,0 +1,197 @@
+"""
+The listener module runs Tor Weather's update loop. It registers for Tor's
+NEWCONSENSUS and NEWDESC controller events through a L{CtlUil} connection
+and runs the L{updaters} pipeline as soon as Tor has new data, instead of
+polling on a timer.
+
+Run it as a long-lived process::
+
+    python -m weatherapp.listener
+
+A failed batch is logged and does not stop the listener. If Tor closes the
+control connection, for instance because it was restarted, the listener
+takes a new connection from the pool, registers for the events again and
+reloads the consensus.
+
+@type _NEWDESC_DELAY: int
+@var _NEWDESC_DELAY: Seconds to wait after a NEWDESC event before reloading
+    descriptors, so that a burst of NEWDESC events costs one reload.
+
+@type _CHECK_INTERVAL: int
+@var _CHECK_INTERVAL: Longest time in seconds between two checks of the
+    control connection.
+"""
+import logging
+import os
+import threading
+import time
+
+import stem
+import stem.connection
+from stem.control import EventType
+
+_NEWDESC_DELAY = 60
+_CHECK_INTERVAL = 60
+
+
+class Listener:
+    '''
+    Listens for new consensus and descriptor events on a Stem connection
+    and runs the update pipeline when new data exists.
+
+    The Stem event handler only records which kind of data changed; the
+    refresh and the pipeline run on the thread that called L{listen}, so the
+    event thread is never blocked by database work.
+
+    @type ctl_util: L{CtlUil}
+    @ivar ctl_util: The Stem connection events are received on.
+
+    @type run: callable
+    @ivar run: The update pipeline, called with L{ctl_util} as its only
+        argument.
+    '''
+
+    def __init__(self, ctl_util, run):
+        self.ctl_util = ctl_util
+        self.run = run
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._new_consensus = False
+        self._new_desc_since = None
+
+    def _handle_event(self, event):
+        '''
+        Stem event handler. Records the event and wakes up L{listen}.
+        '''
+        with self._lock:
+            if event.type == EventType.NEWCONSENSUS:
+                self._new_consensus = True
+            elif self._new_desc_since is None:
+                self._new_desc_since = time.time()
+        self._wakeup.set()
+
+    def _take_pending(self):
+        '''
+        Collect the pending work whose time has come.
+
+        @rtype: tuple (bool, bool, float)
+        @return: Whether to reload the consensus, whether to reload the
+            descriptors, and how many seconds to wait before the next
+            deferred descriptor reload (C{None} if none is pending).
+        '''
+        with self._lock:
+            consensus = self._new_consensus
+            self._new_consensus = False
+
+            descriptors = False
+            timeout = None
+            if self._new_desc_since is not None:
+                waited = time.time() - self._new_desc_since
+                if consensus or waited >= _NEWDESC_DELAY:
+                    descriptors = True
+                    self._new_desc_since = None
+                else:
+                    timeout = _NEWDESC_DELAY - waited
+            return consensus, descriptors, timeout
+
+    def process_pending(self):
+        '''
+        Reload whatever Tor has announced and run the pipeline if the
+        consensus or the descriptors changed. Errors are logged, so that
+        one failed batch does not stop the listener.
+
+        @rtype: float
+        @return: Seconds until a deferred descriptor reload is due, or
+            C{None} if none is pending.
+        '''
+        consensus, descriptors, timeout = self._take_pending()
+
+        try:
+            updated = False
+            if consensus:
+                updated = self.ctl_util.refresh_consensus()
+            if descriptors or updated:
+                updated = self.ctl_util.refresh_descriptors() or updated
+
+            if updated:
+                logging.info("New Tor network data; running updaters")
+                self.run(self.ctl_util)
+        except Exception:
+            logging.exception("Tor Weather update failed")
+        return timeout
+
+    def _register(self):
+        '''
+        Register for NEWCONSENSUS and NEWDESC events on the current
+        connection.
+        '''
+        self.ctl_util.control.add_event_listener(self._handle_event,
+                EventType.NEWCONSENSUS, EventType.NEWDESC)
+
+    def check_connection(self):
+        '''
+        Make sure events are still being received. If Tor closed the
+        control connection, take a new one, register for events on it and
+        reload the consensus, since events may have been missed.
+
+        @rtype: bool
+        @return: C{True} if there is a live connection, C{False} if Tor
+            could not be reached.
+        '''
+        control = self.ctl_util.control
+        if control is not None and control.is_alive():
+            return True
+
+        logging.warning("Lost the Tor control connection; reconnecting")
+        try:
+            self.ctl_util.reconnect()
+            self._register()
+        except (stem.ControllerError,
+                stem.connection.AuthenticationFailure) as exc:
+            logging.error("Could not reconnect to Tor: %s", exc)
+            return False
+        with self._lock:
+            self._new_consensus = True
+        return True
+
+    def listen(self):
+        '''
+        Register for NEWCONSENSUS and NEWDESC events and process them until
+        the process is stopped.
+        '''
+        self._register()
+        try:
+            # Start from a current view of the network.
+            with self._lock:
+                self._new_consensus = True
+            while True:
+                timeout = None
+                if self.check_connection():
+                    timeout = self.process_pending()
+                if timeout is None or timeout > _CHECK_INTERVAL:
+                    timeout = _CHECK_INTERVAL
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+        finally:
+            if self.ctl_util.control is not None:
+                self.ctl_util.control.remove_event_listener(
+                    self._handle_event)
+
+
+def listen():
+    """
+    Connect to Tor and run the update pipeline on every new consensus.
+    """
+    from weatherapp import updaters
+    from weatherapp.ctlutil import CtlUil
+
+    Listener(CtlUil(), updaters.run_all).listen()
+
+
+if __name__ == '__main__':
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'TorWeatherProject.settings')
+    django.setup()
+    logging.basicConfig(level = logging.INFO)
+    listen()
@@ -0,0 +1,97 @@
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+import weatherapp.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriber',
+            name='email',
+            field=models.EmailField(default=None, max_length=75),
+        ),
+        migrations.AddField(
+            model_name='subscriber',
+            name='router',
+            field=models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, to='weatherapp.router'),
+        ),
+        migrations.AddField(
+            model_name='subscriber',
+            name='confirmed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='subscriber',
+            name='confirm_auth',
+            field=models.CharField(default=weatherapp.models.get_rand_string, max_length=25),
+        ),
+        migrations.AddField(
+            model_name='subscriber',
+            name='unsubs_auth',
+            field=models.CharField(default=weatherapp.models.get_rand_string, max_length=25),
+        ),
+        migrations.AddField(
+            model_name='subscriber',
+            name='pref_auth',
+            field=models.CharField(default=weatherapp.models.get_rand_string, max_length=25),
+        ),
+        migrations.AddField(
+            model_name='subscriber',
+            name='sub_date',
+            field=models.DateTimeField(default=datetime.datetime.now),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='subscriber',
+            field=models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, to='weatherapp.subscriber'),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='emailed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='BandwidthSub',
+            fields=[
+                ('subscription_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='weatherapp.subscription')),
+                ('triggered', models.BooleanField(default=False)),
+                ('threshold', models.IntegerField(default=20)),
+                ('last_changed', models.DateTimeField(default=datetime.datetime.now)),
+            ],
+            bases=('weatherapp.subscription',),
+        ),
+        migrations.CreateModel(
+            name='NodeDownSub',
+            fields=[
+                ('subscription_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='weatherapp.subscription')),
+                ('triggered', models.BooleanField(default=False)),
+                ('grace_pd', models.IntegerField(default=1)),
+                ('last_changed', models.DateTimeField(default=datetime.datetime.now)),
+            ],
+            bases=('weatherapp.subscription',),
+        ),
+        migrations.CreateModel(
+            name='TShirtSub',
+            fields=[
+                ('subscription_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='weatherapp.subscription')),
+                ('triggered', models.BooleanField(default=False)),
+                ('avg_bandwidth', models.IntegerField(default=0)),
+                ('last_changed', models.DateTimeField(default=datetime.datetime.now)),
+            ],
+            bases=('weatherapp.subscription',),
+        ),
+        migrations.CreateModel(
+            name='VersionSub',
+            fields=[
+                ('subscription_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='weatherapp.subscription')),
+                ('notify_type', models.CharField(default='UNRECOMMENDED', max_length=250)),
+            ],
+            bases=('weatherapp.subscription',),
+        ),
+    ]
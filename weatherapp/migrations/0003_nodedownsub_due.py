@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def schedule_pending(apps, schema_editor):
+    # Subscriptions already waiting out their grace period need a due time.
+    NodeDownSub = apps.get_model('weatherapp', 'NodeDownSub')
+    pending = NodeDownSub.objects.filter(triggered=True, emailed=False)
+    for sub in pending:
+        sub.due = sub.last_changed + timedelta(hours=sub.grace_pd)
+        sub.save(update_fields=['due'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherapp', '0002_subscriptions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nodedownsub',
+            name='due',
+            field=models.DateTimeField(blank=True, db_index=True, default=None, null=True),
+        ),
+        migrations.RunPython(schedule_pending, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherapp', '0003_nodedownsub_due'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='router',
+            name='bandwidth_sum',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='router',
+            name='bandwidth_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='router',
+            name='up_since',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherapp', '0004_router_bandwidth_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouterInterval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('up', models.BooleanField()),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField(blank=True, null=True)),
+                ('router', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='weatherapp.router')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['router', 'start'], name='routerinterval_start_idx'), models.Index(fields=['router', 'end'], name='routerinterval_end_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherapp', '0005_routerinterval'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='router',
+            name='last_seen',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='subscriber',
+            name='sub_date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='nodedownsub',
+            name='last_changed',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='bandwidthsub',
+            name='last_changed',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='tshirtsub',
+            name='last_changed',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
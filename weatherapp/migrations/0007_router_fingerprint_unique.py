@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+def merge_duplicates(apps, schema_editor):
+    # Bring fingerprints to their canonical form and fold routers sharing a
+    # fingerprint into the oldest one, so the unique index can be built.
+    Router = apps.get_model('weatherapp', 'Router')
+    Subscriber = apps.get_model('weatherapp', 'Subscriber')
+    RouterInterval = apps.get_model('weatherapp', 'RouterInterval')
+    kept = {}
+    for router in Router.objects.order_by('pk'):
+        canonical = router.fingerprint.replace(' ', '').upper()
+        if canonical in kept:
+            Subscriber.objects.filter(router=router).update(
+                router=kept[canonical])
+            RouterInterval.objects.filter(router=router).delete()
+            router.delete()
+            continue
+        if canonical != router.fingerprint:
+            router.fingerprint = canonical
+            router.save(update_fields=['fingerprint'])
+        kept[canonical] = router
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherapp', '0006_timezone_aware_defaults'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='router',
+            name='fingerprint',
+            field=models.CharField(default=None, max_length=40, unique=True),
+        ),
+    ]
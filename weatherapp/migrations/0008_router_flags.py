@@ -0,0 +1,52 @@
+from django.db import migrations
+import weatherapp.models
+
+UP, EXIT, WELCOMED = 1, 2, 4
+
+
+def pack_flags(apps, schema_editor):
+    Router = apps.get_model('weatherapp', 'Router')
+    for up in (False, True):
+        for exit in (False, True):
+            for welcomed in (False, True):
+                flags = (UP if up else 0) | (EXIT if exit else 0) | \
+                        (WELCOMED if welcomed else 0)
+                Router.objects.filter(up=up, exit=exit, welcomed=welcomed) \
+                    .update(flags=flags)
+
+
+def unpack_flags(apps, schema_editor):
+    Router = apps.get_model('weatherapp', 'Router')
+    for router in Router.objects.all():
+        router.up = bool(router.flags & UP)
+        router.exit = bool(router.flags & EXIT)
+        router.welcomed = bool(router.flags & WELCOMED)
+        router.save(update_fields=['up', 'exit', 'welcomed'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherapp', '0007_router_fingerprint_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='router',
+            name='flags',
+            field=weatherapp.models.FlagsField(db_index=True, default=1),
+        ),
+        migrations.RunPython(pack_flags, unpack_flags),
+        migrations.RemoveField(
+            model_name='router',
+            name='up',
+        ),
+        migrations.RemoveField(
+            model_name='router',
+            name='exit',
+        ),
+        migrations.RemoveField(
+            model_name='router',
+            name='welcomed',
+        ),
+    ]
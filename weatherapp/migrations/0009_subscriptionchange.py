@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherapp', '0008_router_flags'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subscription_id', models.BigIntegerField()),
+                ('type_name', models.CharField(max_length=20)),
+                ('fingerprint', models.CharField(blank=True, max_length=40)),
+                ('added', models.BooleanField()),
+            ],
+        ),
+    ]
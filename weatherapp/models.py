@@ -15,12 +15,16 @@ which specify and do the work of the forms displayed on the sign-up and preferen
 @group Helper Functions:
     insert_fingerprint_spaces, 
     get_rand_string,
-    hours_since
+    hours_since,
+    hours_since_expression,
+    flags_match
 ------------------------------------------------------------
 @group Models:
     Router, 
+    RouterInterval,
     Subscriber, 
-    Subscription
+    Subscription,
+    SubscriptionChange
 ------------------------------------------------------------
 @group Subscription Subclasses: 
     NodeDownSub,
@@ -34,23 +38,25 @@ which specify and do the work of the forms displayed on the sign-up and preferen
     PreferencesForm
     
 ------------------------------------------------------------
-@group Custom Fields: PrefixedIntegerField
+@group Custom Fields: FlagsField, PrefixedIntegerField
 
 '''
-from datetime import datetime
+from datetime import timedelta
 import base64
-from msilib.schema import Class
 import os
 import re
 from copy import copy
 from unicodedata import name
 
 from config import url_helper
+from weatherapp import fingerprint as fp
+from weatherapp import known
 
 from django.db import models
 from django import forms
 from django.core import validators
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.db import models
 
 
@@ -80,28 +86,128 @@ def get_rand_string():
     @rtype: str
     @return: A randomly generated, 24 character string (url-safe).
     """
-    r = base64.urlsafe_b64encode(os.urandom(18))
+    r = base64.urlsafe_b64encode(os.urandom(18)).decode('ascii')
 
     # some email clients don't like URLs ending in -
     if r.endswith("-"):
         r = r.replace("-", "x")
     return r  
 
-def hours_since(time):
+def hours_since(time, now=None):
     """
     Get the number of hours passed since datetime C{time}.
 
     @type time: C{datetime}
-    @arg time: A C{datetime} object.
-    @rtype: int
+    @arg time: A C{datetime} object. A naive C{datetime} is taken to be in
+        the current time zone.
+    @type now: C{datetime}
+    @arg now: The time to count to. Default value is the current time.
+    @rtype: float
     @return: The number of hours since C{time}.
     """
 
-    delta = datetime.now() - time
-    hours = (delta.day * 24) + (delta.seconds / 3600)
-    return hours 
+    if now is None:
+        now = timezone.now()
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time)
+    return (now - time).total_seconds() / 3600
+
+
+def hours_since_expression(field, now=None):
+    """
+    Build a database expression for the time passed since the datetime
+    column C{field}, for use with C{annotate()}, so the ages of many rows
+    are computed in one query. The annotated values are C{timedelta}s;
+    divide their C{total_seconds()} by 3600 for hours.
+
+    @type field: str
+    @arg field: The name of a C{DateTimeField}, which may span relations.
+    @type now: C{datetime}
+    @arg now: The time to count to. Default value is the current time.
+    @rtype: C{ExpressionWrapper}
+    @return: The expression.
+    """
+
+    if now is None:
+        now = timezone.now()
+    return models.ExpressionWrapper(
+        models.Value(now, output_field=models.DateTimeField()) -
+        models.F(field), output_field=models.DurationField())
+
+
+def flags_match(values, required=0, excluded=0):
+    """
+    Test many flag bitmasks at once, for example the L{Router.flags} of
+    the rows of a C{values()} query, with the same rules as the
+    C{hasflags} and C{lacksflags} lookups.
+
+    @type values: iterable of int
+    @arg values: The bitmasks to test.
+    @type required: int
+    @arg required: Flags that must all be set.
+    @type excluded: int
+    @arg excluded: Flags that must all be clear.
+    @rtype: list [bool]
+    @return: Whether each bitmask matches, in order.
+    """
+
+    return [value & required == required and not value & excluded
+            for value in values]
+
+
+def _flag_property(flag, doc):
+    """
+    Build a boolean property that reads and writes one bit of a model's
+    C{flags} field.
+    """
+
+    def get(self):
+        return bool(self.flags & flag)
+
+    def set(self, value):
+        if value:
+            self.flags |= flag
+        else:
+            self.flags &= ~flag
+
+    return property(get, set, doc=doc)
     
 
+# CUSTOM FIELDS ---------------------------------------------------------------
+# -----------------------------------------------------------------------------
+
+class FlagsField(models.PositiveIntegerField):
+    """
+    An integer field holding a bitmask of flags. Besides the usual integer
+    lookups it has two lookups that test bits in the database, so a query
+    on several flags is a single bitwise expression:
+
+        - C{hasflags}: every bit of the given mask is set.
+        - C{lacksflags}: no bit of the given mask is set.
+    """
+
+
+@FlagsField.register_lookup
+class HasFlags(models.Lookup):
+    lookup_name = 'hasflags'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return '(%s & %s) = %s' % (lhs, rhs, rhs), \
+               lhs_params + rhs_params + rhs_params
+
+
+@FlagsField.register_lookup
+class LacksFlags(models.Lookup):
+    lookup_name = 'lacksflags'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return '(%s & %s) = 0' % (lhs, rhs), lhs_params + rhs_params
+
+
 # MODELS ----------------------------------------------------------------------
 # -----------------------------------------------------------------------------
 
@@ -131,41 +237,124 @@ class Router(models.Model):
     These are the values that fields will be instantiated with if they are not specified in the model's construction.
 
     @type fingerprint: CharField (str)
-    @ivar fingerprint: The L{Router}'s fingerprint. Required constructor argument.
+    @ivar fingerprint: The L{Router}'s fingerprint, in the canonical upper-case
+    form without spaces. Unique and indexed. Required constructor argument.
 
     @type name: CharField (str)
     @ivar name: The L{Router}'s name. Default value is C{'Unnamed'}.
     
-    @type welcomed: BooleanField (bool)
+    @type UP: int
+    @cvar UP: Flag set if this L{Router} was in the last consensus.
+    @type EXIT: int
+    @cvar EXIT: Flag set if this L{Router} accepts exits to port 80.
+    @type WELCOMED: int
+    @cvar WELCOMED: Flag set once the L{Router} operator has received a welcome
+    email.
+    @type HIBERNATING: int
+    @cvar HIBERNATING: Flag set if this L{Router}'s descriptor says it is
+    hibernating.
+    @type STABLE: int
+    @cvar STABLE: The consensus Stable flag.
+    @type GUARD: int
+    @cvar GUARD: The consensus Guard flag.
+    @type FAST: int
+    @cvar FAST: The consensus Fast flag.
+    @type RUNNING: int
+    @cvar RUNNING: The consensus Running flag.
+    @type VALID: int
+    @cvar VALID: The consensus Valid flag.
+    @type _CONSENSUS_FLAGS: dict {str: int}
+    @cvar _CONSENSUS_FLAGS: The flags taken from the consensus, by their name in
+    the consensus.
+
+    @type flags: FlagsField (int)
+    @ivar flags: The L{Router}'s state as a bitmask of the flags above. Indexed.
+    Default value is C{UP}.
+
+    @type welcomed: bool
     @ivar welcomed: Whether the L{Router} operator has received a welcome email.
-    Default value is C{False}.
+    Stored as the L{WELCOMED} flag. Default value is C{False}.
 
-    @type up: BooleanField (bool)
+    @type up: bool
     @ivar up: Whether this L{Router} was up the last time a new consensus document was published. 
-    Default value is C{True}.
+    Stored as the L{UP} flag. Default value is C{True}.
 
-    @type exit: BooleanField (bool)
+    @type exit: bool
     @ivar exit: Whether this L{Router} is an exit node (if it accepts exits to port 80).
-    Default is C{False}.
+    Stored as the L{EXIT} flag. Default is C{False}.
+
+    @type bandwidth_sum: BigIntegerField (int)
+    @ivar bandwidth_sum: Sum of the observed bandwidth samples in kB/s taken
+    since the L{Router} last came up, one per consensus. Only kept for routers
+    with a T-shirt subscription. Default value is C{0}.
+
+    @type bandwidth_count: IntegerField (int)
+    @ivar bandwidth_count: Number of samples in L{bandwidth_sum}. Default value
+    is C{0}.
+
+    @type up_since: DateTimeField (datetime)
+    @ivar up_since: When the first sample in L{bandwidth_sum} was taken, from
+    which the L{Router}'s uptime is counted. Default value is C{None}.
     '''
+    UP = 1 << 0
+    EXIT = 1 << 1
+    WELCOMED = 1 << 2
+    HIBERNATING = 1 << 3
+    STABLE = 1 << 4
+    GUARD = 1 << 5
+    FAST = 1 << 6
+    RUNNING = 1 << 7
+    VALID = 1 << 8
+    _CONSENSUS_FLAGS = { 'Stable': STABLE,
+                         'Guard': GUARD,
+                         'Fast': FAST,
+                         'Running': RUNNING,
+                         'Valid': VALID }
+
     _FINGERPRINT_MAX_LEN = 40
     _NAME_MAX_LEN = 100
     _DEFAULTS = { 'name': 'Unnamed',
-                  'welcomed': False,
-                  'last_seen': datetime.now,
-                  'up': True,
-                  'exit': False 
+                  'last_seen': timezone.now,
+                  'flags': UP,
+                  'bandwidth_sum': 0,
+                  'bandwidth_count': 0,
+                  'up_since': None
                 }
 
-    fingerprint = models.CharField(max_length=_FINGERPRINT_MAX_LEN, default=None, blank=False)
+    fingerprint = models.CharField(max_length=_FINGERPRINT_MAX_LEN, default=None, blank=False,
+                                   unique=True)
 
     name = models.CharField(max_length=_NAME_MAX_LEN, default=_DEFAULTS['name'])
 
     last_seen = models.DateTimeField(default=_DEFAULTS['last_seen'])
 
-    welcomed = models.BooleanField(default=_DEFAULTS['welcomed'])
-    up = models.BooleanField(default=_DEFAULTS['up'])
-    exit = models.BooleanField(default=_DEFAULTS['exit'])
+    flags = FlagsField(default=_DEFAULTS['flags'], db_index=True)
+
+    welcomed = _flag_property(WELCOMED, "Whether the operator was welcomed.")
+    up = _flag_property(UP, "Whether the router is up.")
+    exit = _flag_property(EXIT, "Whether the router allows exits to port 80.")
+
+    bandwidth_sum = models.BigIntegerField(default=_DEFAULTS['bandwidth_sum'])
+    bandwidth_count = models.IntegerField(default=_DEFAULTS['bandwidth_count'])
+    up_since = models.DateTimeField(default=_DEFAULTS['up_since'], null=True,
+                                    blank=True)
+
+    @classmethod
+    def consensus_flags(cls, names):
+        """
+        Converts the names of consensus flags to the matching flag bits.
+        Flags that L{Router} does not track are ignored.
+
+        @type names: iterable of str
+        @param names: Flag names as they appear in the consensus.
+
+        @rtype: int
+        @return: The bitmask of the tracked flags.
+        """
+        flags = 0
+        for name in names:
+            flags |= cls._CONSENSUS_FLAGS.get(name, 0)
+        return flags
 
     def __unicode__(self):
         """
@@ -187,6 +376,88 @@ class Router(models.Model):
         """
         return insert_fingerprint_spaces(self.fingerprint)
 
+    def binary_fingerprint(self):
+        """
+        Returns the L{fingerprint} for this L{Router} in its compact 20 byte
+        binary form.
+
+        @rtype: bytes
+        @return: The L{Router}'s binary fingerprint.
+        """
+        return fp.to_binary(self.fingerprint)
+
+
+
+class RouterInterval(models.Model):
+    '''
+    Model for the long-term availability history of a L{Router}, stored as
+    run-length encoded intervals: one row for each stretch of consensuses
+    in which the L{Router} was continuously up or continuously down.
+
+    Intervals are opened and closed from the consensus diffs, so a
+    L{Router} whose state does not change costs nothing per update. The
+    interval the L{Router} is currently in is open, with no L{end}.
+
+    @type router: L{Router}
+    @ivar router: The L{Router} this interval belongs to.
+
+    @type up: BooleanField (bool)
+    @ivar up: Whether the L{Router} was up during this interval.
+
+    @type start: DateTimeField (datetime)
+    @ivar start: The time of the update the interval began at.
+
+    @type end: DateTimeField (datetime)
+    @ivar end: The time of the update the interval ended at, or C{None} if
+    the interval is still open.
+    '''
+
+    router = models.ForeignKey(Router, on_delete=models.CASCADE)
+    up = models.BooleanField()
+    start = models.DateTimeField()
+    end = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['router', 'start'],
+                         name='routerinterval_start_idx'),
+            models.Index(fields=['router', 'end'],
+                         name='routerinterval_end_idx'),
+        ]
+
+    @classmethod
+    def overlapping(cls, router, start, end):
+        """
+        Returns the intervals of C{router} that overlap the time range from
+        C{start} to C{end}, using the indexes on L{router} and the interval
+        bounds.
+
+        @type router: L{Router}
+        @param router: The L{Router} in question.
+        @type start: datetime
+        @param start: The start of the range.
+        @type end: datetime
+        @param end: The end of the range.
+
+        @rtype: QuerySet
+        @return: The overlapping intervals, oldest first.
+        """
+        return cls.objects.filter(router=router, start__lte=end) \
+            .filter(models.Q(end__gte=start) | models.Q(end__isnull=True)) \
+            .order_by('start')
+
+    @classmethod
+    def was_down(cls, router, start, end):
+        """
+        @rtype: bool
+        @return: C{True} if C{router} was down at any point between
+            C{start} and C{end}.
+        """
+        return cls.overlapping(router, start, end).filter(up=False).exists()
+
+    def __unicode__(self):
+        return "%s %s from %s to %s" % (self.router.name,
+            'up' if self.up else 'down', self.start, self.end or 'now')
 
 
 class Subscriber(models.Model):
@@ -231,7 +502,7 @@ class Subscriber(models.Model):
 
     @type sub_date: DateTimeField (datetime)
     @ivar sub_date: Datetime at which the L{Subscriber} subscribed. Default 
-        value is the current time, evaluated by a call to C{datetime.now}.
+        value is the current time, evaluated by a call to C{timezone.now}.
 
     '''
     _EMAIL_MAX_LEN = 75
@@ -240,7 +511,7 @@ class Subscriber(models.Model):
                   'confirm_auth': get_rand_string,
                   'unsubs_auth': get_rand_string,
                   'pref_auth': get_rand_string,
-                  'sub_date': datetime.now }
+                  'sub_date': timezone.now }
 
 
     email = models.EmailField(max_length=_EMAIL_MAX_LEN, default=None, blank=False)
@@ -285,16 +556,272 @@ class Subscription(models.Model):
     subscriber = models.ForeignKey(Subscriber, default=None,on_delete=models.CASCADE, blank=False)
     emailed = models.BooleanField(default=_DEFAULTS['emailed'])
 
+
+class SubscriptionChange(models.Model):
+    '''
+    A subscription that was confirmed, added or removed, recorded so that
+    the process running the updaters can bring its L{fanout} index up to
+    date without reading every subscription. Rows are written by the
+    L{fanout} signal handlers in whichever process made the change, and
+    deleted once the index has applied them.
+
+    @type subscription_id: IntegerField (int)
+    @ivar subscription_id: The id of the L{Subscription}. Not a foreign
+        key, since removed subscriptions no longer exist.
+    @type type_name: CharField (str)
+    @ivar type_name: The subscription type, as named in
+        L{fanout.SUBSCRIPTION_TYPES}.
+    @type fingerprint: CharField (str)
+    @ivar fingerprint: The fingerprint of the subscribed L{Router}, or an
+        empty string for a removal.
+    @type added: BooleanField (bool)
+    @ivar added: C{True} if the subscription became active, C{False} if it
+        was removed or its subscriber is no longer confirmed.
+    '''
+
+    subscription_id = models.BigIntegerField()
+    type_name = models.CharField(max_length=20)
+    fingerprint = models.CharField(max_length=Router._FINGERPRINT_MAX_LEN,
+                                   blank=True)
+    added = models.BooleanField()
+
 # SUBSCRIPTION SUBCLASSES -----------------------------------------------------
 # -----------------------------------------------------------------------------
 
+class NodeDownSub(Subscription):
+    """
+    A subscription class for node-down notifications. Subscribers are
+    emailed once their router has been down for longer than their grace
+    period.
+
+    @type _DEFAULTS: dict {str: various}
+    @cvar _DEFAULTS: Dictionary mapping field names to their default
+        parameters.
+
+    @type triggered: BooleanField (bool)
+    @ivar triggered: C{True} if the router is down, C{False} if it is up.
+        Default value is C{False}.
+    @type grace_pd: IntegerField (int)
+    @ivar grace_pd: Hours the router must be down before the subscriber is
+        emailed. Default value is C{1}.
+    @type last_changed: DateTimeField (datetime)
+    @ivar last_changed: The time L{triggered} last changed.
+    @type due: DateTimeField (datetime)
+    @ivar due: The time the subscriber is due to be emailed, scheduled when
+        the router goes down and cleared when it comes back up or the email
+        is sent. Indexed, so each update only reads the subscriptions that
+        have come due. Default value is C{None}.
+    """
+
+    _DEFAULTS = { 'triggered': False,
+                  'grace_pd': 1,
+                  'last_changed': timezone.now,
+                  'due': None }
+
+    triggered = models.BooleanField(default=_DEFAULTS['triggered'])
+    grace_pd = models.IntegerField(default=_DEFAULTS['grace_pd'])
+    last_changed = models.DateTimeField(default=_DEFAULTS['last_changed'])
+    due = models.DateTimeField(default=_DEFAULTS['due'], null=True,
+                               blank=True, db_index=True)
+
+    @staticmethod
+    def get_due(went_down, grace_pd):
+        """
+        @type went_down: datetime
+        @param went_down: The last time the router was seen up.
+        @type grace_pd: int
+        @param grace_pd: The grace period in hours.
+
+        @rtype: datetime
+        @return: The time the grace period ends.
+        """
+        return went_down + timedelta(hours=grace_pd)
+
+
+class VersionSub(Subscription):
+    """
+    A subscription class for version notifications. Subscribers are
+    emailed when their router runs a version of Tor that is not
+    recommended (L{UNRECOMMENDED}) or not on the recommended list at all
+    (L{OBSOLETE}).
+
+    @type _NOTIFY_TYPE_MAX_LEN: int
+    @cvar _NOTIFY_TYPE_MAX_LEN: Maximum length of L{notify_type}.
+
+    @type notify_type: CharField (str)
+    @ivar notify_type: Either L{UNRECOMMENDED} or L{OBSOLETE}.
+    """
+
+    UNRECOMMENDED = 'UNRECOMMENDED'
+    OBSOLETE = 'OBSOLETE'
+    _NOTIFY_TYPE_MAX_LEN = 250
+
+    notify_type = models.CharField(max_length=_NOTIFY_TYPE_MAX_LEN,
+                                   default=UNRECOMMENDED)
+
+
+class BandwidthSub(Subscription):
+    """
+    A subscription class for low bandwidth notifications. Subscribers are
+    emailed when their router's observed bandwidth has stayed below
+    L{threshold} for L{_HOURS_BELOW} hours.
+
+    @type _DEFAULTS: dict {str: various}
+    @cvar _DEFAULTS: Dictionary mapping field names to their default
+        parameters.
+
+    @type _HOURS_BELOW: int
+    @cvar _HOURS_BELOW: Hours the bandwidth must stay below the threshold
+        before the subscriber is emailed.
+
+    @type triggered: BooleanField (bool)
+    @ivar triggered: C{True} if the observed bandwidth has been below the
+        threshold for L{_HOURS_BELOW} hours. Default value is C{False}.
+    @type threshold: IntegerField (int)
+    @ivar threshold: Threshold in kB/s. Default value is C{20}.
+    @type last_changed: DateTimeField (datetime)
+    @ivar last_changed: The time L{triggered} last changed.
+    """
+
+    _DEFAULTS = { 'triggered': False,
+                  'threshold': 20,
+                  'last_changed': timezone.now }
+    _HOURS_BELOW = 24
+
+    triggered = models.BooleanField(default=_DEFAULTS['triggered'])
+    threshold = models.IntegerField(default=_DEFAULTS['threshold'])
+    last_changed = models.DateTimeField(default=_DEFAULTS['last_changed'])
+
+
+class TShirtSub(Subscription):
+    """
+    A subscription class for T-shirt notifications. Subscribers are
+    emailed when their router has been up for two months with an average
+    bandwidth of 500 kB/s, or 100 kB/s if it allows exits to port 80.
+
+    @type _DEFAULTS: dict {str: various}
+    @cvar _DEFAULTS: Dictionary mapping field names to their default
+        parameters.
+
+    @type _HOURS_REQUIRED: int
+    @cvar _HOURS_REQUIRED: Hours of uptime needed for a T-shirt.
+    @type _BANDWIDTH: int
+    @cvar _BANDWIDTH: Average bandwidth in kB/s needed for a T-shirt.
+    @type _EXIT_BANDWIDTH: int
+    @cvar _EXIT_BANDWIDTH: Average bandwidth in kB/s needed for a T-shirt
+        by a router that allows exits to port 80.
+
+    @type triggered: BooleanField (bool)
+    @ivar triggered: C{True} while the router is up. Default value is
+        C{False}.
+    @type avg_bandwidth: IntegerField (int)
+    @ivar avg_bandwidth: Average observed bandwidth in kB/s since the
+        router came up, from L{Router.bandwidth_sum} and
+        L{Router.bandwidth_count} at the last update. Default value is C{0}.
+    @type last_changed: DateTimeField (datetime)
+    @ivar last_changed: The time L{triggered} last changed.
+    """
+
+    _DEFAULTS = { 'triggered': False,
+                  'avg_bandwidth': 0,
+                  'last_changed': timezone.now }
+    _HOURS_REQUIRED = 1464
+    _EXIT_BANDWIDTH = 100
+    _BANDWIDTH = 500
+
+    triggered = models.BooleanField(default=_DEFAULTS['triggered'])
+    avg_bandwidth = models.IntegerField(default=_DEFAULTS['avg_bandwidth'])
+    last_changed = models.DateTimeField(default=_DEFAULTS['last_changed'])
+
+    @classmethod
+    def is_eligible(cls, avg_bandwidth, hours_up, exit):
+        """
+        Check the T-shirt rule against a router's running totals.
+
+        @type avg_bandwidth: int
+        @param avg_bandwidth: Average bandwidth in kB/s since the router
+            came up.
+        @type hours_up: int
+        @param hours_up: Hours the router has been up.
+        @type exit: bool
+        @param exit: Whether the router allows exits to port 80.
+
+        @rtype: bool
+        @return: C{True} if the router has earned a T-shirt.
+        """
+        needed = cls._EXIT_BANDWIDTH if exit else cls._BANDWIDTH
+        return hours_up >= cls._HOURS_REQUIRED and avg_bandwidth >= needed
+
 
 # FORMS -----------------------------------------------------------------------
 # -----------------------------------------------------------------------------
+class SubscribeForm(forms.Form):
+    '''
+    The form on the sign-up page: the subscriber's email address, entered
+    twice, and the fingerprint of the L{Router} to watch. The router search
+    box only helps fill in the fingerprint and is not submitted data.
 
+    The fingerprint is checked against the L{known} filter of recently seen
+    fingerprints first, so a mistyped or unknown fingerprint is rejected
+    without a database query. Only fingerprints that pass the filter are
+    looked up in the L{Router} table.
 
-# CUSTOM FIELDS ---------------------------------------------------------------
-# -----------------------------------------------------------------------------
+    @type NOT_FOUND: str
+    @cvar NOT_FOUND: Error code of a well-formed fingerprint that no known
+    L{Router} has.
+
+    @type router: L{Router}
+    @ivar router: The L{Router} with the entered fingerprint, once
+    L{fingerprint} has been cleaned.
+    '''
+    NOT_FOUND = 'not_found'
+
+    email_1 = forms.EmailField(label='Enter Email:',
+                               max_length=Subscriber._EMAIL_MAX_LEN)
+    email_2 = forms.EmailField(label='Confirm Email:',
+                               max_length=Subscriber._EMAIL_MAX_LEN)
+    fingerprint = forms.CharField(label='Node Fingerprint:',
+                                  max_length=Router._FINGERPRINT_MAX_LEN + 9,
+                                  widget=forms.TextInput(attrs={'size': '50'}))
+    router_search = forms.CharField(
+        label='Enter router name, then click the arrow:',
+        max_length=Router._NAME_MAX_LEN, required=False,
+        widget=forms.TextInput(attrs={'id': 'router_search',
+                                      'autocomplete': 'off'}))
+
+    def clean_fingerprint(self):
+        """
+        Normalize the fingerprint and find its L{Router}.
+
+        @rtype: str
+        @return: The fingerprint in canonical form.
+        """
+        fingerprint = fp.normalize(self.cleaned_data['fingerprint'])
+        if not fp.is_valid(fingerprint):
+            raise ValidationError('A fingerprint is 40 hexadecimal characters.',
+                                  code='invalid')
+        known_filter = known.get_filter()
+        if known_filter is not None and \
+           not known_filter.might_contain(fingerprint):
+            raise ValidationError('No router has this fingerprint.',
+                                  code=self.NOT_FOUND)
+        try:
+            self.router = Router.objects.get(fingerprint=fingerprint)
+        except Router.DoesNotExist:
+            raise ValidationError('No router has this fingerprint.',
+                                  code=self.NOT_FOUND)
+        return fingerprint
+
+    def clean(self):
+        """
+        Check that both email addresses are the same.
+        """
+        cleaned_data = super().clean()
+        email_1 = cleaned_data.get('email_1')
+        email_2 = cleaned_data.get('email_2')
+        if email_1 and email_2 and email_1 != email_2:
+            raise ValidationError('The email addresses do not match.')
+        return cleaned_data
 
 
 # Create your models here.
@@ -0,0 +1,310 @@
+"""
+The presence module keeps a rolling record of which consensuses each router
+was listed in, as one bit per consensus, so that questions about a router's
+uptime are answered by counting bits rather than by reading history rows.
+
+Consensuses are numbered by the hour of their valid-after time (see
+L{consensus_seq}). Each router's record is a Python int whose lowest bit is
+the most recent consensus it was checked against. Records are shifted
+lazily: an update only touches the routers in the new consensus, and a
+router that was absent has its record shifted by the number of consensuses
+it missed the next time it is read or set. Only the last L{_WINDOW}
+consensuses are kept, and a router missing from all of them is dropped
+when the next consensus is recorded. Routers are keyed by their binary fingerprints (see
+L{fingerprint}).
+
+The updaters save the presence history to L{PRESENCE_FILE} after each
+update. Other processes load it from there and reload it whenever the file
+changes (see L{get_history}).
+
+@type _WINDOW: int
+@var _WINDOW: Number of consensuses kept per router, sixty days of hourly
+    consensuses.
+
+@type _MAGIC: bytes
+@var _MAGIC: Marks the start of a presence file.
+
+@type _HEADER: struct.Struct
+@var _HEADER: Layout of the presence file header: the magic bytes, the
+    window, the latest consensus number and the number of routers.
+
+@type _RECORD: struct.Struct
+@var _RECORD: Layout of the fixed part of each router's record in a
+    presence file: its binary fingerprint, the consensus number its bits
+    end at and the first consensus it was seen in.
+
+@type PRESENCE_FILE: str
+@var PRESENCE_FILE: Where the process-wide presence history is saved.
+"""
+import calendar
+import logging
+import os
+import struct
+import threading
+
+from weatherapp import fingerprint as fp
+
+_WINDOW = 60 * 24
+_MAGIC = b'TWP2'
+_HEADER = struct.Struct('<4sIII')
+_RECORD = struct.Struct('<%dsII' % fp.BINARY_LEN)
+
+PRESENCE_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data', 'presence.dat')
+
+
+def consensus_seq(valid_after):
+    """
+    Number a consensus by the hours between the epoch and its valid-after
+    time.
+
+    @type valid_after: datetime
+    @param valid_after: The valid-after time of the consensus, in UTC.
+
+    @rtype: int
+    @return: The consensus number.
+    """
+    return calendar.timegm(valid_after.utctimetuple()) // 3600
+
+
+class PresenceHistory:
+    '''
+    A record of the last L{window} consensuses for a set of routers.
+
+    @type window: int
+    @ivar window: Number of consensuses kept per router.
+
+    @type seq: int
+    @ivar seq: The number of the latest consensus recorded, or C{None}.
+
+    @type _bits: dict {bytes: int}
+    @ivar _bits: The presence bits of each router, lowest bit last.
+    @type _ends: dict {bytes: int}
+    @ivar _ends: The consensus number of the lowest bit of each router.
+    @type _first_seen: dict {bytes: int}
+    @ivar _first_seen: The first consensus each router was seen in.
+    '''
+
+    def __init__(self, window = _WINDOW):
+        self.window = window
+        self.seq = None
+        self._mask = (1 << window) - 1
+        self._lock = threading.Lock()
+        self._bits = {}
+        self._ends = {}
+        self._first_seen = {}
+
+    def record(self, seq, fingerprints):
+        """
+        Record that the routers C{fingerprints} were in consensus C{seq}.
+        A consensus older than the latest one recorded is ignored. Routers
+        that have been missing for the whole window are dropped.
+
+        @type seq: int
+        @param seq: The consensus number, from L{consensus_seq}.
+        @type fingerprints: iterable of str
+        @param fingerprints: The routers in the consensus.
+        """
+        with self._lock:
+            if self.seq is not None and seq <= self.seq:
+                return
+            self.seq = seq
+            for fingerprint in fingerprints:
+                key = fp.to_binary(fingerprint)
+                self._bits[key] = self._current(key) | 1
+                self._ends[key] = seq
+                self._first_seen.setdefault(key, seq)
+            # The last bit set of a router was at its end, so its bits are
+            # all shifted out once the window has passed it.
+            gone = [key for key, end in self._ends.items()
+                    if seq - end >= self.window]
+            for key in gone:
+                del self._bits[key], self._ends[key], self._first_seen[key]
+
+    def _current(self, key):
+        """
+        @rtype: int
+        @return: The bits of the router C{key} shifted to end at L{seq}.
+        """
+        bits = self._bits.get(key, 0)
+        if bits:
+            bits = (bits << (self.seq - self._ends[key])) & self._mask
+        return bits
+
+    def _recent(self, fingerprint, last):
+        """
+        @rtype: tuple (int, int)
+        @return: The bits of C{fingerprint} for the last C{last}
+            consensuses since it was first seen, and how many consensuses
+            that is.
+        """
+        key = fp.to_binary(fingerprint)
+        first = self._first_seen.get(key)
+        if first is None:
+            return 0, 0
+        span = min(last or self.window, self.window, self.seq - first + 1)
+        return self._current(key) & ((1 << span) - 1), span
+
+    def present_in(self, fingerprint, last = None):
+        """
+        @type last: int
+        @param last: Count over this many consensuses, or L{window}.
+
+        @rtype: int
+        @return: How many of the last C{last} consensuses C{fingerprint} was
+            in.
+        """
+        with self._lock:
+            bits, span = self._recent(fingerprint, last)
+        return bin(bits).count('1')
+
+    def uptime(self, fingerprint, last = None):
+        """
+        @type last: int
+        @param last: Count over this many consensuses, or L{window}.
+
+        @rtype: float
+        @return: The fraction of the last C{last} consensuses since it was
+            first seen that C{fingerprint} was in, or C{0.0} if it has never
+            been seen.
+        """
+        with self._lock:
+            bits, span = self._recent(fingerprint, last)
+        if not span:
+            return 0.0
+        return bin(bits).count('1') / span
+
+    def longest_outage(self, fingerprint, last = None):
+        """
+        @type last: int
+        @param last: Look at this many consensuses, or L{window}.
+
+        @rtype: int
+        @return: The most consecutive consensuses C{fingerprint} was
+            missing from among the last C{last} since it was first seen.
+        """
+        with self._lock:
+            bits, span = self._recent(fingerprint, last)
+        if not span:
+            return 0
+        return max(len(run) for run in format(bits, '0%db' % span).split('1'))
+
+    def seen_within(self, last = None):
+        """
+        @type last: int
+        @param last: Look at this many consensuses, or L{window}.
+
+        @rtype: list [str]
+        @return: The routers in any of the last C{last} consensuses.
+        """
+        mask = (1 << min(last or self.window, self.window)) - 1
+        with self._lock:
+            return [fp.from_binary(key) for key in self._bits
+                    if self._current(key) & mask]
+
+    def stats(self, fingerprint, last = None):
+        """
+        @rtype: dict {str: various}
+        @return: The C{uptime}, C{present_in} and C{longest_outage} of
+            C{fingerprint} over the last C{last} consensuses, for display.
+        """
+        return {'uptime': self.uptime(fingerprint, last),
+                'present_in': self.present_in(fingerprint, last),
+                'longest_outage': self.longest_outage(fingerprint, last)}
+
+    def save(self, path):
+        """
+        Write the history to C{path}, replacing any previous file only once
+        the new one is complete. Each router's bits take C{window / 8}
+        bytes.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        size = (self.window + 7) // 8
+        temp_path = path + '.tmp'
+        with self._lock, open(temp_path, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, self.window, self.seq or 0,
+                                   len(self._bits)))
+            for key, bits in self._bits.items():
+                out.write(_RECORD.pack(key, self._ends[key],
+                                       self._first_seen[key]))
+                out.write(bits.to_bytes(size, 'little'))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a history written by L{save}.
+
+        @rtype: L{PresenceHistory}
+        @return: The history, or an empty one if C{path} is missing or is
+            not a presence file with the current window.
+        """
+        history = cls()
+        size = (history.window + 7) // 8
+        try:
+            with open(path, 'rb') as source:
+                magic, window, seq, count = _HEADER.unpack(
+                    source.read(_HEADER.size))
+                if magic != _MAGIC or window != history.window:
+                    logging.warning("Ignoring presence history in %s", path)
+                    return history
+                for i in range(count):
+                    key, end, first = _RECORD.unpack(
+                        source.read(_RECORD.size))
+                    history._bits[key] = int.from_bytes(source.read(size),
+                                                        'little')
+                    history._ends[key] = end
+                    history._first_seen[key] = first
+        except FileNotFoundError:
+            return history
+        except (OSError, struct.error) as exc:
+            logging.warning("Could not read presence history in %s: %s",
+                            path, exc)
+            return cls()
+        history.seq = seq or None
+        return history
+
+    def __len__(self):
+        return len(self._bits)
+
+
+_history = None
+_history_mtime = None
+_history_lock = threading.Lock()
+
+
+def get_history():
+    '''
+    Return the process-wide L{PresenceHistory}, loading it from
+    L{PRESENCE_FILE} on first use and again whenever another process has
+    saved a newer one.
+
+    @rtype: L{PresenceHistory}
+    @return: The shared history.
+    '''
+    global _history, _history_mtime
+    try:
+        mtime = os.stat(PRESENCE_FILE).st_mtime
+    except OSError:
+        mtime = None
+    with _history_lock:
+        if _history is None or \
+           (mtime is not None and mtime != _history_mtime):
+            _history = PresenceHistory.load(PRESENCE_FILE)
+            _history_mtime = mtime
+        return _history
+
+
+def save_history():
+    '''
+    Save the process-wide L{PresenceHistory} to L{PRESENCE_FILE}, without
+    making this process reload it.
+    '''
+    global _history_mtime
+    with _history_lock:
+        if _history is None:
+            return
+        _history.save(PRESENCE_FILE)
+        _history_mtime = os.stat(PRESENCE_FILE).st_mtime
@@ -0,0 +1,444 @@
+"""
+The search module answers the router searches on the subscribe page from an
+in-memory index of the relays in the current consensus, so a keystroke in
+the search box never reaches the database or the Tor controller.
+
+L{RouterNameIndex} keeps the relays' nicknames and fingerprints in sorted
+lists and answers prefix queries by bisection. L{TrigramIndex} answers
+fuzzy queries, for nicknames that are misremembered, from an inverted index
+of the three letter sequences in each nickname and fingerprint, ranking
+the relays by how many of the query's trigrams they share.
+
+The updaters save the fingerprint and nickname of each relay in a new
+consensus to L{ROUTERS_FILE} (see L{publish}). The process that answers the
+searches, the web server, builds its indexes from that file whenever it
+changes: the sorted lists are rebuilt, and the trigram index is changed
+only for the relays that differ from the previous list. Until the
+updaters have published a router list, the indexes are loaded from the
+L{Router} table instead, and reloaded once they are older than
+L{_MAX_AGE}.
+
+@type _MAX_RESULTS: int
+@var _MAX_RESULTS: Default number of suggestions returned for a query.
+
+@type _MAX_AGE: int
+@var _MAX_AGE: Seconds after which an index loaded from the database is
+    reloaded, one consensus period.
+
+@type _MIN_SIMILARITY: float
+@var _MIN_SIMILARITY: Lowest trigram similarity of a fuzzy match.
+
+@type _MAGIC: bytes
+@var _MAGIC: Marks the start of a router list file.
+
+@type _HEADER: struct.Struct
+@var _HEADER: Layout of the router list header: the magic bytes and the
+    number of relays.
+
+@type _RECORD: struct.Struct
+@var _RECORD: Layout of the fixed part of each relay's record in a router
+    list: its binary fingerprint and the length of its UTF-8 nickname, which
+    follows.
+
+@type ROUTERS_FILE: str
+@var ROUTERS_FILE: Where the updaters publish the relays in the latest
+    consensus.
+"""
+import bisect
+import logging
+import os
+import struct
+import threading
+import time
+
+from weatherapp import fingerprint as fp
+
+_MAX_RESULTS = 10
+_MAX_AGE = 3600
+_MIN_SIMILARITY = 0.25
+_MAGIC = b'TWR1'
+_HEADER = struct.Struct('<4sI')
+_RECORD = struct.Struct('<%dsB' % fp.BINARY_LEN)
+
+ROUTERS_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data', 'routers.dat')
+
+
+class RouterNameIndex:
+    '''
+    A sorted-array index of relay nicknames and fingerprints.
+
+    The index is replaced whole by L{build}, so readers always see one
+    consistent snapshot without taking a lock.
+
+    @type built: float
+    @ivar built: When the index was last built, as a C{time.time()} value,
+        or C{None} if it never was.
+
+    @type _snapshot: tuple
+    @ivar _snapshot: The lower-cased nicknames in sorted order, their
+        display forms, the fingerprints for each lower-cased nickname, and
+        the sorted fingerprints.
+    '''
+
+    def __init__(self):
+        self.built = None
+        self._snapshot = ([], [], {}, [])
+
+    def build(self, routers):
+        """
+        Replace the index with the routers in C{routers}.
+
+        @type routers: iterable of tuple (str, str)
+        @param routers: The fingerprint and nickname of each relay.
+        """
+        by_name = {}
+        display = {}
+        fingerprints = []
+        for fingerprint, name in routers:
+            key = name.lower()
+            by_name.setdefault(key, []).append(fingerprint)
+            display.setdefault(key, name)
+            fingerprints.append(fingerprint)
+        keys = sorted(by_name)
+        self._snapshot = (keys, [display[key] for key in keys], by_name,
+                          sorted(fingerprints))
+        self.built = time.time()
+
+    def names_with_prefix(self, prefix, limit = _MAX_RESULTS):
+        """
+        Find the nicknames that start with C{prefix}, ignoring case.
+
+        @type prefix: str
+        @param prefix: The start of a nickname.
+        @type limit: int
+        @param limit: The most nicknames to return.
+
+        @rtype: list [str]
+        @return: The matching nicknames in alphabetical order.
+        """
+        keys, names = self._snapshot[0], self._snapshot[1]
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_left(keys, prefix + '\uffff', start,
+                                 min(len(keys), start + limit))
+        return names[start:end]
+
+    def fingerprints_with_prefix(self, prefix, limit = _MAX_RESULTS):
+        """
+        Find the fingerprints that start with C{prefix}, which may contain
+        spaces and be in either case.
+
+        @rtype: list [str]
+        @return: The matching fingerprints in sorted order.
+        """
+        fingerprints = self._snapshot[3]
+        prefix = fp.normalize(prefix)
+        if not prefix:
+            return []
+        start = bisect.bisect_left(fingerprints, prefix)
+        end = bisect.bisect_left(fingerprints, prefix + 'Z', start,
+                                 min(len(fingerprints), start + limit))
+        return fingerprints[start:end]
+
+    def suggest(self, query, limit = _MAX_RESULTS):
+        """
+        Suggest completions for a search box entry: nicknames starting with
+        C{query}, then fingerprints starting with it.
+
+        @rtype: list [str]
+        @return: At most C{limit} suggestions.
+        """
+        suggestions = self.names_with_prefix(query, limit)
+        if len(suggestions) < limit:
+            suggestions += self.fingerprints_with_prefix(
+                query, limit - len(suggestions))
+        return suggestions
+
+    def fingerprints_for(self, name):
+        """
+        @rtype: list [str]
+        @return: The fingerprints of the relays with nickname C{name},
+            ignoring case.
+        """
+        return list(self._snapshot[2].get(name.lower(), []))
+
+    def __len__(self):
+        return len(self._snapshot[3])
+
+
+def _trigrams(text):
+    """
+    @rtype: set [str]
+    @return: The trigrams of C{text}, lower-cased and padded so that its
+        start and end count for more.
+    """
+    text = '  ' + text.lower() + ' '
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def _similarity(grams, other):
+    """
+    @rtype: float
+    @return: The Jaccard similarity of two sets of trigrams.
+    """
+    shared = len(grams & other)
+    return float(shared) / (len(grams) + len(other) - shared)
+
+
+class TrigramIndex:
+    '''
+    An inverted index from trigrams to the relays whose nickname or
+    fingerprint contains them.
+
+    A query reads only the postings of its own trigrams, and the relays
+    found there are ranked by the Jaccard similarity of the query's
+    trigrams and those of their nickname or fingerprint, whichever is the
+    closer match.
+
+    @type _postings: dict {str: set [str]}
+    @ivar _postings: The fingerprints of the relays with each trigram.
+    @type _routers: dict {str: tuple (str, set [str], set [str])}
+    @ivar _routers: The nickname of each indexed relay, and the trigrams
+        of its nickname and of its fingerprint.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._routers = {}
+
+    def build(self, routers):
+        """
+        Replace the index with the routers in C{routers}.
+
+        @type routers: iterable of tuple (str, str)
+        @param routers: The fingerprint and nickname of each relay.
+        """
+        with self._lock:
+            self._postings = {}
+            self._routers = {}
+            for fingerprint, name in routers:
+                self._add(fingerprint, name)
+
+    def _add(self, fingerprint, name):
+        self._remove(fingerprint)
+        name_grams = _trigrams(name)
+        fingerprint_grams = _trigrams(fingerprint)
+        self._routers[fingerprint] = (name, name_grams, fingerprint_grams)
+        for gram in name_grams | fingerprint_grams:
+            self._postings.setdefault(gram, set()).add(fingerprint)
+
+    def _remove(self, fingerprint):
+        entry = self._routers.pop(fingerprint, None)
+        if entry is None:
+            return
+        for gram in entry[1] | entry[2]:
+            posting = self._postings[gram]
+            posting.discard(fingerprint)
+            if not posting:
+                del self._postings[gram]
+
+    def add(self, fingerprint, name):
+        """
+        Index the relay C{fingerprint} under C{name}, replacing any entry
+        it already has.
+        """
+        with self._lock:
+            self._add(fingerprint, name)
+
+    def remove(self, fingerprint):
+        """
+        Drop the relay C{fingerprint} from the index, if present.
+        """
+        with self._lock:
+            self._remove(fingerprint)
+
+    def update(self, routers):
+        """
+        Bring the index in line with C{routers}, touching only the relays
+        that joined or left the consensus or changed nickname since the
+        last update.
+
+        @type routers: iterable of tuple (str, str)
+        @param routers: The fingerprint and nickname of each relay.
+        """
+        routers = dict(routers)
+        with self._lock:
+            for fingerprint in [fingerprint for fingerprint in self._routers
+                                if fingerprint not in routers]:
+                self._remove(fingerprint)
+            for fingerprint, name in routers.items():
+                entry = self._routers.get(fingerprint)
+                if entry is None or entry[0] != name:
+                    self._add(fingerprint, name)
+
+    def search(self, query, limit = _MAX_RESULTS):
+        """
+        Find the relays whose nickname or fingerprint is most like
+        C{query}.
+
+        @type query: str
+        @param query: A nickname or fingerprint, possibly misspelt.
+        @type limit: int
+        @param limit: The most relays to return.
+
+        @rtype: list [tuple (str, str, float)]
+        @return: For each match, best first: the nickname or fingerprint
+            that matched, the relay's fingerprint, and the similarity,
+            from L{_MIN_SIMILARITY} to 1.
+        """
+        query = query.strip()
+        if not query:
+            return []
+        query_grams = _trigrams(query)
+        matches = []
+        with self._lock:
+            candidates = set()
+            for gram in query_grams:
+                candidates.update(self._postings.get(gram, ()))
+            for fingerprint in candidates:
+                name, name_grams, fingerprint_grams = \
+                    self._routers[fingerprint]
+                match = name
+                similarity = _similarity(query_grams, name_grams)
+                by_fingerprint = _similarity(query_grams, fingerprint_grams)
+                if by_fingerprint > similarity:
+                    match, similarity = fingerprint, by_fingerprint
+                if similarity >= _MIN_SIMILARITY:
+                    matches.append((match, fingerprint, similarity))
+        matches.sort(key = lambda match: (-match[2], match[0].lower()))
+        return matches[:limit]
+
+    def __len__(self):
+        return len(self._routers)
+
+
+name_index = RouterNameIndex()
+trigram_index = TrigramIndex()
+_routers_mtime = None
+_load_lock = threading.Lock()
+
+
+def publish(state):
+    """
+    Save the fingerprint and nickname of each relay in a new consensus to
+    L{ROUTERS_FILE}, replacing any previous file only once the new one is
+    complete.
+
+    @type state: dict {str: L{RouterState}}
+    @param state: The current view of the network, from L{diff}.
+    """
+    directory = os.path.dirname(ROUTERS_FILE)
+    temp_path = ROUTERS_FILE + '.tmp'
+    try:
+        os.makedirs(directory, exist_ok = True)
+        with open(temp_path, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, len(state)))
+            for fingerprint, router_state in state.items():
+                name = router_state.name.encode('utf-8')[:255]
+                out.write(_RECORD.pack(fp.to_binary(fingerprint), len(name)))
+                out.write(name)
+        os.replace(temp_path, ROUTERS_FILE)
+    except OSError as exc:
+        logging.error("Could not save the router list: %s", exc)
+
+
+def _read_routers(path):
+    """
+    Read a router list written by L{publish}.
+
+    @rtype: list [tuple (str, str)]
+    @return: The fingerprint and nickname of each relay, or C{None} if
+        C{path} is missing or is not a router list.
+    """
+    try:
+        with open(path, 'rb') as source:
+            magic, count = _HEADER.unpack(source.read(_HEADER.size))
+            if magic != _MAGIC:
+                logging.warning("Ignoring router list in %s", path)
+                return None
+            routers = []
+            for i in range(count):
+                key, length = _RECORD.unpack(source.read(_RECORD.size))
+                routers.append((fp.from_binary(key),
+                                source.read(length).decode('utf-8',
+                                                           'replace')))
+    except FileNotFoundError:
+        return None
+    except (OSError, struct.error) as exc:
+        logging.warning("Could not read router list in %s: %s", path, exc)
+        return None
+    return routers
+
+
+def _ensure_loaded():
+    """
+    Load the process-wide indexes from L{ROUTERS_FILE} if the file changed
+    since it was last read. If the updaters have not published a router
+    list yet, load them from the L{Router} table with one query instead,
+    and again once that is older than L{_MAX_AGE} seconds.
+    """
+    global _routers_mtime
+    try:
+        mtime = os.stat(ROUTERS_FILE).st_mtime
+    except OSError:
+        mtime = None
+    if mtime is not None and mtime == _routers_mtime:
+        return
+    if mtime is None and name_index.built is not None and \
+       time.time() - name_index.built <= _MAX_AGE:
+        return
+    with _load_lock:
+        if mtime is not None and mtime == _routers_mtime:
+            return
+        routers = _read_routers(ROUTERS_FILE) if mtime is not None else None
+        if routers is None:
+            from weatherapp.models import Router
+            routers = list(Router.objects
+                           .filter(flags__hasflags = Router.UP)
+                           .values_list('fingerprint', 'name'))
+        trigram_index.update(routers)
+        name_index.build(routers)
+        _routers_mtime = mtime
+
+
+def get_name_index():
+    """
+    @rtype: L{RouterNameIndex}
+    @return: The process-wide prefix index, loaded if needed.
+    """
+    _ensure_loaded()
+    return name_index
+
+
+def get_trigram_index():
+    """
+    @rtype: L{TrigramIndex}
+    @return: The process-wide fuzzy index, loaded if needed.
+    """
+    _ensure_loaded()
+    return trigram_index
+
+
+def suggest(query, limit = _MAX_RESULTS):
+    """
+    Suggest relays for a search box entry: exact prefixes of nicknames and
+    fingerprints first, then fuzzy matches.
+
+    @rtype: list [str]
+    @return: At most C{limit} distinct nicknames or fingerprints.
+    """
+    suggestions = get_name_index().suggest(query, limit)
+    if len(suggestions) < limit:
+        seen = set(suggestion.lower() for suggestion in suggestions)
+        for match, fingerprint, similarity in \
+                get_trigram_index().search(query, limit):
+            if match.lower() not in seen:
+                seen.add(match.lower())
+                suggestions.append(match)
+            if len(suggestions) == limit:
+                break
+    return suggestions
@@ -0,0 +1,398 @@
+"""
+The synthetic module generates realistic Tor network data at any scale, for
+load testing and benchmarking Tor Weather without a live Tor network.
+
+A L{SyntheticNetwork} models N relays hour by hour: relays go down and come
+back (churn), join and leave for good, hibernate, drift in observed
+bandwidth and upgrade their Tor version. The exit policies are a realistic
+mix. Each hour can be written as a Tor DataDirectory style directory
+(C{cached-consensus} and C{cached-descriptors}), which
+L{CachedDataCtlUil} and the L{ctlsim} control-port simulator both read.
+L{populate_database} fills the L{Router}, L{Subscriber} and
+L{Subscription} tables at a configurable scale.
+
+Generate 24 hours of a 7,000 relay network with::
+
+    python -m weatherapp.synthetic --relays 7000 --hours 24 OUTDIR
+
+@type _VERSIONS: list [str]
+@var _VERSIONS: Tor versions relays run, oldest first. The consensus
+    recommends all but the oldest.
+
+@type _OBSOLETE_SHARE: float
+@var _OBSOLETE_SHARE: Share of new relays that run the oldest, no longer
+    recommended, version.
+
+@type _EXIT_POLICIES: list [tuple (str, float, list [str], str)]
+@var _EXIT_POLICIES: The exit policy mix: name, share of relays, policy
+    lines and the consensus policy summary.
+"""
+import argparse
+import base64
+import binascii
+import os
+import random
+from datetime import datetime, timedelta
+
+_VERSIONS = ['0.4.5.16', '0.4.7.16', '0.4.8.9', '0.4.8.12']
+_OBSOLETE_SHARE = 0.03
+
+_EXIT_POLICIES = [
+    ('reject', 0.70, ['reject *:*'], 'reject 1-65535'),
+    ('default', 0.08,
+     ['reject *:25', 'reject *:119', 'reject *:135-139', 'reject *:445',
+      'reject *:563', 'reject *:1214', 'reject *:4661-4666',
+      'reject *:6346-6429', 'reject *:6699', 'reject *:6881-6999',
+      'accept *:*'],
+     'reject 25,119,135-139,445,563,1214,4661-4666,6346-6429,6699,6881-6999'),
+    ('reduced', 0.17,
+     ['accept *:20-23', 'accept *:43', 'accept *:53', 'accept *:79-81',
+      'accept *:110', 'accept *:143', 'accept *:443', 'accept *:993',
+      'accept *:995', 'accept *:5222-5223', 'reject *:*'],
+     'accept 20-23,43,53,79-81,110,143,443,993,995,5222-5223'),
+    ('web', 0.05, ['accept *:80', 'accept *:443', 'reject *:*'],
+     'accept 80,443'),
+]
+
+_NAMES = ['Unnamed', 'default', 'relay', 'tor', 'torrelay', 'exit',
+          'middle', 'guard', 'node', 'freedom', 'privacy', 'onion']
+
+
+class SyntheticRelay:
+    '''
+    One relay of a L{SyntheticNetwork}.
+
+    @type fingerprint: str
+    @ivar fingerprint: The relay's 40 character hex fingerprint.
+    @type nickname: str
+    @ivar nickname: The relay's nickname.
+    @type address: str
+    @ivar address: The relay's IPv4 address.
+    @type bandwidth: int
+    @ivar bandwidth: Observed bandwidth in bytes per second.
+    @type version: str
+    @ivar version: The Tor version the relay runs.
+    @type policy: tuple
+    @ivar policy: The relay's entry in L{_EXIT_POLICIES}.
+    @type up: bool
+    @ivar up: Whether the relay is in the consensus.
+    @type hibernating: bool
+    @ivar hibernating: Whether the relay is hibernating.
+    @type up_since: datetime
+    @ivar up_since: When the relay last came up.
+    @type published: datetime
+    @ivar published: When the relay last published a descriptor.
+    '''
+
+    def __init__(self, rng, now):
+        self.fingerprint = '%040X' % rng.getrandbits(160)
+        name = rng.choice(_NAMES)
+        if name != 'Unnamed' and rng.random() < 0.8:
+            name += str(rng.randint(1, 9999))
+        self.nickname = name
+        self.address = '%d.%d.%d.%d' % (rng.randint(1, 223),
+                                        rng.randint(0, 255),
+                                        rng.randint(0, 255),
+                                        rng.randint(1, 254))
+        self.bandwidth = int(rng.lognormvariate(13, 1.5))
+        if rng.random() < _OBSOLETE_SHARE:
+            self.version = _VERSIONS[0]
+        else:
+            self.version = rng.choice(_VERSIONS[1:])
+        self.policy = _choose_policy(rng)
+        self.up = True
+        self.hibernating = False
+        self.up_since = now - timedelta(hours = rng.randint(0, 24 * 120))
+        self.published = now - timedelta(hours = rng.randint(0, 17))
+        self._digest = rng.getrandbits(160)
+
+    def flags(self, now):
+        """
+        @rtype: list [str]
+        @return: The relay's consensus flags.
+        """
+        flags = ['Running', 'Valid']
+        stable = now - self.up_since >= timedelta(days = 7)
+        if self.bandwidth >= 100 * 1024:
+            flags.append('Fast')
+        if stable:
+            flags.append('Stable')
+        if stable and self.bandwidth >= 2 * 1024 * 1024:
+            flags.append('Guard')
+        if self.policy[0] in ('default', 'web'):
+            flags.append('Exit')
+        return sorted(flags)
+
+    def consensus_entry(self, now):
+        """
+        @rtype: str
+        @return: The relay's router status entry.
+        """
+        identity = base64.b64encode(binascii.unhexlify(self.fingerprint))
+        digest = base64.b64encode(binascii.unhexlify('%040X' % self._digest))
+        return '\n'.join([
+            'r %s %s %s %s %s 9001 0' % (
+                self.nickname, identity.decode().rstrip('='),
+                digest.decode().rstrip('='),
+                self.published.strftime('%Y-%m-%d %H:%M:%S'), self.address),
+            's ' + ' '.join(self.flags(now)),
+            'v Tor ' + self.version,
+            'w Bandwidth=%d' % max(1, self.bandwidth // 1024),
+            'p ' + self.policy[3],
+        ])
+
+    def descriptor(self, now):
+        """
+        @rtype: str
+        @return: The relay's server descriptor, with the annotations Tor
+            writes to its cached-descriptors file.
+        """
+        spaced = ' '.join(self.fingerprint[i:i + 4] for i in range(0, 40, 4))
+        lines = [
+            '@downloaded-at %s' % now.strftime('%Y-%m-%d %H:%M:%S'),
+            '@source "127.0.0.1"',
+            'router %s %s 9001 0 0' % (self.nickname, self.address),
+            'platform Tor %s on Linux' % self.version,
+            'published %s' % self.published.strftime('%Y-%m-%d %H:%M:%S'),
+            'fingerprint %s' % spaced,
+            'uptime %d' % max(0, (now - self.up_since).total_seconds()),
+            'bandwidth %d %d %d' % (self.bandwidth * 2, self.bandwidth * 4,
+                                    self.bandwidth),
+        ]
+        if self.hibernating:
+            lines.append('hibernating 1')
+        lines.append('contact operator <%s AT example DOT org>' %
+                     self.nickname.lower())
+        lines.extend(self.policy[2])
+        lines.extend(['router-signature', '-----BEGIN SIGNATURE-----',
+                      'AAAA', '-----END SIGNATURE-----'])
+        return '\n'.join(lines)
+
+
+def _choose_policy(rng):
+    value = rng.random()
+    for policy in _EXIT_POLICIES:
+        value -= policy[1]
+        if value <= 0:
+            return policy
+    return _EXIT_POLICIES[0]
+
+
+class SyntheticNetwork:
+    '''
+    A synthetic Tor network that can be advanced one hour at a time.
+
+    @type relays: list [L{SyntheticRelay}]
+    @ivar relays: Every relay, up or down.
+    @type now: datetime
+    @ivar now: The valid-after time of the current consensus.
+    @type churn: float
+    @ivar churn: Hourly chance of an up relay going down, and of a down
+        relay coming back.
+    @type turnover: float
+    @ivar turnover: Hourly share of relays that leave for good and are
+        replaced by new ones.
+    @type hibernation: float
+    @ivar hibernation: Hourly chance of a relay starting to hibernate.
+    @type upgrade: float
+    @ivar upgrade: Hourly chance of a relay upgrading its Tor version.
+    '''
+
+    def __init__(self, relay_count, seed = None,
+                 start = datetime(2022, 1, 1), churn = 0.02,
+                 turnover = 0.002, hibernation = 0.002, upgrade = 0.003):
+        self._rng = random.Random(seed)
+        self.now = start
+        self.churn = churn
+        self.turnover = turnover
+        self.hibernation = hibernation
+        self.upgrade = upgrade
+        self.relays = [SyntheticRelay(self._rng, start)
+                       for _ in range(relay_count)]
+
+    def advance(self, hours = 1):
+        """
+        Move the network forward by C{hours} hours.
+        """
+        rng = self._rng
+        for _ in range(hours):
+            self.now += timedelta(hours = 1)
+            for relay in self.relays:
+                if relay.hibernating:
+                    if rng.random() < 0.1:
+                        relay.hibernating = False
+                        relay.up = True
+                        relay.published = self.now
+                elif relay.up:
+                    if rng.random() < self.hibernation:
+                        relay.hibernating = True
+                        relay.up = False
+                        relay.published = self.now
+                    elif rng.random() < self.churn:
+                        relay.up = False
+                elif rng.random() < self.churn * 5:
+                    relay.up = True
+                    relay.up_since = self.now
+                    relay.published = self.now
+
+                if relay.up and rng.random() < 1.0 / 18:
+                    relay.bandwidth = max(1024, int(relay.bandwidth *
+                                          rng.lognormvariate(0, 0.15)))
+                    relay.published = self.now
+                if rng.random() < self.upgrade:
+                    position = _VERSIONS.index(relay.version)
+                    if position + 1 < len(_VERSIONS):
+                        relay.version = _VERSIONS[position + 1]
+                        relay.published = self.now
+
+            leaving = int(len(self.relays) * self.turnover)
+            for _ in range(leaving):
+                self.relays.pop(rng.randrange(len(self.relays)))
+                self.relays.append(SyntheticRelay(rng, self.now))
+
+    def consensus(self):
+        """
+        @rtype: str
+        @return: The current consensus document.
+        """
+        header = [
+            'network-status-version 3',
+            'vote-status consensus',
+            'consensus-method 32',
+            'valid-after %s' % self.now.strftime('%Y-%m-%d %H:%M:%S'),
+            'fresh-until %s' % (self.now + timedelta(hours = 1)).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            'valid-until %s' % (self.now + timedelta(hours = 3)).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            'voting-delay 300 300',
+            'client-versions ' + ','.join(_VERSIONS[1:]),
+            'server-versions ' + ','.join(_VERSIONS[1:]),
+            'known-flags Exit Fast Guard Running Stable Valid',
+        ]
+        entries = [relay.consensus_entry(self.now) for relay in self.relays
+                   if relay.up]
+        return '\n'.join(header + entries + ['directory-footer', ''])
+
+    def descriptors(self):
+        """
+        @rtype: str
+        @return: The server descriptors of every relay that is up or
+            hibernating, as in Tor's cached-descriptors file.
+        """
+        return '\n'.join([relay.descriptor(self.now) for relay in self.relays
+                          if relay.up or relay.hibernating] + [''])
+
+    def write(self, path):
+        """
+        Write the current consensus and descriptors to C{path} as
+        C{cached-consensus} and C{cached-descriptors}.
+
+        @type path: str
+        @param path: The directory to write to; it is created if needed.
+        """
+        os.makedirs(path, exist_ok = True)
+        with open(os.path.join(path, 'cached-consensus'), 'w') as out:
+            out.write(self.consensus())
+        with open(os.path.join(path, 'cached-descriptors'), 'w') as out:
+            out.write(self.descriptors())
+
+
+def generate(path, relay_count, hours, seed = None, **kwargs):
+    """
+    Write C{hours} hourly snapshots of a synthetic network of
+    C{relay_count} relays, to the subdirectories C{0000}, C{0001}, ... of
+    C{path}.
+
+    @rtype: L{SyntheticNetwork}
+    @return: The network as of the last snapshot written.
+    """
+    network = SyntheticNetwork(relay_count, seed, **kwargs)
+    for hour in range(hours):
+        if hour:
+            network.advance()
+        network.write(os.path.join(path, '%04d' % hour))
+    return network
+
+
+def populate_database(network, subscriber_count, seed = None,
+                      batch_size = 1000):
+    """
+    Fill the L{Router}, L{Subscriber} and L{Subscription} tables from
+    C{network}. Every relay gets a L{Router} row, and C{subscriber_count}
+    confirmed subscribers are spread over random relays, each with a
+    node-down subscription and a random mix of the other types.
+
+    @type network: L{SyntheticNetwork}
+    @param network: The network to take the relays from.
+    @type subscriber_count: int
+    @param subscriber_count: The number of subscribers to create.
+    """
+    from django.db import transaction
+
+    with transaction.atomic():
+        _populate(network, subscriber_count, random.Random(seed), batch_size)
+
+
+def _populate(network, subscriber_count, rng, batch_size):
+    from weatherapp.models import BandwidthSub, NodeDownSub, Router, \
+        Subscriber, TShirtSub, VersionSub
+
+    Router.objects.bulk_create(
+        [Router(fingerprint = relay.fingerprint, name = relay.nickname,
+                up = relay.up, exit = relay.policy[0] != 'reject')
+         for relay in network.relays], batch_size = batch_size)
+    routers = list(Router.objects.values_list('id', flat = True))
+
+    for start in range(0, subscriber_count, batch_size):
+        count = min(batch_size, subscriber_count - start)
+        subscribers = Subscriber.objects.bulk_create(
+            [Subscriber(email = 'user%d@example.com' % (start + i),
+                        router_id = rng.choice(routers), confirmed = True,
+                        confirm_auth = '%024x' % rng.getrandbits(96),
+                        unsubs_auth = '%024x' % rng.getrandbits(96),
+                        pref_auth = '%024x' % rng.getrandbits(96))
+             for i in range(count)])
+        if subscribers and subscribers[0].pk is None:
+            # The backend does not return primary keys from bulk inserts.
+            subscribers = list(Subscriber.objects.order_by('-id')[:count])
+
+        # Multi-table subclasses can't be bulk created, so save them one
+        # at a time.
+        for subscriber in subscribers:
+            NodeDownSub(subscriber = subscriber,
+                        grace_pd = rng.choice([1, 1, 2, 6, 24])).save()
+            if rng.random() < 0.5:
+                VersionSub(subscriber = subscriber,
+                           notify_type = rng.choice(
+                               [VersionSub.UNRECOMMENDED,
+                                VersionSub.OBSOLETE])).save()
+            if rng.random() < 0.4:
+                BandwidthSub(subscriber = subscriber).save()
+            if rng.random() < 0.2:
+                TShirtSub(subscriber = subscriber).save()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Generate a synthetic Tor network for Tor Weather.')
+    parser.add_argument('path', help = 'directory to write snapshots to')
+    parser.add_argument('--relays', type = int, default = 7000)
+    parser.add_argument('--hours', type = int, default = 24)
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--subscribers', type = int, default = 0,
+                        help = 'also add this many subscribers to the '
+                               'database')
+    args = parser.parse_args()
+
+    network = generate(args.path, args.relays, args.hours, args.seed)
+    if args.subscribers:
+        import django
+
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                              'TorWeatherProject.settings')
+        django.setup()
+        populate_database(network, args.subscribers, args.seed)
+
+
+if __name__ == '__main__':
+    main()
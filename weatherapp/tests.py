@@ -1,3 +1,1048 @@
-from django.test import TestCase
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone as dt_timezone
 
-# Create your tests here.
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+try:
+    import stem
+except ImportError:
+    stem = None
+
+from weatherapp import diff, search, updaters
+from weatherapp.bandwidth import BandwidthHistory
+from weatherapp.fanout import SubscriptionIndex
+from weatherapp.known import FingerprintFilter
+from weatherapp import fingerprint as fp
+from weatherapp.models import BandwidthSub, NodeDownSub, Router, \
+    SubscribeForm, Subscriber, SubscriptionChange, TShirtSub, VersionSub, \
+    flags_match, get_rand_string
+from weatherapp.presence import PresenceHistory
+from weatherapp.search import RouterNameIndex, TrigramIndex
+from weatherapp.synthetic import SyntheticNetwork, populate_database
+
+FINGERPRINT = '0123456789ABCDEF0123456789ABCDEF01234567'
+OTHER_FINGERPRINT = 'FEDCBA9876543210FEDCBA9876543210FEDCBA98'
+SPACED_FINGERPRINT = ' '.join(FINGERPRINT.lower()[i:i + 4]
+                              for i in range(0, 40, 4))
+
+StatusEntry = collections.namedtuple('StatusEntry', ['nickname', 'flags'])
+Descriptor = collections.namedtuple('Descriptor',
+    ['observed_bandwidth', 'exit', 'version', 'hibernating'])
+
+
+class FakeCtlUtil:
+    """
+    Answers the L{CtlUil} calls the updaters make from a fixed consensus
+    and descriptor index, so they can be tested without Tor.
+    """
+
+    def __init__(self, consensus = None, descriptors = None,
+                 valid_after = datetime(2026, 1, 1, tzinfo = dt_timezone.utc)):
+        self.consensus = consensus or {}
+        self.descriptors = descriptors or {}
+        self.valid_after = valid_after
+
+    def get_consensus(self):
+        return self.consensus
+
+    def get_descriptors(self):
+        return self.descriptors
+
+    def get_valid_after(self):
+        return self.valid_after
+
+    def get_recommended_versions(self):
+        return []
+
+    def classify_version(self, version):
+        return 'recommended'
+
+
+def _state(name = 'moria1', flags = frozenset(['Running', 'Valid']),
+           bandwidth = 100, exit = False, version = None,
+           hibernating = False):
+    return diff.RouterState(name, flags, bandwidth, exit, version,
+                            hibernating)
+
+
+class DiffStatesTest(SimpleTestCase):
+    """Tests for L{diff.diff_states}."""
+
+    def test_unchanged(self):
+        self.assertEqual(diff.diff_states({FINGERPRINT: _state()},
+                                          {FINGERPRINT: _state()}), [])
+
+    def test_appeared_and_disappeared(self):
+        old = {FINGERPRINT: _state()}
+        new = {OTHER_FINGERPRINT: _state('tor26')}
+        changes = diff.diff_states(old, new)
+        self.assertEqual(changes, [
+            diff.RouterChange(diff.APPEARED, OTHER_FINGERPRINT, None,
+                              new[OTHER_FINGERPRINT]),
+            diff.RouterChange(diff.DISAPPEARED, FINGERPRINT,
+                              old[FINGERPRINT], None)])
+
+    def test_one_record_per_changed_field(self):
+        old = {FINGERPRINT: _state()}
+        new = {FINGERPRINT: _state(name = 'moria2', bandwidth = 50,
+                                   hibernating = True)}
+        changes = diff.diff_states(old, new)
+        self.assertEqual(set((change.kind, change.old, change.new)
+                             for change in changes),
+                         set([(diff.NAME_CHANGED, 'moria1', 'moria2'),
+                              (diff.BANDWIDTH_CHANGED, 100, 50),
+                              (diff.HIBERNATION_CHANGED, False, True)]))
+        self.assertEqual(diff.changed_fingerprints(changes),
+                         set([FINGERPRINT]))
+        self.assertEqual(diff.fingerprints_with(changes,
+                                                [diff.EXIT_CHANGED]), set())
+
+
+class FingerprintTest(SimpleTestCase):
+    """Tests for the L{fingerprint} codec."""
+
+    def test_normalize(self):
+        self.assertEqual(fp.normalize(SPACED_FINGERPRINT), FINGERPRINT)
+        self.assertTrue(fp.is_valid(SPACED_FINGERPRINT))
+
+    def test_is_valid(self):
+        self.assertFalse(fp.is_valid(FINGERPRINT[:-1]))
+        self.assertFalse(fp.is_valid(FINGERPRINT + '0'))
+        self.assertFalse(fp.is_valid('G' + FINGERPRINT[1:]))
+
+    def test_binary_round_trip(self):
+        binary = fp.to_binary(FINGERPRINT.lower())
+        self.assertEqual(len(binary), fp.BINARY_LEN)
+        self.assertEqual(fp.from_binary(binary), FINGERPRINT)
+
+    def test_to_binary_rejects_short_fingerprints(self):
+        self.assertRaises(ValueError, fp.to_binary, FINGERPRINT[:-2])
+
+
+class FingerprintFilterTest(SimpleTestCase):
+    """Tests for L{known.FingerprintFilter}."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'known.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_might_contain(self):
+        known = FingerprintFilter.build([FINGERPRINT])
+        self.assertTrue(known.might_contain(FINGERPRINT.lower()))
+        self.assertFalse(known.might_contain(OTHER_FINGERPRINT))
+        self.assertFalse(known.might_contain('not a fingerprint'))
+        self.assertEqual(len(known), 1)
+
+    def test_save_and_load(self):
+        FingerprintFilter.build([FINGERPRINT]).save(self.path)
+        known = FingerprintFilter.load(self.path)
+        self.assertTrue(FINGERPRINT in known)
+        self.assertFalse(OTHER_FINGERPRINT in known)
+        self.assertEqual(len(known), 1)
+
+    def test_load_missing_or_corrupt(self):
+        self.assertIsNone(FingerprintFilter.load(self.path))
+        with open(self.path, 'wb') as out:
+            out.write(b'junk')
+        self.assertIsNone(FingerprintFilter.load(self.path))
+
+
+class FlagsLookupTest(TestCase):
+    """
+    Tests for the C{hasflags} and C{lacksflags} lookups and
+    L{models.flags_match}.
+    """
+
+    def setUp(self):
+        Router.objects.create(fingerprint = FINGERPRINT, name = 'both',
+                              flags = Router.UP | Router.EXIT)
+        Router.objects.create(fingerprint = OTHER_FINGERPRINT, name = 'up',
+                              flags = Router.UP)
+
+    def names(self, **lookup):
+        return set(Router.objects.filter(**lookup)
+                   .values_list('name', flat = True))
+
+    def test_hasflags(self):
+        self.assertEqual(self.names(flags__hasflags = Router.UP),
+                         set(['both', 'up']))
+        self.assertEqual(
+            self.names(flags__hasflags = Router.UP | Router.EXIT),
+            set(['both']))
+
+    def test_lacksflags(self):
+        self.assertEqual(self.names(flags__lacksflags = Router.EXIT),
+                         set(['up']))
+        self.assertEqual(
+            self.names(flags__lacksflags = Router.UP | Router.EXIT), set())
+
+    def test_flags_match(self):
+        values = Router.objects.order_by('name').values_list('flags',
+                                                             flat = True)
+        self.assertEqual(flags_match(values, required = Router.UP),
+                         [True, True])
+        self.assertEqual(flags_match(values, Router.UP, Router.EXIT),
+                         [False, True])
+        self.assertEqual(flags_match(values, excluded = Router.EXIT),
+                         [False, True])
+
+
+class MergeDuplicatesMigrationTest(TransactionTestCase):
+    """Tests for the fingerprint clean-up in migration 0007."""
+
+    before = [('weatherapp', '0006_timezone_aware_defaults')]
+    after = [('weatherapp', '0007_router_fingerprint_unique')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph
+                     .leaf_nodes())
+
+    def test_merge_duplicates(self):
+        apps = self.migrate(self.before)
+        Router = apps.get_model('weatherapp', 'Router')
+        Subscriber = apps.get_model('weatherapp', 'Subscriber')
+        kept = Router.objects.create(fingerprint = SPACED_FINGERPRINT)
+        duplicate = Router.objects.create(fingerprint = FINGERPRINT)
+        Subscriber.objects.create(email = 'op@example.com',
+                                  router = duplicate, confirm_auth = 'a',
+                                  unsubs_auth = 'b', pref_auth = 'c')
+
+        apps = self.migrate(self.after)
+        Router = apps.get_model('weatherapp', 'Router')
+        Subscriber = apps.get_model('weatherapp', 'Subscriber')
+        self.assertEqual(
+            list(Router.objects.values_list('pk', 'fingerprint')),
+            [(kept.pk, FINGERPRINT)])
+        self.assertEqual(Subscriber.objects.get().router_id, kept.pk)
+
+
+class SyntheticDatabaseTest(TestCase):
+    """Tests for L{synthetic.populate_database}."""
+
+    def test_get_rand_string(self):
+        auth = get_rand_string()
+        self.assertIsInstance(auth, str)
+        self.assertEqual(len(auth), 24)
+        self.assertFalse(auth.endswith('-'))
+
+    def test_populate_database(self):
+        network = SyntheticNetwork(50, seed = 1)
+        populate_database(network, 20, seed = 1)
+        self.assertEqual(Router.objects.count(), 50)
+        self.assertEqual(Subscriber.objects.count(), 20)
+        self.assertEqual(NodeDownSub.objects.count(), 20)
+
+
+class UpdateRoutersTest(TestCase):
+    """Tests for L{updaters.update_routers} and L{updaters.run_all}."""
+
+    def setUp(self):
+        updaters._previous_state = None
+        updaters._previous_time = None
+
+    def tearDown(self):
+        updaters._previous_state = None
+        updaters._previous_time = None
+
+    def test_first_update(self):
+        ctl_util = FakeCtlUtil({FINGERPRINT: StatusEntry('moria1',
+                                                         ['Running'])})
+        changes = updaters.update_routers(ctl_util)
+        self.assertEqual([change.kind for change in changes],
+                         [diff.APPEARED])
+        router = Router.objects.get(fingerprint = FINGERPRINT)
+        self.assertEqual(router.name, 'moria1')
+        self.assertTrue(router.up)
+
+    @unittest.skipUnless(getattr(connection.features,
+                                 'supports_update_conflicts_with_target',
+                                 False), 'the database cannot upsert')
+    def test_new_routers_are_upserted(self):
+        Router.objects.create(fingerprint = FINGERPRINT, name = 'old',
+                              flags = 0)
+        updaters._write_routers([], [Router(fingerprint = FINGERPRINT,
+                                            name = 'moria1',
+                                            flags = Router.UP)])
+        router = Router.objects.get()
+        self.assertEqual(router.name, 'moria1')
+        self.assertTrue(router.up)
+
+    def test_empty_consensus_is_ignored(self):
+        Router.objects.create(fingerprint = FINGERPRINT, name = 'moria1')
+        self.assertIsNone(updaters.update_routers(FakeCtlUtil()))
+        self.assertIsNone(updaters.run_all(FakeCtlUtil()))
+        self.assertTrue(Router.objects.get().up)
+        self.assertIsNone(updaters._previous_state)
+
+
+class FakeController:
+    """A Stem controller that only tracks its event listeners."""
+
+    def __init__(self):
+        self.alive = True
+        self.listeners = []
+
+    def is_alive(self):
+        return self.alive
+
+    def add_event_listener(self, listener, *events):
+        self.listeners.append(listener)
+
+    def remove_event_listener(self, listener):
+        self.listeners.remove(listener)
+
+
+class ListenerCtlUtil:
+    """A L{CtlUil} whose refreshes return or raise what a test sets."""
+
+    def __init__(self):
+        self.control = FakeController()
+        self.consensus_result = True
+        self.descriptors_result = False
+
+    def refresh_consensus(self):
+        if isinstance(self.consensus_result, Exception):
+            raise self.consensus_result
+        return self.consensus_result
+
+    def refresh_descriptors(self):
+        return self.descriptors_result
+
+    def reconnect(self):
+        self.control = FakeController()
+
+
+@unittest.skipIf(stem is None, 'stem is not installed')
+class ListenerTest(SimpleTestCase):
+    """Tests for L{listener.Listener}."""
+
+    def setUp(self):
+        from weatherapp.listener import Listener
+
+        self.runs = []
+        self.ctl_util = ListenerCtlUtil()
+        self.listener = Listener(self.ctl_util, self.runs.append)
+
+    def test_failed_batch_is_logged(self):
+        self.ctl_util.consensus_result = ValueError('broken')
+        self.listener._new_consensus = True
+        with self.assertLogs(level = 'ERROR'):
+            self.listener.process_pending()
+        self.assertEqual(self.runs, [])
+
+    def test_unchanged_descriptors_do_not_run(self):
+        self.listener._new_desc_since = 0
+        self.listener.process_pending()
+        self.assertEqual(self.runs, [])
+        self.ctl_util.descriptors_result = True
+        self.listener._new_desc_since = 0
+        self.listener.process_pending()
+        self.assertEqual(self.runs, [self.ctl_util])
+
+    def test_reconnect(self):
+        self.ctl_util.control.alive = False
+        self.assertTrue(self.listener.check_connection())
+        self.assertEqual(self.ctl_util.control.listeners,
+                         [self.listener._handle_event])
+        self.assertTrue(self.listener._new_consensus)
+
+
+@unittest.skipIf(stem is None, 'stem is not installed')
+class ExitPolicyCacheTest(SimpleTestCase):
+    """Tests for L{ctlutil.ExitPolicyCache}."""
+
+    def setUp(self):
+        from weatherapp.ctlutil import ExitPolicyCache
+
+        self.cache = ExitPolicyCache(max_size = 2)
+
+    def policy(self, *rules):
+        from stem.exit_policy import ExitPolicy
+
+        return ExitPolicy(*rules)
+
+    def test_address_rejects_share_a_digest(self):
+        first = self.cache.digest(self.policy(
+            'reject 1.2.3.4:*', 'reject 10.0.0.0/8:*', 'accept *:80',
+            'reject *:*'))
+        second = self.cache.digest(self.policy(
+            'reject 5.6.7.8:*', 'accept *:80', 'reject *:*'))
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.can_exit_to(first, [80, 443]),
+                         {80: True, 443: False})
+        self.assertNotEqual(first,
+                            self.cache.digest(self.policy('reject *:*')))
+
+    def test_least_recently_used_is_dropped(self):
+        first = self.cache.digest(self.policy('reject *:*'))
+        self.cache.digest(self.policy('accept *:80', 'reject *:*'))
+        self.cache.digest(self.policy('accept *:443', 'reject *:*'))
+        self.assertIsNone(self.cache.can_exit_to(first, [80]))
+
+
+class PoolController:
+    """A Stem controller whose authentication can be made to fail."""
+
+    def __init__(self, alive = True, auth_error = None):
+        self.alive = alive
+        self.auth_error = auth_error
+        self.closed = False
+
+    def is_alive(self):
+        return self.alive and not self.closed
+
+    def is_authenticated(self):
+        return self.alive
+
+    def authenticate(self, authenticator):
+        if self.auth_error:
+            raise self.auth_error
+
+    def reconnect(self, authenticator):
+        self.authenticate(authenticator)
+        self.alive = True
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(stem is None, 'stem is not installed')
+class ControllerPoolTest(SimpleTestCase):
+    """Tests for L{ctlutil.ControllerPool}."""
+
+    def setUp(self):
+        import stem.connection
+        from weatherapp.ctlutil import ControllerPool
+
+        self.auth_error = stem.connection.AuthenticationFailure('denied')
+        self.pool = ControllerPool('127.0.0.1', 9051, None, max_size = 1)
+
+    def test_reuses_idle_connections(self):
+        control = PoolController()
+        self.pool._idle.append(control)
+        self.assertIs(self.pool.acquire(timeout = 0), control)
+        self.pool.release(control)
+        self.assertEqual(self.pool._idle, [control])
+
+    def test_failed_reauthentication_is_discarded(self):
+        stale = PoolController(alive = False, auth_error = self.auth_error)
+        fresh = PoolController()
+        self.pool._idle.append(stale)
+        with mock.patch('weatherapp.ctlutil.Controller.from_port',
+                        return_value = fresh):
+            self.assertIs(self.pool.acquire(timeout = 0), fresh)
+        self.assertTrue(stale.closed)
+
+    def test_failed_authentication_closes_and_frees_the_slot(self):
+        refused = PoolController(auth_error = self.auth_error)
+        with mock.patch('weatherapp.ctlutil.Controller.from_port',
+                        return_value = refused):
+            self.assertRaises(type(self.auth_error), self.pool.acquire,
+                              timeout = 0)
+        self.assertTrue(refused.closed)
+        fresh = PoolController()
+        with mock.patch('weatherapp.ctlutil.Controller.from_port',
+                        return_value = fresh):
+            self.assertIs(self.pool.acquire(timeout = 0), fresh)
+
+
+@unittest.skipIf(stem is None, 'stem is not installed')
+class CachedDataCtlUilTest(SimpleTestCase):
+    """Tests for L{ctlutil.CachedDataCtlUil}."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reads_the_cached_files(self):
+        from weatherapp.ctlutil import CachedDataCtlUil
+
+        network = SyntheticNetwork(20, seed = 2)
+        network.write(self.directory)
+        ctl_util = CachedDataCtlUil(self.directory)
+        self.assertTrue(ctl_util.refresh_consensus())
+        self.assertEqual(len(ctl_util.get_consensus()), 20)
+        self.assertEqual(len(ctl_util.get_descriptors()), 20)
+        relay = network.relays[0]
+        self.assertTrue(ctl_util.is_up(relay.fingerprint))
+        self.assertEqual(ctl_util.is_exit(relay.fingerprint),
+                         relay.policy[0] != 'reject')
+
+    def test_missing_consensus_is_a_failed_load(self):
+        from weatherapp.ctlutil import CachedDataCtlUil
+
+        ctl_util = CachedDataCtlUil(self.directory)
+        with self.assertLogs(level = 'ERROR'):
+            self.assertFalse(ctl_util.refresh_consensus())
+        self.assertEqual(ctl_util.get_consensus(), {})
+
+
+class SubscriptionIndexTest(TestCase):
+    """Tests for L{fanout.SubscriptionIndex}."""
+
+    def setUp(self):
+        self.router = Router.objects.create(fingerprint = FINGERPRINT)
+        self.index = SubscriptionIndex()
+
+    def subscribe(self, confirmed = True):
+        with self.captureOnCommitCallbacks(execute = True):
+            subscriber = Subscriber.objects.create(
+                email = 'op@example.com', router = self.router,
+                confirmed = confirmed)
+            sub = NodeDownSub.objects.create(subscriber = subscriber)
+        return subscriber, sub
+
+    def test_build(self):
+        subscriber, sub = self.subscribe()
+        self.subscribe(confirmed = False)
+        self.index.build()
+        self.assertEqual(self.index.subscriptions_for([FINGERPRINT]),
+                         set([sub.pk]))
+        self.assertEqual(self.index.take_added(), {})
+        self.assertFalse(SubscriptionChange.objects.exists())
+
+    def test_update_applies_recorded_changes(self):
+        self.index.build()
+        subscriber, sub = self.subscribe()
+        self.index.update()
+        self.assertEqual(self.index.subscriptions_for([FINGERPRINT],
+                                                      'node_down'),
+                         set([sub.pk]))
+        self.assertEqual(self.index.take_added(), {sub.pk: 'node_down'})
+        self.assertFalse(SubscriptionChange.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute = True):
+            subscriber.delete()
+        self.index.update()
+        self.assertEqual(self.index.subscriptions_for([FINGERPRINT]), set())
+        self.assertEqual(self.index.fingerprints(), set())
+
+    def test_confirmation(self):
+        self.index.build()
+        subscriber, sub = self.subscribe(confirmed = False)
+        self.index.update()
+        self.assertEqual(len(self.index), 0)
+        subscriber.confirmed = True
+        with self.captureOnCommitCallbacks(execute = True):
+            subscriber.save()
+        self.index.update()
+        self.assertEqual(self.index.subscriptions_for([FINGERPRINT]),
+                         set([sub.pk]))
+
+
+@unittest.skipIf(stem is None, 'stem is not installed')
+class BenchmarkTest(TestCase):
+    """A smoke test of L{benchmarks.run_cycle}."""
+
+    def setUp(self):
+        from weatherapp import bandwidth, known, presence
+        from weatherapp.fanout import subscription_index
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # run_cycle points these module globals at its scratch directory.
+        patched = [(bandwidth, 'HISTORY_FILE'), (bandwidth, '_history'),
+                   (presence, 'PRESENCE_FILE'), (presence, '_history'),
+                   (presence, '_history_mtime'), (known, 'FILTER_FILE'),
+                   (known, '_filter'), (known, '_filter_mtime'),
+                   (updaters, '_previous_state'),
+                   (updaters, '_previous_time'),
+                   (updaters, '_previous_recommended')]
+        for module, name in patched:
+            patcher = mock.patch.object(module, name, getattr(module, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(subscription_index.__init__)
+
+    def test_run_cycle(self):
+        from weatherapp.benchmarks import run_cycle
+
+        stages, email_count = run_cycle(30, 10, self.directory, seed = 1)
+        self.assertIn('subscription_index', stages)
+        self.assertIn('router_upsert_diff', stages)
+        self.assertIn('email_dispatch', stages)
+        self.assertTrue(all(seconds >= 0 for seconds in stages.values()))
+        self.assertGreaterEqual(email_count, 0)
+        self.assertEqual(Router.objects.count(), 30)
+
+
+class CheckNodeDownTest(TestCase):
+    """Tests for L{updaters.check_node_down}."""
+
+    def setUp(self):
+        patcher = mock.patch('weatherapp.presence.get_history',
+                             return_value = PresenceHistory())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.went_down = datetime(2026, 1, 1, tzinfo = dt_timezone.utc)
+
+    def subscribe(self, fingerprint, **fields):
+        router = Router.objects.create(fingerprint = fingerprint, flags = 0,
+                                       last_seen = self.went_down)
+        subscriber = Subscriber.objects.create(email = 'op@example.com',
+            router = router, confirmed = True)
+        return NodeDownSub.objects.create(subscriber = subscriber,
+                                          grace_pd = 2, **fields)
+
+    def test_down_routers_are_scheduled(self):
+        down = self.subscribe(FINGERPRINT)
+        hibernating = self.subscribe(OTHER_FINGERPRINT)
+        ctl_util = FakeCtlUtil(descriptors = {
+            OTHER_FINGERPRINT: Descriptor(100, False, None, True)})
+        email_list = []
+        updaters.check_node_down(ctl_util, email_list)
+
+        # The grace period has long passed, so the email is sent at once.
+        self.assertEqual(len(email_list), 1)
+        down.refresh_from_db()
+        self.assertTrue(down.triggered)
+        self.assertTrue(down.emailed)
+        self.assertIsNone(down.due)
+        hibernating.refresh_from_db()
+        self.assertFalse(hibernating.triggered)
+
+        updaters.check_node_down(ctl_util, email_list)
+        self.assertEqual(len(email_list), 1)
+
+    def test_grace_period(self):
+        self.went_down = timezone.now()
+        sub = self.subscribe(FINGERPRINT)
+        email_list = []
+        updaters.check_node_down(FakeCtlUtil(), email_list)
+        sub.refresh_from_db()
+        self.assertTrue(sub.triggered)
+        self.assertEqual(sub.due, self.went_down + timedelta(hours = 2))
+        self.assertEqual(email_list, [])
+
+    def test_routers_back_up_are_cancelled(self):
+        sub = self.subscribe(FINGERPRINT, triggered = True,
+            due = timezone.now() + timedelta(hours = 1))
+        Router.objects.update(flags = Router.UP)
+        email_list = []
+        updaters.check_node_down(FakeCtlUtil(), email_list)
+        sub.refresh_from_db()
+        self.assertFalse(sub.triggered)
+        self.assertIsNone(sub.due)
+        self.assertEqual(email_list, [])
+
+
+class BandwidthHistoryTest(SimpleTestCase):
+    """Tests for L{bandwidth.BandwidthHistory}."""
+
+    def test_recent_max(self):
+        history = BandwidthHistory(slots = 4)
+        for seq, value in enumerate([50, 10, 15, 12, 8]):
+            self.assertTrue(history.record(seq, {FINGERPRINT: value}))
+        self.assertFalse(history.record(4, {FINGERPRINT: 100}))
+        self.assertEqual(history.recent_max([FINGERPRINT], 3),
+                         {FINGERPRINT: 15})
+        # The first sample has been overwritten.
+        self.assertEqual(history.recent_max([FINGERPRINT], 4),
+                         {FINGERPRINT: 15})
+        self.assertEqual(history.recent_max([FINGERPRINT], 5), {})
+
+    def test_down_routers_are_cleared(self):
+        history = BandwidthHistory(slots = 4)
+        history.record(0, {FINGERPRINT: 10, OTHER_FINGERPRINT: 10})
+        history.record(1, {OTHER_FINGERPRINT: 10})
+        history.record(2, {FINGERPRINT: 30, OTHER_FINGERPRINT: 10})
+        self.assertEqual(history.recent_max([FINGERPRINT, OTHER_FINGERPRINT],
+                                            2), {OTHER_FINGERPRINT: 10})
+        self.assertEqual(history.recent_max([FINGERPRINT], 1),
+                         {FINGERPRINT: 30})
+
+    def test_retain(self):
+        history = BandwidthHistory(slots = 4)
+        history.record(0, {FINGERPRINT: 10, OTHER_FINGERPRINT: 20})
+        history.retain([OTHER_FINGERPRINT])
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history.recent_max([OTHER_FINGERPRINT], 1),
+                         {OTHER_FINGERPRINT: 20})
+
+    def test_save_and_load(self):
+        history = BandwidthHistory()
+        for seq in range(3):
+            history.record(seq, {FINGERPRINT: 10 + seq})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bandwidth.dat')
+            history.save(path)
+            loaded = BandwidthHistory.load(path)
+        self.assertEqual(loaded.seq, 2)
+        self.assertEqual(loaded.recent_max([FINGERPRINT], 3),
+                         {FINGERPRINT: 12})
+        self.assertFalse(loaded.record(2, {FINGERPRINT: 99}))
+
+
+class PresenceHistoryTest(SimpleTestCase):
+    """Tests for L{presence.PresenceHistory}."""
+
+    def test_stats(self):
+        history = PresenceHistory(window = 8)
+        for seq in range(6):
+            present = [OTHER_FINGERPRINT]
+            if seq not in (2, 3):
+                present.append(FINGERPRINT)
+            history.record(seq, present)
+        self.assertEqual(history.stats(FINGERPRINT),
+                         {'uptime': 4 / 6, 'present_in': 4,
+                          'longest_outage': 2})
+        self.assertEqual(history.present_in(FINGERPRINT, 2), 2)
+        self.assertEqual(history.uptime(OTHER_FINGERPRINT), 1.0)
+        self.assertEqual(history.uptime(
+            '1111111111111111111111111111111111111111'), 0.0)
+
+    def test_absent_routers_are_dropped(self):
+        history = PresenceHistory(window = 4)
+        history.record(0, [FINGERPRINT, OTHER_FINGERPRINT])
+        for seq in range(1, 4):
+            history.record(seq, [OTHER_FINGERPRINT])
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history.seen_within(), [FINGERPRINT,
+                                                 OTHER_FINGERPRINT])
+        self.assertEqual(history.seen_within(3), [OTHER_FINGERPRINT])
+        history.record(4, [OTHER_FINGERPRINT])
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history.present_in(FINGERPRINT), 0)
+
+    def test_save_and_load(self):
+        history = PresenceHistory()
+        history.record(10, [FINGERPRINT])
+        history.record(12, [FINGERPRINT, OTHER_FINGERPRINT])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'presence.dat')
+            history.save(path)
+            loaded = PresenceHistory.load(path)
+        self.assertEqual(loaded.seq, 12)
+        self.assertEqual(loaded.stats(FINGERPRINT), history.stats(FINGERPRINT))
+        self.assertEqual(loaded.present_in(OTHER_FINGERPRINT), 1)
+
+
+class SubscribeFormTest(TestCase):
+    """Tests for L{models.SubscribeForm}."""
+
+    def setUp(self):
+        Router.objects.create(fingerprint = FINGERPRINT, name = 'moria1')
+        patcher = mock.patch('weatherapp.known.get_filter',
+                             return_value = None)
+        self.get_filter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def form(self, fingerprint):
+        return SubscribeForm({'email_1': 'op@example.com',
+                              'email_2': 'op@example.com',
+                              'fingerprint': fingerprint})
+
+    def test_valid(self):
+        form = self.form(SPACED_FINGERPRINT)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['fingerprint'], FINGERPRINT)
+        self.assertEqual(form.router.name, 'moria1')
+
+    def test_malformed_fingerprint(self):
+        form = self.form(FINGERPRINT[:-1])
+        self.assertFalse(form.is_valid())
+        self.assertTrue(form.has_error('fingerprint', 'invalid'))
+
+    def test_unknown_fingerprint(self):
+        form = self.form(OTHER_FINGERPRINT)
+        self.assertFalse(form.is_valid())
+        self.assertTrue(form.has_error('fingerprint', SubscribeForm.NOT_FOUND))
+
+    def test_filter_rejects_without_a_query(self):
+        self.get_filter.return_value = FingerprintFilter.build([FINGERPRINT])
+        form = self.form(OTHER_FINGERPRINT)
+        with self.assertNumQueries(0):
+            self.assertFalse(form.is_valid())
+        self.assertTrue(form.has_error('fingerprint', SubscribeForm.NOT_FOUND))
+        self.assertTrue(self.form(FINGERPRINT).is_valid())
+
+
+class SubscribeViewTest(TestCase):
+    """Tests for L{views.subscribe}."""
+
+    def setUp(self):
+        Router.objects.create(fingerprint = FINGERPRINT, name = 'moria1')
+        patcher = mock.patch('weatherapp.known.get_filter',
+                             return_value = None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, fingerprint, email_2 = 'op@example.com'):
+        return self.client.post('/subscribe/', {'email_1': 'op@example.com',
+                                                'email_2': email_2,
+                                                'fingerprint': fingerprint})
+
+    def test_form(self):
+        self.assertTemplateUsed(self.client.get('/subscribe/'),
+                                'subscribe.html')
+
+    def test_unknown_fingerprint(self):
+        response = self.post(OTHER_FINGERPRINT)
+        self.assertTemplateUsed(response, 'fingerprint_not_found.html')
+
+    def test_invalid_form_is_redisplayed(self):
+        response = self.post(FINGERPRINT, email_2 = 'other@example.com')
+        self.assertTemplateUsed(response, 'subscribe.html')
+        self.assertTrue(response.context['form'].errors)
+
+    def test_valid_form_is_not_stored(self):
+        response = self.post(FINGERPRINT)
+        self.assertTemplateUsed(response, 'error.html')
+        self.assertFalse(Subscriber.objects.exists())
+
+
+ROUTERS = [(FINGERPRINT, 'moria1'), (OTHER_FINGERPRINT, 'moria2'),
+           ('1111111111111111111111111111111111111111', 'tor26'),
+           ('2222222222222222222222222222222222222222', 'Tor26')]
+
+
+class RouterNameIndexTest(SimpleTestCase):
+    """Tests for L{search.RouterNameIndex}."""
+
+    def setUp(self):
+        self.index = RouterNameIndex()
+        self.index.build(ROUTERS)
+
+    def test_names_with_prefix(self):
+        self.assertEqual(self.index.names_with_prefix('MOR'),
+                         ['moria1', 'moria2'])
+        self.assertEqual(self.index.names_with_prefix('mor', 1), ['moria1'])
+        self.assertEqual(self.index.names_with_prefix(''), [])
+        self.assertEqual(self.index.names_with_prefix('x'), [])
+
+    def test_fingerprints(self):
+        self.assertEqual(self.index.fingerprints_with_prefix('0123 45'),
+                         [FINGERPRINT])
+        self.assertEqual(sorted(self.index.fingerprints_for('TOR26')),
+                         ['1111111111111111111111111111111111111111',
+                          '2222222222222222222222222222222222222222'])
+        self.assertEqual(len(self.index), 4)
+
+    def test_suggest(self):
+        self.assertEqual(self.index.suggest('fed'), [OTHER_FINGERPRINT])
+        self.assertEqual(self.index.suggest('tor'), ['tor26'])
+
+
+class RouterLookupViewTest(TestCase):
+    """
+    Tests for L{views.router_name_lookup} and
+    L{views.router_fingerprint_lookup}, answered from the L{Router} table
+    since no router list has been published.
+    """
+
+    def setUp(self):
+        for fingerprint, name in ROUTERS:
+            Router.objects.create(fingerprint = fingerprint, name = name)
+        Router.objects.create(fingerprint = '3' * 40, name = 'gone',
+                              flags = 0)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, value in (('ROUTERS_FILE',
+                             os.path.join(directory, 'routers.dat')),
+                            ('name_index', RouterNameIndex()),
+                            ('trigram_index', TrigramIndex())):
+            patcher = mock.patch.object(search, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def lookup(self, view, query):
+        response = self.client.get('/%s/' % view, {'query': query})
+        return response.json()
+
+    def test_router_name_lookup(self):
+        self.assertEqual(self.lookup('router_name_lookup', 'mor')[:2],
+                         ['moria1', 'moria2'])
+        self.assertEqual(self.lookup('router_name_lookup', 'gon'), [])
+
+    def test_router_fingerprint_lookup(self):
+        view = 'router_fingerprint_lookup'
+        self.assertEqual(self.lookup(view, 'moria1'), FINGERPRINT)
+        self.assertEqual(self.lookup(view, 'FEDC'), OTHER_FINGERPRINT)
+        self.assertEqual(self.lookup(view, 'tor26'), 'nonunique_name')
+        self.assertEqual(self.lookup(view, 'gone'), 'no_router')
+
+
+class TrigramIndexTest(SimpleTestCase):
+    """Tests for L{search.TrigramIndex}."""
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        self.index.build(ROUTERS)
+
+    def test_search(self):
+        matches = self.index.search('moira1')
+        self.assertEqual(matches[0][:2], ('moria1', FINGERPRINT))
+        self.assertTrue(all(0.25 <= similarity <= 1
+                            for match, fingerprint, similarity in matches))
+        self.assertEqual(self.index.search('moria2', 1)[0][2], 1.0)
+        self.assertEqual(self.index.search('FEDCBA98765')[0][1],
+                         OTHER_FINGERPRINT)
+        self.assertEqual(self.index.search('zzzz'), [])
+        self.assertEqual(self.index.search('  '), [])
+
+    def test_update(self):
+        self.index.update([(FINGERPRINT, 'renamed'),
+                           (OTHER_FINGERPRINT, 'moria2')])
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.search('tor26'), [])
+        self.assertEqual(self.index.search('moria1')[0][0], 'moria2')
+        self.assertEqual(self.index.search('renamed')[0][1], FINGERPRINT)
+        # Trigrams left with no relays are dropped.
+        self.assertNotIn('tor', self.index._postings)
+
+    def test_add_and_remove(self):
+        self.index.add(FINGERPRINT, 'bigrelay')
+        self.assertEqual(self.index.search('bigrelay')[0][1], FINGERPRINT)
+        self.index.remove(FINGERPRINT)
+        self.index.remove(FINGERPRINT)
+        self.assertEqual(self.index.search('bigrelay'), [])
+        self.assertEqual(len(self.index), 3)
+
+
+def _subscribe(model, fingerprint, router_flags = Router.UP, **fields):
+    """Add a confirmed subscriber with a C{model} subscription."""
+    router = Router.objects.create(fingerprint = fingerprint,
+                                   flags = router_flags)
+    subscriber = Subscriber.objects.create(email = 'op@example.com',
+                                           router = router, confirmed = True)
+    return model.objects.create(subscriber = subscriber, **fields)
+
+
+class CheckLowBandwidthTest(TestCase):
+    """Tests for L{updaters.check_low_bandwidth}."""
+
+    def setUp(self):
+        self.history = BandwidthHistory()
+        patcher = mock.patch('weatherapp.bandwidth.get_history',
+                             return_value = self.history)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.low = _subscribe(BandwidthSub, FINGERPRINT, threshold = 20)
+        self.high = _subscribe(BandwidthSub, OTHER_FINGERPRINT,
+                               threshold = 20)
+        for seq in range(BandwidthSub._HOURS_BELOW):
+            self.history.record(seq, {FINGERPRINT: 10,
+                                      OTHER_FINGERPRINT: 10 + seq})
+
+    def test_sustained_low_bandwidth(self):
+        email_list = []
+        updaters.check_low_bandwidth(FakeCtlUtil(), email_list)
+        self.assertEqual(len(email_list), 1)
+        self.low.refresh_from_db()
+        self.assertTrue(self.low.triggered)
+        self.assertTrue(self.low.emailed)
+        self.high.refresh_from_db()
+        self.assertFalse(self.high.triggered)
+
+        updaters.check_low_bandwidth(FakeCtlUtil(), email_list)
+        self.assertEqual(len(email_list), 1)
+
+    def test_reset_once_above_threshold(self):
+        updaters.check_low_bandwidth(FakeCtlUtil(), [])
+        self.history.record(BandwidthSub._HOURS_BELOW, {FINGERPRINT: 30})
+        updaters.check_low_bandwidth(FakeCtlUtil(), [])
+        self.low.refresh_from_db()
+        self.assertFalse(self.low.triggered)
+        self.assertFalse(self.low.emailed)
+
+
+class VersionCtlUtil(FakeCtlUtil):
+    """Classifies the versions in a fixed table."""
+
+    VERSIONS = {'0.4.8.1': 'RECOMMENDED', '0.4.7.1': 'UNRECOMMENDED',
+                '0.2.0.1': 'OBSOLETE'}
+
+    def classify_version(self, version):
+        return self.VERSIONS[version]
+
+
+class CheckVersionTest(TestCase):
+    """Tests for L{updaters.check_version}."""
+
+    def check(self, *versions):
+        descriptors = dict(
+            (fingerprint, Descriptor(100, False, version, False))
+            for fingerprint, version in zip((FINGERPRINT, OTHER_FINGERPRINT),
+                                            versions))
+        email_list = []
+        updaters.check_version(VersionCtlUtil(descriptors = descriptors),
+                               email_list)
+        return email_list
+
+    def test_notify_types(self):
+        unrecommended = _subscribe(VersionSub, FINGERPRINT)
+        obsolete_only = _subscribe(VersionSub, OTHER_FINGERPRINT,
+                                   notify_type = VersionSub.OBSOLETE)
+        self.assertEqual(len(self.check('0.4.7.1', '0.4.7.1')), 1)
+        self.assertEqual(len(self.check('0.4.7.1', '0.2.0.1')), 1)
+        unrecommended.refresh_from_db()
+        obsolete_only.refresh_from_db()
+        self.assertTrue(unrecommended.emailed)
+        self.assertTrue(obsolete_only.emailed)
+
+    def test_reset_once_recommended(self):
+        sub = _subscribe(VersionSub, FINGERPRINT)
+        self.check('0.4.7.1')
+        self.assertEqual(self.check('0.4.8.1'), [])
+        sub.refresh_from_db()
+        self.assertFalse(sub.emailed)
+        self.assertEqual(len(self.check('0.4.7.1')), 1)
+
+
+class CheckEarnTShirtTest(TestCase):
+    """Tests for L{updaters.check_earn_tshirt}."""
+
+    def subscribe(self, fingerprint, bandwidth, hours_up, flags = Router.UP):
+        sub = _subscribe(TShirtSub, fingerprint, router_flags = flags)
+        Router.objects.filter(fingerprint = fingerprint).update(
+            bandwidth_sum = bandwidth * 10, bandwidth_count = 10,
+            up_since = timezone.now() - timedelta(hours = hours_up))
+        return sub
+
+    def test_eligible_routers(self):
+        hours = TShirtSub._HOURS_REQUIRED + 1
+        fast = self.subscribe(FINGERPRINT, 500, hours)
+        exit = self.subscribe(OTHER_FINGERPRINT, 100, hours,
+                              Router.UP | Router.EXIT)
+        slow = self.subscribe('1' * 40, 100, hours)
+        young = self.subscribe('2' * 40, 500, 24)
+        email_list = []
+        updaters.check_earn_tshirt(FakeCtlUtil(), email_list)
+        self.assertEqual(len(email_list), 2)
+        for sub, emailed in ((fast, True), (exit, True), (slow, False),
+                             (young, False)):
+            sub.refresh_from_db()
+            self.assertEqual(sub.emailed, emailed)
+            self.assertTrue(sub.triggered)
+        self.assertEqual(slow.avg_bandwidth, 100)
+
+        updaters.check_earn_tshirt(FakeCtlUtil(), email_list)
+        self.assertEqual(len(email_list), 2)
+
+    def test_down_routers_are_reset(self):
+        sub = self.subscribe(FINGERPRINT, 500, 24)
+        updaters.check_earn_tshirt(FakeCtlUtil(), [])
+        Router.objects.update(flags = 0)
+        updaters.check_earn_tshirt(FakeCtlUtil(), [])
+        sub.refresh_from_db()
+        self.assertFalse(sub.triggered)
+        self.assertEqual(sub.avg_bandwidth, 0)
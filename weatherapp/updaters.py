@@ -1 +1,753 @@
-    
\ No newline at end of file
+"""
+The updaters module brings Tor Weather's database up to date with the Tor
+network. It is run by the L{listener} each time Tor has new consensus or
+descriptor data, through L{run_all}.
+
+The Stem data comes from a L{CtlUil} object, whose consensus snapshot and
+descriptor index are refreshed by the caller before L{run_all} is called.
+Each run is compared with the previous one by the L{diff} module and only
+the routers that changed are written. A router's
+L{last_seen<Router.last_seen>} time is therefore only written when it goes
+down, and records the last update in which it was still up.
+
+The subscription checks evaluate each subscription type with a small,
+fixed number of set-based queries joining L{Subscription} to L{Subscriber}
+and L{Router}, and compare the results against the in-memory network data
+held by the L{CtlUil} and the L{bandwidth} history, so their cost does
+not grow with one database or controller round trip per subscription.
+
+Each run rebuilds the L{fanout} index from the database, since
+subscribers confirm and unsubscribe in another process. After the first
+run, L{check_all_subs} is given the changes from the L{diff} module and
+uses the index to evaluate only the subscriptions on routers with a
+relevant change, plus any subscriptions confirmed since the previous run.
+The first run after a start checks every subscription, since routers may
+have gone down or changed while the updaters were not running.
+
+@type _previous_state: dict {str: L{RouterState}}
+@var _previous_state: The view of the network from the previous run, or
+    C{None} before the first run.
+
+@type _previous_time: datetime
+@var _previous_time: The time of the previous run.
+
+@type _previous_recommended: list [str]
+@var _previous_recommended: The recommended versions at the previous run.
+
+@type _ROUTER_UP: Q
+@var _ROUTER_UP: Matches subscriptions whose router is up, with a bitwise
+    test of L{Router.flags}.
+
+@type _ROUTER_DOWN: Q
+@var _ROUTER_DOWN: Matches subscriptions whose router is down.
+
+@type _CHUNK_SIZE: int
+@var _CHUNK_SIZE: Maximum number of ids in one C{__in} lookup or bulk
+    update.
+
+@type _UPTIME_DAYS: int
+@var _UPTIME_DAYS: Days of L{presence} history summarized in node down
+    emails.
+
+@type SUBSCRIPTION_CHECKS: list [tuple (str, callable, tuple)]
+@var SUBSCRIPTION_CHECKS: The subscription checks run by L{check_all_subs},
+    with the name of the subscription type each one checks and the
+    L{diff} change kinds that can affect it. A check with C{None} for its
+    change kinds depends on time as well as on the network, and is always
+    run over every subscription.
+"""
+import logging
+
+from django.core.mail import send_mass_mail
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from weatherapp import bandwidth, diff, emails, known, presence, search
+from weatherapp.fanout import subscription_index
+from weatherapp.models import BandwidthSub, NodeDownSub, Router, \
+    RouterInterval, TShirtSub, VersionSub, flags_match, \
+    hours_since_expression
+
+_CHUNK_SIZE = 500
+_UPTIME_DAYS = 30
+
+_previous_state = None
+_previous_time = None
+_previous_recommended = None
+
+_ROUTER_UP = Q(subscriber__router__flags__hasflags = Router.UP)
+_ROUTER_DOWN = Q(subscriber__router__flags__lacksflags = Router.UP)
+
+
+def _write_routers(updated, created):
+    """
+    Write routers with bulk queries: one INSERT per chunk of new routers,
+    and one UPDATE per chunk of routers for each distinct set of changed
+    columns, so no column is written that did not change.
+
+    Where the database supports it, new routers are upserted on their
+    fingerprint, so a router added by an overlapping update since it was
+    looked up is updated instead of failing the whole transaction. Such a
+    router is new to both updates, so it is not yet welcomed and
+    overwriting its flags loses nothing.
+
+    @type updated: list [tuple (L{Router}, set [str])]
+    @param updated: Existing routers, each with the names of the columns
+        that changed.
+    @type created: list [L{Router}]
+    @param created: Routers to add to the table.
+    """
+
+    by_fields = {}
+    for router, fields in updated:
+        if fields:
+            by_fields.setdefault(frozenset(fields), []).append(router)
+    for fields, routers in by_fields.items():
+        Router.objects.bulk_update(routers, sorted(fields),
+                                   batch_size = _CHUNK_SIZE)
+    if getattr(connection.features, 'supports_update_conflicts_with_target',
+               False):
+        Router.objects.bulk_create(created, batch_size = _CHUNK_SIZE,
+            update_conflicts = True, unique_fields = ['fingerprint'],
+            update_fields = ['name', 'flags', 'last_seen'])
+    else:
+        Router.objects.bulk_create(created, batch_size = _CHUNK_SIZE)
+
+
+def _state_flags(router_state):
+    """
+    @type router_state: L{RouterState}
+    @param router_state: A router's state in the current consensus.
+
+    @rtype: int
+    @return: The L{Router.flags} of a router in that state, apart from
+        L{Router.WELCOMED}.
+    """
+    flags = Router.UP | Router.consensus_flags(router_state.flags)
+    if router_state.exit:
+        flags |= Router.EXIT
+    if router_state.hibernating:
+        flags |= Router.HIBERNATING
+    return flags
+
+
+def update_all_routers(state, now):
+    """
+    Bring the whole L{Router} table in line with C{state}. Routers in
+    C{state} are marked up and have their name and flags updated; routers
+    that are not are marked down. Routers seen for the first time are added
+    to the table. This is only needed when there is no previous view of the
+    network to diff against.
+
+    @type state: dict {str: L{RouterState}}
+    @param state: The current view of the network.
+
+    @type now: datetime
+    @param now: The time of this update.
+    """
+
+    existing = set()
+    updated = []
+    for router in Router.objects.only('pk', 'fingerprint', 'name', 'flags'):
+        existing.add(router.fingerprint)
+        router_state = state.get(router.fingerprint)
+        fields = set()
+        if router_state is None:
+            if router.up:
+                router.up = False
+                router.last_seen = now
+                fields.update(['flags', 'last_seen'])
+        else:
+            flags = (router.flags & Router.WELCOMED) | \
+                    _state_flags(router_state)
+            for field, value in (('flags', flags),
+                                 ('name', router_state.name)):
+                if getattr(router, field) != value:
+                    setattr(router, field, value)
+                    fields.add(field)
+        updated.append((router, fields))
+
+    created = [Router(fingerprint = fingerprint, name = router_state.name,
+                      flags = _state_flags(router_state), last_seen = now)
+               for fingerprint, router_state in state.items()
+               if fingerprint not in existing]
+    _write_routers(updated, created)
+
+
+def apply_changes(changes, last_up):
+    """
+    Write the routers that C{changes} touch to the L{Router} table, updating
+    only the columns that changed, with bulk queries.
+
+    @type changes: list [L{RouterChange}]
+    @param changes: Change records from L{diff.diff_states}.
+
+    @type last_up: datetime
+    @param last_up: The time of the last update, recorded as the
+        L{last_seen<Router.last_seen>} time of routers that went down.
+    """
+
+    by_fingerprint = {}
+    for change in changes:
+        by_fingerprint.setdefault(change.fingerprint, []).append(change)
+
+    routers = {}
+    for chunk in _chunks(by_fingerprint):
+        for router in Router.objects.filter(fingerprint__in = chunk) \
+                                    .only('pk', 'fingerprint', 'flags'):
+            routers[router.fingerprint] = router
+
+    consensus_mask = Router.consensus_flags(Router._CONSENSUS_FLAGS)
+    updated, created = [], []
+    for fingerprint, router_changes in by_fingerprint.items():
+        router = routers.get(fingerprint)
+        fields = set()
+        for change in router_changes:
+            if change.kind == diff.APPEARED:
+                if router is None:
+                    created.append(Router(fingerprint = fingerprint,
+                                          name = change.new.name,
+                                          flags = _state_flags(change.new)))
+                    break
+                router.flags = (router.flags & Router.WELCOMED) | \
+                               _state_flags(change.new)
+                router.name = change.new.name
+                fields.update(['flags', 'name'])
+            elif change.kind == diff.DISAPPEARED:
+                if router is None:
+                    break
+                router.up = False
+                router.last_seen = last_up
+                fields.update(['flags', 'last_seen'])
+            elif router is None:
+                continue
+            elif change.kind == diff.NAME_CHANGED:
+                router.name = change.new
+                fields.add('name')
+            elif change.kind == diff.FLAGS_CHANGED:
+                router.flags = (router.flags & ~consensus_mask) | \
+                               Router.consensus_flags(change.new)
+                fields.add('flags')
+            elif change.kind == diff.EXIT_CHANGED:
+                router.exit = change.new
+                fields.add('flags')
+            elif change.kind == diff.HIBERNATION_CHANGED:
+                if change.new:
+                    router.flags |= Router.HIBERNATING
+                else:
+                    router.flags &= ~Router.HIBERNATING
+                fields.add('flags')
+        if router is not None:
+            updated.append((router, fields))
+
+    _write_routers(updated, created)
+
+
+def record_intervals(up, down, now):
+    """
+    Bring the open L{RouterInterval} of each router in C{up} and C{down}
+    in line with its state, closing the interval it was in and opening a
+    new one if its state changed. Routers already in an open interval of
+    the right state are left alone.
+
+    @type up: iterable of str
+    @param up: Fingerprints of routers that are up.
+    @type down: iterable of str
+    @param down: Fingerprints of routers that are down.
+    @type now: datetime
+    @param now: The time of this update.
+    """
+
+    for is_up, fingerprints in ((True, up), (False, down)):
+        for chunk in _chunks(fingerprints):
+            ids = list(Router.objects.filter(fingerprint__in = chunk)
+                       .values_list('pk', flat = True))
+            open_intervals = RouterInterval.objects.filter(
+                router_id__in = ids, end__isnull = True)
+            open_intervals.exclude(up = is_up).update(end = now)
+            current = set(open_intervals.filter(up = is_up)
+                          .values_list('router_id', flat = True))
+            RouterInterval.objects.bulk_create(
+                [RouterInterval(router_id = pk, up = is_up, start = now)
+                 for pk in ids if pk not in current])
+
+
+def update_routers(ctl_util):
+    """
+    Diff the network held by C{ctl_util} against the previous update and
+    write the routers that changed, and the L{RouterInterval}s of the
+    routers that came up or went down. All the writes of one update are
+    made in a single transaction.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem with a current consensus snapshot.
+
+    @rtype: list [L{RouterChange}]
+    @return: The changes since the previous update, or C{None} if
+        C{ctl_util} holds no consensus, in which case nothing is written.
+        On the first update every router is reported as L{diff.APPEARED}.
+    """
+    global _previous_state, _previous_time
+
+    now = timezone.now()
+    state = diff.network_state(ctl_util)
+    if not state:
+        logging.error("No consensus to update the routers from")
+        return None
+
+    with transaction.atomic():
+        if _previous_state is None:
+            logging.info("Updating all routers")
+            changes = diff.diff_states({}, state)
+            update_all_routers(state, now)
+            record_intervals(state, Router.objects
+                             .filter(flags__lacksflags = Router.UP)
+                             .values_list('fingerprint', flat = True), now)
+        else:
+            changes = diff.diff_states(_previous_state, state)
+            logging.info("Updating %d changed routers",
+                         len(diff.changed_fingerprints(changes)))
+            apply_changes(changes, _previous_time)
+            record_intervals(
+                diff.fingerprints_with(changes, [diff.APPEARED]),
+                diff.fingerprints_with(changes, [diff.DISAPPEARED]), now)
+
+    _previous_state = state
+    _previous_time = now
+    return changes
+
+
+def _chunks(items, size = _CHUNK_SIZE):
+    """
+    Split C{items} into lists of at most C{size} items, to keep C{__in}
+    lookups under the database's limit on query parameters.
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _update_ids(model, ids, **fields):
+    """
+    Set C{fields} on every C{model} row whose primary key is in C{ids},
+    with one UPDATE per chunk of ids.
+    """
+    for chunk in _chunks(ids):
+        model.objects.filter(pk__in = chunk).update(**fields)
+
+
+def _restricted(queryset, ids):
+    """
+    Yield C{queryset} restricted to each chunk of C{ids}, or C{queryset}
+    itself if C{ids} is C{None}.
+    """
+    if ids is None:
+        yield queryset
+        return
+    for chunk in _chunks(ids):
+        yield queryset.filter(pk__in = chunk)
+
+
+def _sub_rows(queryset, *fields):
+    """
+    Fetch the subscriptions in C{queryset} as dicts, joined with the
+    subscriber and router columns needed to decide on and write emails, in
+    one query.
+    """
+    return queryset.filter(subscriber__confirmed = True).values('pk',
+        'subscriber__email', 'subscriber__unsubs_auth',
+        'subscriber__pref_auth', 'subscriber__router__fingerprint',
+        'subscriber__router__name', *fields)
+
+
+def check_node_down(ctl_util, email_list, ids = None):
+    """
+    Check node down subscriptions. A subscription is triggered when its
+    router is down and not hibernating, which schedules an email for the
+    end of the grace period in L{NodeDownSub.due}. The schedule is
+    cancelled if the router comes back up first. Runs a fixed number of
+    queries however many subscriptions there are. The emails include the
+    router's uptime over the last L{_UPTIME_DAYS} days from the
+    L{presence} history.
+
+    The emails that have come due are always looked for among every
+    subscription, since they become due with time rather than with a
+    change to the network. The lookup uses the index on
+    L{NodeDownSub.due}, so only the due subscriptions are read.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem.
+    @type email_list: list
+    @param email_list: List that email tuples are appended to.
+    @type ids: iterable of int
+    @param ids: Only check the subscriptions with these ids, if given.
+    """
+
+    now = timezone.now()
+    hibernating = set(fingerprint for fingerprint, desc
+                      in ctl_util.get_descriptors().items()
+                      if desc.hibernating)
+    subs = NodeDownSub.objects.filter(subscriber__confirmed = True)
+
+    for checked in _restricted(subs, ids):
+        # Routers that are back up, or only hibernating.
+        checked.filter(_ROUTER_UP, triggered = True) \
+            .update(triggered = False, emailed = False, last_changed = now,
+                    due = None)
+        for chunk in _chunks(hibernating):
+            checked.filter(triggered = True,
+                           subscriber__router__fingerprint__in = chunk) \
+                .update(triggered = False, emailed = False,
+                        last_changed = now, due = None)
+
+        # Routers that have gone down since the last check.
+        down = checked.filter(_ROUTER_DOWN, triggered = False)
+        scheduled = []
+        for row in down.values('pk', 'grace_pd',
+                               'subscriber__router__fingerprint',
+                               'subscriber__router__last_seen'):
+            if row['subscriber__router__fingerprint'] in hibernating:
+                continue
+            went_down = row['subscriber__router__last_seen'] or now
+            scheduled.append(NodeDownSub(pk = row['pk'], triggered = True,
+                last_changed = went_down,
+                due = NodeDownSub.get_due(went_down, row['grace_pd'])))
+        NodeDownSub.objects.bulk_update(scheduled,
+            ['triggered', 'last_changed', 'due'], batch_size = _CHUNK_SIZE)
+
+    emailed = []
+    history = presence.get_history()
+    for row in _sub_rows(subs.filter(due__lte = now), 'grace_pd'):
+        fingerprint = row['subscriber__router__fingerprint']
+        email_list.append(emails.node_down_tuple(
+            row['subscriber__email'], fingerprint,
+            row['subscriber__router__name'], row['grace_pd'],
+            row['subscriber__unsubs_auth'], row['subscriber__pref_auth'],
+            history.stats(fingerprint, _UPTIME_DAYS * 24), _UPTIME_DAYS))
+        emailed.append(row['pk'])
+    _update_ids(NodeDownSub, emailed, emailed = True, due = None)
+
+
+def check_version(ctl_util, email_list, ids = None):
+    """
+    Check version subscriptions against the recommended versions of the
+    current consensus. Each distinct Tor version is classified once, and
+    the subscriptions are read and written with a fixed number of queries.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem.
+    @type email_list: list
+    @param email_list: List that email tuples are appended to.
+    @type ids: iterable of int
+    @param ids: Only check the subscriptions with these ids, if given.
+    """
+
+    version_types = {}
+    by_version = {}
+    for fingerprint, desc in ctl_util.get_descriptors().items():
+        if desc.version is None:
+            continue
+        if desc.version not in by_version:
+            by_version[desc.version] = ctl_util.classify_version(desc.version)
+        version_types[fingerprint] = by_version[desc.version]
+
+    emailed, reset = [], []
+    rows = (row for subs in _restricted(VersionSub.objects.all(), ids)
+            for row in _sub_rows(subs, 'notify_type', 'emailed'))
+    for row in rows:
+        version_type = version_types.get(row['subscriber__router__fingerprint'],
+                                         'ERROR')
+        if version_type == 'ERROR':
+            continue
+        if version_type == 'RECOMMENDED':
+            if row['emailed']:
+                reset.append(row['pk'])
+        elif not row['emailed'] and \
+             (row['notify_type'] == VersionSub.UNRECOMMENDED or
+              version_type == VersionSub.OBSOLETE):
+            email_list.append(emails.version_tuple(row['subscriber__email'],
+                row['subscriber__router__fingerprint'],
+                row['subscriber__router__name'], version_type,
+                row['subscriber__unsubs_auth'], row['subscriber__pref_auth']))
+            emailed.append(row['pk'])
+    _update_ids(VersionSub, emailed, emailed = True)
+    _update_ids(VersionSub, reset, emailed = False)
+
+
+def check_low_bandwidth(ctl_util, email_list, ids = None):
+    """
+    Check low bandwidth subscriptions against the L{bandwidth} history of
+    routers that are up, with a fixed number of queries. A subscription is
+    triggered once its router's bandwidth has stayed below the threshold
+    for L{BandwidthSub._HOURS_BELOW} hourly consensuses, and reset once the
+    latest sample is back above it.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem.
+    @type email_list: list
+    @param email_list: List that email tuples are appended to.
+    @type ids: iterable of int
+    @param ids: Only check the subscriptions with these ids, if given.
+    """
+
+    now = timezone.now()
+    history = bandwidth.get_history()
+    subs = BandwidthSub.objects.filter(_ROUTER_UP)
+    rows = [row for checked in _restricted(subs, ids)
+            for row in _sub_rows(checked, 'threshold', 'triggered',
+                                 'emailed')]
+    fingerprints = set(row['subscriber__router__fingerprint'] for row in rows)
+    sustained = history.recent_max(fingerprints, BandwidthSub._HOURS_BELOW)
+    latest = history.recent_max(fingerprints, 1)
+
+    triggered, reset, emailed = [], [], []
+    for row in rows:
+        fingerprint = row['subscriber__router__fingerprint']
+        highest = sustained.get(fingerprint)
+        if highest is not None and highest < row['threshold']:
+            if not row['triggered']:
+                triggered.append(row['pk'])
+            if not row['emailed']:
+                email_list.append(emails.low_bandwidth_tuple(
+                    row['subscriber__email'], fingerprint,
+                    row['subscriber__router__name'], latest[fingerprint],
+                    row['threshold'], row['subscriber__unsubs_auth'],
+                    row['subscriber__pref_auth']))
+                emailed.append(row['pk'])
+        elif row['triggered'] and \
+             latest.get(fingerprint, 0) >= row['threshold']:
+            reset.append(row['pk'])
+    _update_ids(BandwidthSub, triggered, triggered = True, last_changed = now)
+    _update_ids(BandwidthSub, emailed, emailed = True)
+    _update_ids(BandwidthSub, reset, triggered = False, emailed = False,
+                last_changed = now)
+
+
+def check_earn_tshirt(ctl_util, email_list, ids = None):
+    """
+    Check T-shirt subscriptions against the running bandwidth totals kept
+    on each L{Router} by L{record_bandwidth}, so each subscription is a
+    constant-time check. Uptime is counted from L{Router.up_since}, not
+    from the number of samples, so a missed consensus does not cost a
+    router any hours, and is computed by the database in the same query
+    that reads the subscriptions. The averages are copied to the
+    subscriptions with one bulk update per chunk of subscriptions.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem.
+    @type email_list: list
+    @param email_list: List that email tuples are appended to.
+    @type ids: iterable of int
+    @param ids: Ignored; uptime grows with every update, so every
+        subscription is checked on every run.
+    """
+
+    now = timezone.now()
+    subs = TShirtSub.objects.filter(subscriber__confirmed = True)
+
+    subs.filter(_ROUTER_DOWN, triggered = True).update(
+        triggered = False, avg_bandwidth = 0, last_changed = now)
+
+    updated, came_up, emailed = [], [], []
+    up = subs.filter(_ROUTER_UP).annotate(up_for = hours_since_expression(
+        'subscriber__router__up_since', now))
+    rows = list(_sub_rows(up, 'triggered', 'emailed', 'up_for',
+                          'subscriber__router__flags',
+                          'subscriber__router__bandwidth_sum',
+                          'subscriber__router__bandwidth_count'))
+    exits = flags_match([row['subscriber__router__flags'] for row in rows],
+                        required = Router.EXIT)
+    for row, exit in zip(rows, exits):
+        samples = row['subscriber__router__bandwidth_count']
+        avg_bandwidth = row['subscriber__router__bandwidth_sum'] // samples \
+                        if samples else 0
+        up_for = row['up_for']
+        hours_up = int(up_for.total_seconds() // 3600) if up_for else 0
+        updated.append(TShirtSub(pk = row['pk'],
+                                 avg_bandwidth = avg_bandwidth))
+        if not row['triggered']:
+            came_up.append(row['pk'])
+        if not row['emailed'] and \
+           TShirtSub.is_eligible(avg_bandwidth, hours_up, exit):
+            email_list.append(emails.t_shirt_tuple(
+                row['subscriber__email'],
+                row['subscriber__router__fingerprint'],
+                row['subscriber__router__name'], avg_bandwidth, hours_up,
+                exit, row['subscriber__unsubs_auth'],
+                row['subscriber__pref_auth']))
+            emailed.append(row['pk'])
+
+    TShirtSub.objects.bulk_update(updated, ['avg_bandwidth'],
+                                  batch_size = _CHUNK_SIZE)
+    _update_ids(TShirtSub, came_up, triggered = True, last_changed = now)
+    _update_ids(TShirtSub, emailed, emailed = True)
+
+
+def _bandwidth_samples(ctl_util, fingerprints):
+    """
+    @rtype: dict {str: int}
+    @return: The observed bandwidth in kB/s of each router in
+        C{fingerprints} that is in the consensus.
+    """
+    consensus = ctl_util.get_consensus()
+    descriptors = ctl_util.get_descriptors()
+    samples = {}
+    for fingerprint in fingerprints:
+        if fingerprint in consensus:
+            desc = descriptors.get(fingerprint)
+            samples[fingerprint] = desc.observed_bandwidth // 1000 \
+                                   if desc else 0
+    return samples
+
+
+def _consensus_seq(ctl_util):
+    """
+    @rtype: int
+    @return: The number of the consensus held by C{ctl_util}, from
+        L{presence.consensus_seq}.
+    """
+    return presence.consensus_seq(ctl_util.get_valid_after() or
+                                  timezone.now())
+
+
+def record_bandwidth(ctl_util):
+    """
+    Record the current observed bandwidth of the routers with low
+    bandwidth or T-shirt subscriptions. Low bandwidth routers get a sample
+    in the L{bandwidth} history, once per consensus, and routers without a
+    low bandwidth subscription are dropped from it before it is saved.
+    T-shirt routers have the sample added to their running totals, also
+    once per consensus, and routers that are down have their totals
+    cleared, each with a fixed number of queries.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem with a current consensus snapshot.
+    """
+
+    history = bandwidth.get_history()
+    subscribed = subscription_index.fingerprints(('low_bandwidth',))
+    history.retain(subscribed)
+    new_consensus = history.record(_consensus_seq(ctl_util),
+                                   _bandwidth_samples(ctl_util, subscribed))
+    try:
+        history.save(bandwidth.HISTORY_FILE)
+    except OSError as exc:
+        logging.error("Could not save the bandwidth history: %s", exc)
+
+    now = timezone.now()
+    Router.objects.filter(flags__lacksflags = Router.UP,
+                          bandwidth_count__gt = 0).update(
+        bandwidth_sum = 0, bandwidth_count = 0, up_since = None)
+    if not new_consensus:
+        return
+
+    samples = _bandwidth_samples(ctl_util,
+        subscription_index.fingerprints(('t_shirt',)))
+    updated = []
+    for chunk in _chunks(samples):
+        for row in Router.objects.filter(fingerprint__in = chunk).values(
+                'pk', 'fingerprint', 'bandwidth_sum', 'bandwidth_count',
+                'up_since'):
+            updated.append(Router(pk = row['pk'],
+                bandwidth_sum = row['bandwidth_sum'] +
+                                samples[row['fingerprint']],
+                bandwidth_count = row['bandwidth_count'] + 1,
+                up_since = row['up_since'] or now))
+    Router.objects.bulk_update(updated,
+        ['bandwidth_sum', 'bandwidth_count', 'up_since'],
+        batch_size = _CHUNK_SIZE)
+
+
+SUBSCRIPTION_CHECKS = [
+    ('node_down', check_node_down,
+     (diff.APPEARED, diff.DISAPPEARED, diff.HIBERNATION_CHANGED)),
+    ('version', check_version, (diff.APPEARED, diff.VERSION_CHANGED)),
+    ('low_bandwidth', check_low_bandwidth, None),
+    ('t_shirt', check_earn_tshirt, None)]
+
+
+def check_all_subs(ctl_util, changes = None):
+    """
+    Run every subscription check. If C{changes} is given, each check is
+    only run over the subscriptions on routers with a change it cares
+    about, and over the subscriptions confirmed since the previous run.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem.
+    @type changes: list [L{RouterChange}]
+    @param changes: The changes since the previous run, if known.
+
+    @rtype: list [tuple]
+    @return: The emails to send, as tuples for Django's send_mass_mail().
+    """
+    global _previous_recommended
+
+    # A change to the recommended versions can affect every version
+    # subscription, whether or not its router changed.
+    recommended = ctl_util.get_recommended_versions()
+    recommended_changed = recommended != _previous_recommended
+    _previous_recommended = recommended
+
+    added = subscription_index.take_added()
+    email_list = []
+    for name, check, kinds in SUBSCRIPTION_CHECKS:
+        if changes is None or kinds is None or \
+           (name == 'version' and recommended_changed):
+            ids = None
+        else:
+            fingerprints = diff.fingerprints_with(changes, kinds)
+            ids = subscription_index.subscriptions_for(fingerprints, name)
+            ids.update(pk for pk, type_name in added.items()
+                       if type_name == name)
+            logging.info("Checking %d %s subscriptions", len(ids), name)
+        check(ctl_util, email_list, ids)
+    return email_list
+
+
+def record_presence(ctl_util):
+    """
+    Record which routers are in the current consensus in the L{presence}
+    history, and save it. The L{known} fingerprint filter is rebuilt from
+    the updated history.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem with a current consensus snapshot.
+    """
+
+    history = presence.get_history()
+    history.record(_consensus_seq(ctl_util), ctl_util.get_consensus())
+    try:
+        presence.save_history()
+    except OSError as exc:
+        logging.error("Could not save the presence history: %s", exc)
+    known.rebuild(history)
+
+
+def run_all(ctl_util):
+    """
+    Run every stage of the update pipeline against the data currently held
+    by C{ctl_util}: update the routers and the subscription index, publish
+    the router list for the search box, record their presence and
+    bandwidth, check the subscriptions and send the notification emails.
+
+    @type ctl_util: L{CtlUil}
+    @param ctl_util: A connection to Stem with a current consensus snapshot.
+
+    @rtype: list [L{RouterChange}]
+    @return: The changes since the previous run, or C{None} if C{ctl_util}
+        holds no consensus, in which case the run is abandoned.
+    """
+
+    first_run = _previous_state is None
+    changes = update_routers(ctl_util)
+    if changes is None:
+        return None
+    subscription_index.update()
+    search.publish(_previous_state)
+    record_presence(ctl_util)
+    record_bandwidth(ctl_util)
+    email_list = check_all_subs(ctl_util, None if first_run else changes)
+    logging.info("Sending %d emails", len(email_list))
+    send_mass_mail(email_list, fail_silently = True)
+    return changes
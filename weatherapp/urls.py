@@ -7,5 +7,7 @@ urlpatterns = [
     path ('', views.home , name = 'home'),
     path ('subscribe/', views.subscribe , name = 'subscribe'),
     path ('notification_info/', views.notification_info , name = 'notification_info'),
+    path ('router_name_lookup/', views.router_name_lookup , name = 'router_name_lookup'),
+    path ('router_fingerprint_lookup/', views.router_fingerprint_lookup , name = 'router_fingerprint_lookup'),
     
 ]
\ No newline at end of file
@@ -1,8 +1,11 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from config import url_helper,templates
 from django.shortcuts import render, get_object_or_404
 
+from weatherapp import search
+from weatherapp.models import SubscribeForm
+
 
 
 
@@ -21,16 +24,58 @@ def home(request):
 def subscribe(request):
     """
     Displays the subscription form (all fields empty or default) if the
-    form hasn't been submitted. After the user hits the submit button,
-    redirects to the pending page if all of the fields were acceptable.
-    If the user is already subscribed to that Tor node, they are sent to 
-    an error page.
+    form hasn't been submitted. After the user hits the submit button, a
+    fingerprint that no known router has leads to the fingerprint not found
+    page, and other invalid fields redisplay the form with their errors.
+    Subscriptions are not stored yet, so a valid form leads to an error
+    page that says so rather than to the pending page.
     """
 
-    
-    return render(request, 'subscribe.html')
+    if request.method == 'POST':
+        form = SubscribeForm(request.POST)
+        if form.is_valid():
+            return render(request, 'error.html', {'error_message':
+                'Your details are valid, but signing up is not available '
+                'yet, so no subscription was created for router %s. '
+                'Please try again later.' % form.cleaned_data['fingerprint']})
+        if form.has_error('fingerprint', SubscribeForm.NOT_FOUND):
+            return render(request, 'fingerprint_not_found.html',
+                          {'fingerprint': request.POST.get('fingerprint')})
+    else:
+        form = SubscribeForm()
+    return render(request, 'subscribe.html', {'form': form})
+
+
+
+def router_name_lookup(request):
+    """
+    Returns a JSON list of router names and fingerprints starting with the
+    C{query} parameter, followed by close fuzzy matches, for the router
+    search autocomplete on the subscribe page. Answered from the in-memory
+    L{search} indexes.
+    """
+
+    query = request.GET.get('query', '')
+    return JsonResponse(search.suggest(query), safe=False)
 
+def router_fingerprint_lookup(request):
+    """
+    Returns the fingerprint of the router named by the C{query} parameter as
+    JSON, or C{"nonunique_name"} if several routers have that name, or
+    C{"no_router"} if none does. A fingerprint, or a prefix of exactly one
+    fingerprint, is also accepted as the query.
+    """
 
+    query = request.GET.get('query', '').strip()
+    index = search.get_name_index()
+    fingerprints = index.fingerprints_for(query)
+    if not fingerprints:
+        fingerprints = index.fingerprints_with_prefix(query, 2)
+    if not fingerprints:
+        return JsonResponse('no_router', safe=False)
+    if len(fingerprints) > 1:
+        return JsonResponse('nonunique_name', safe=False)
+    return JsonResponse(fingerprints[0], safe=False)
 
 def notification_info(request):
     """